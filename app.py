@@ -1,7 +1,7 @@
 import os
 import logging
 from dotenv import load_dotenv
-from flask import Flask
+from flask import Flask, Request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager
@@ -21,8 +21,17 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
+# Stream multipart file uploads straight to disk next to the upload folder
+# instead of a temporary file that has to be copied again when it is saved
+class IngestRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        from utils import IngestFile
+        from config import INCOMING_FOLDER
+        return IngestFile(INCOMING_FOLDER)
+
 # Create the app
 app = Flask(__name__)
+app.request_class = IngestRequest
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 
 # Configure the database
@@ -36,7 +45,7 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Set upload folder and allowed extensions from config
-from config import UPLOAD_FOLDER, MAX_CONTENT_LENGTH
+from config import UPLOAD_FOLDER, MAX_CONTENT_LENGTH, LIVE_ABR_ENABLED, LIVE_ABR_FOLDER, MEDIA_WORKER_AUTOSTART
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
@@ -51,6 +60,11 @@ login_manager.login_message_category = 'info'
 # Create upload directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, "thumbnails"), exist_ok=True)
+os.makedirs(os.path.join(UPLOAD_FOLDER, ".incoming"), exist_ok=True)
+os.makedirs(os.path.join(UPLOAD_FOLDER, ".progress"), exist_ok=True)
+if LIVE_ABR_ENABLED:
+    # One of the HLS roots; created up front so it is watched without waiting for a retry
+    os.makedirs(LIVE_ABR_FOLDER, exist_ok=True)
 
 with app.app_context():
     # Import models
@@ -93,8 +107,9 @@ app.register_blueprint(webrtc_bp)
 # Additional route setup
 setup_routes(app)
 
-# Start WebRTC server as a separate process when in production
-if os.environ.get('FLASK_ENV') != 'development':
+# Start WebRTC server and media workers as separate processes when in production
+# (skipped inside the media worker processes, which import this module too)
+if os.environ.get('FLASK_ENV') != 'development' and not os.environ.get('STREAMLITE_MEDIA_WORKER'):
     import subprocess
     import sys
     
@@ -108,6 +123,17 @@ if os.environ.get('FLASK_ENV') != 'development':
         logger.info("WebRTC server started as a separate process on port 5443")
     except Exception as e:
         logger.error(f"Failed to start WebRTC server: {e}")
+    
+    # Start the media processing worker pool unless it runs as its own service
+    if MEDIA_WORKER_AUTOSTART:
+        try:
+            media_worker_process = subprocess.Popen(
+                [sys.executable, "media_worker.py"],
+                env=dict(os.environ, STREAMLITE_MEDIA_WORKER="1")
+            )
+            logger.info("Media worker pool started as a separate process")
+        except Exception as e:
+            logger.error(f"Failed to start media worker pool: {e}")
 
 # Context processors
 @app.context_processor
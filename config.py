@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 # Application configuration
 DEBUG = True
@@ -8,6 +9,12 @@ SECRET_KEY = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-producti
 UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
 THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, "thumbnails")
 MAX_CONTENT_LENGTH = 1024 * 1024 * 1024  # 1GB
+INCOMING_FOLDER = os.path.join(UPLOAD_FOLDER, ".incoming")  # Partial uploads, same filesystem as UPLOAD_FOLDER
+
+# Chunked (resumable) uploads
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB per PUT request
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get("CHUNKED_UPLOAD_MAX_SIZE", 4 * 1024 * 1024 * 1024))  # 4GB
+CHUNKED_UPLOAD_EXPIRY = 24 * 3600  # Abandoned sessions are removed after this many seconds
 
 # Allowed file extensions
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mkv', 'mov', 'webm', 'flv', 'wmv', 'm4v', 'mpg', 'mpeg', '3gp', '3g2', 'mxf', 'ts', 'mts', 'h264', 'h265', 'hevc', 'divx', 'f4v'}
@@ -18,8 +25,32 @@ ALLOWED_EXTENSIONS = ALLOWED_VIDEO_EXTENSIONS.union(ALLOWED_AUDIO_EXTENSIONS)
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
 FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
 
+# Limits for every ffmpeg/ffprobe process (see ffmpeg_runner)
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", 3000))  # Seconds
+# Encodes get FFMPEG_TIMEOUT plus this many seconds per second of media (see ffmpeg_runner.encode_timeout)
+FFMPEG_TIMEOUT_PER_MEDIA_SECOND = float(os.environ.get("FFMPEG_TIMEOUT_PER_MEDIA_SECOND", 4))
+FFPROBE_TIMEOUT = int(os.environ.get("FFPROBE_TIMEOUT", 60))
+FFMPEG_MAX_OUTPUT_BYTES = int(os.environ.get("FFMPEG_MAX_OUTPUT_BYTES", 50 * 1024 * 1024 * 1024))  # Per process
+
 # Thumbnail generation
-THUMBNAIL_POSITION = 5  # Position in seconds to take a thumbnail from a video
+THUMBNAIL_POSITION = 5  # Fallback position in seconds when frames cannot be scored
+THUMBNAIL_CANDIDATES = 12  # Frames sampled and scored to pick the thumbnail
+
+# Storyboard (seek preview) sprite sheets
+STORYBOARD_FOLDER = os.path.join(UPLOAD_FOLDER, "storyboards")
+STORYBOARD_INTERVAL = 5  # Seconds between preview frames
+STORYBOARD_MAX_FRAMES = 400  # Long videos use a wider interval to stay under this
+STORYBOARD_TILE_WIDTH = 160  # Width of each preview frame in pixels
+STORYBOARD_GRID = (10, 10)  # Columns and rows per sprite sheet
+STORYBOARD_FORMAT = os.environ.get("STORYBOARD_FORMAT", "jpg")  # jpg or webp
+
+# Audio waveforms (see waveform.py)
+WAVEFORM_FOLDER = os.path.join(UPLOAD_FOLDER, "waveforms")
+WAVEFORM_SAMPLE_RATE = 8000  # Audio is decoded to mono at this rate before peaks are taken
+WAVEFORM_SAMPLES_PER_PEAK = 64  # Finest level, 125 peaks per second at 8 kHz
+WAVEFORM_LEVEL_FACTOR = 4  # Each coarser level covers this many peaks of the previous one
+WAVEFORM_MIN_PEAKS = 1024  # Stop adding coarser levels below this many peaks
+WAVEFORM_BITS = 8  # Stored value size, 8 or 16
 
 # Video quality presets for transcoding
 VIDEO_QUALITY_PRESETS = {
@@ -43,5 +74,150 @@ VIDEO_QUALITY_PRESETS = {
 # Default transcoding quality
 DEFAULT_QUALITY = 'medium'
 
+# Parallel encoding of long videos and their HLS ladders (split at keyframes, one ffmpeg process per segment)
+TRANSCODE_PARALLEL_PROCESSES = int(os.environ.get("TRANSCODE_PARALLEL_PROCESSES", os.cpu_count() or 1))
+TRANSCODE_SEGMENT_SECONDS = 60  # Target length of each independently encoded segment
+TRANSCODE_PARALLEL_MIN_DURATION = 300  # Shorter videos are encoded by a single process
+
+# Adaptive HLS packaging for on-demand video
+HLS_VOD_ENABLED = os.environ.get("HLS_VOD_ENABLED", "1") == "1"
+HLS_VOD_FOLDER = os.path.join(UPLOAD_FOLDER, "hls")
+HLS_VOD_SEGMENT_DURATION = 6  # Seconds per segment, keyframes are forced on these boundaries
+HLS_VOD_SEGMENT_TYPE = os.environ.get("HLS_VOD_SEGMENT_TYPE", "mpegts")  # mpegts or fmp4
+# Web-compatible sources are copied into the ladder as the rung they fit in, unless their bitrate
+# is more than this multiple of the rung's
+HLS_VOD_COPY_MAX_BITRATE_RATIO = 2
+
+# Background media processing
+MEDIA_WORKER_PROCESSES = int(os.environ.get("MEDIA_WORKER_PROCESSES", 2))  # Separate processes that run ffmpeg jobs
+# The web application starts the pool itself unless this is 0 (set it when media-worker.service is used)
+MEDIA_WORKER_AUTOSTART = os.environ.get("MEDIA_WORKER_AUTOSTART", "1") == "1"
+# Held by the running pool; a second pool on the host exits instead of duplicating the
+# CPU budget, ABR encoders, live archives and metric samples
+MEDIA_WORKER_LOCK_PATH = os.path.join(UPLOAD_FOLDER, ".media-worker.lock")
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 2))  # Seconds an idle worker waits before polling again
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_HEARTBEAT_INTERVAL = 60  # Seconds between heartbeats of a running job
+JOB_STALE_TIMEOUT = int(os.environ.get("JOB_STALE_TIMEOUT", 600))  # Running jobs without a heartbeat for this long are requeued
+JOB_PROGRESS_FOLDER = os.path.join(UPLOAD_FOLDER, ".progress")  # Per-job progress records written by the workers
+JOB_PROGRESS_INTERVAL = 1  # Minimum seconds between progress record updates
+JOB_PROGRESS_POLL_INTERVAL = 2000  # Milliseconds between client progress polls
+
+# CPU budget for ffmpeg processes started by the media workers (see transcode_scheduler).
+# Cores outside the budget are left to the gunicorn web workers.
+TRANSCODE_CPU_BUDGET = int(os.environ.get("TRANSCODE_CPU_BUDGET", max(1, (os.cpu_count() or 2) // 2)))
+# Share of the budget kept for the lanes below one with work waiting, so a queued live
+# encoder cannot hold back every upload job
+TRANSCODE_LOWER_LANE_RESERVE = float(os.environ.get("TRANSCODE_LOWER_LANE_RESERVE", 0.25))
+# Priority lanes, highest first: default encoder threads, nice value and ionice class/level
+TRANSCODE_LANES = {
+    # Live ABR encoders (see live_transcoder.py), threads split across renditions
+    'live': {'threads': max(1, min(6, TRANSCODE_CPU_BUDGET - int(TRANSCODE_CPU_BUDGET * TRANSCODE_LOWER_LANE_RESERVE))),
+             'nice': 0},
+    'interactive': {'threads': 2, 'nice': 5, 'ionice_class': 2, 'ionice_level': 4},  # Probing and thumbnails of new uploads
+    'bulk': {'threads': 4, 'nice': 15, 'ionice_class': 3}  # Full encodes, HLS ladders and storyboards
+}
+SCHEDULER_METRICS_PATH = os.path.join(UPLOAD_FOLDER, ".progress", "scheduler.json")
+# flock()ed around every scheduler update; the kernel drops it when a worker dies mid-update
+SCHEDULER_LOCK_PATH = os.environ.get("SCHEDULER_LOCK_PATH", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-scheduler.lock"))
+
+# Directories nginx-rtmp may write live HLS output to (see hls_index.py), in lookup order
+HLS_ROOTS = [path for path in os.environ.get("HLS_ROOTS", os.pathsep.join([
+    "/var/hls",  # Default nginx-rtmp path
+    "/var/www/hls",  # Alternative nginx path
+    os.path.join(os.getcwd(), "hls"),  # Local development path
+    "/hls",
+    "/live/hls",
+    "/var/www/html/live/hls",  # Common aapanel path
+    "/home/wwwroot/default/live/hls",  # Another common path
+])).split(os.pathsep) if path]
+HLS_NEGATIVE_CACHE_TTL = 1  # Seconds a missing HLS file is not looked up again (without inotify)
+
+# Live ABR ladder (see live_transcoder.py): the media worker pool runs one ffmpeg per live stream
+# that re-encodes the RTMP ingest into these renditions plus a master playlist
+LIVE_ABR_ENABLED = os.environ.get("LIVE_ABR_ENABLED", "0") == "1"
+LIVE_ABR_FOLDER = os.environ.get("LIVE_ABR_FOLDER", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-abr"))
+LIVE_ABR_INPUT_URL = os.environ.get("LIVE_ABR_INPUT_URL", "rtmp://127.0.0.1:1935/live/{stream_key}")
+LIVE_ABR_LADDER = [  # Renditions above the stream's configured resolution are skipped
+    {'name': '1080p', 'height': 1080, 'video_bitrate': '5000k', 'audio_bitrate': '160k'},
+    {'name': '720p', 'height': 720, 'video_bitrate': '2800k', 'audio_bitrate': '128k'},
+    {'name': '480p', 'height': 480, 'video_bitrate': '1400k', 'audio_bitrate': '96k'},
+    {'name': '360p', 'height': 360, 'video_bitrate': '800k', 'audio_bitrate': '64k'},
+]
+LIVE_ABR_SEGMENT_DURATION = 2  # Seconds, keyframes are forced on these boundaries in every rendition
+LIVE_ABR_LIST_SIZE = 6  # Segments per rendition playlist
+LIVE_ABR_CHECK_INTERVAL = 2  # Seconds between checks of the running encoders
+if LIVE_ABR_ENABLED:
+    HLS_ROOTS.append(LIVE_ABR_FOLDER)
+
+# Live-to-VOD archiving (see live_archive.py): segments are copied out of the HLS roots as they are
+# written, before hls_cleanup removes them, and remuxed without re-encoding into a private Media item at the end.
+# Off unless enabled: broadcasters may not expect their streams to be recorded
+LIVE_ARCHIVE_ENABLED = os.environ.get("LIVE_ARCHIVE_ENABLED", "0") == "1"
+# Outside UPLOAD_FOLDER, which is served to anyone; on its filesystem the finished video is renamed into place
+LIVE_ARCHIVE_FOLDER = os.environ.get("LIVE_ARCHIVE_FOLDER", os.path.join(os.path.dirname(UPLOAD_FOLDER), "live-archive"))
+LIVE_ARCHIVE_CHECK_INTERVAL = 2  # Seconds between playlist checks, well below hls_playlist_length
+
+# Shared-memory cache of the newest live segments, used when the application serves HLS itself
+# (see segment_cache.py); the budget is split into slots of HLS_SEGMENT_CACHE_SLOT_BYTES
+HLS_SEGMENT_CACHE_ENABLED = os.environ.get("HLS_SEGMENT_CACHE_ENABLED", "1") == "1"
+HLS_SEGMENT_CACHE_PATH = os.environ.get("HLS_SEGMENT_CACHE_PATH", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-segments"))
+HLS_SEGMENT_CACHE_BYTES = int(os.environ.get("HLS_SEGMENT_CACHE_BYTES", 256 * 1024 * 1024))
+HLS_SEGMENT_CACHE_SLOT_BYTES = 4 * 1024 * 1024  # Larger segments are always read from disk
+HLS_SEGMENT_CACHE_PER_STREAM = 6  # Newest segments kept per stream
+
+# Edge relay (see edge_relay.py): HLS files missing locally are fetched from this origin over
+# pooled keep-alive connections and cached; an empty HLS_ORIGIN_URL disables relaying
+HLS_ORIGIN_URL = os.environ.get("HLS_ORIGIN_URL", "https://hwosecurity.org/live/hls").rstrip("/")
+HLS_ORIGIN_TIMEOUT = 3  # Seconds per origin request
+HLS_ORIGIN_POOL_SIZE = 4  # Idle keep-alive connections kept per worker
+HLS_EDGE_CACHE_FOLDER = os.environ.get("HLS_EDGE_CACHE_FOLDER", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-edge"))
+HLS_EDGE_MANIFEST_TTL = 1  # Seconds a relayed playlist is reused, playlists change every segment
+HLS_EDGE_SEGMENT_TTL = 300  # Seconds a relayed segment is kept, segments never change
+HLS_EDGE_NEGATIVE_TTL = 2  # Seconds a missing file or failed origin request is remembered
+
+# Live stream state (see live_state.py)
+LIVE_STALL_GRACE = int(os.environ.get("LIVE_STALL_GRACE", 60))  # Seconds without new segments before a stream is ended
+LIVE_STALL_CHECK_INTERVAL = 10  # Seconds between stall checks in the media worker pool
+LIVE_STATUS_POLL_INTERVAL = 15000  # Milliseconds between status checks of the viewer page
+# Snapshot of live streams written by the media worker pool, status checks read it instead of the database
+LIVE_STATUS_PATH = os.environ.get("LIVE_STATUS_PATH", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-live-status.json"))
+LIVE_STATUS_REFRESH_INTERVAL = 5  # Seconds between snapshots; older than three intervals counts as missing
+
+# Concurrent viewers from player heartbeats (see viewer_tracker.py)
+VIEWER_FOLDER = os.environ.get("VIEWER_FOLDER", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "streamlite-viewers"))
+VIEWER_HEARTBEAT_INTERVAL = 15  # Seconds between heartbeats of a viewer page
+VIEWER_SESSION_TIMEOUT = 45  # Seconds without a heartbeat before a viewer is no longer counted
+VIEWER_FLUSH_INTERVAL = 10  # Seconds between viewer count updates in the database
+HLL_PRECISION = 11  # Unique viewer sketches have 2^11 registers: 2KB, about 2.3% error (see hyperloglog.py)
+
+# Low-latency HLS server (see llhls_server.py); nginx proxies /live/llhls/ to it
+LLHLS_ENABLED = os.environ.get("LLHLS_ENABLED", "0") == "1"  # Players load playlists from /live/llhls/
+LLHLS_HOST = os.environ.get("LLHLS_HOST", "127.0.0.1")
+LLHLS_PORT = int(os.environ.get("LLHLS_PORT", 5090))
+LLHLS_HOLD_TIMEOUT = 6  # Seconds a request for a future part or segment is held without a target duration
+LLHLS_POLL_INTERVAL = 0.1  # Seconds between mtime checks of waited-on files without inotify
+
+# Live stream metrics (see live_metrics.py)
+ANALYTICS_SAMPLE_INTERVAL = 5  # Seconds between samples of viewers, ingest bitrate and chat rate
+ANALYTICS_RING_SIZE = 720  # Samples kept in memory per stream (one hour at 5 seconds)
+ANALYTICS_MINUTE_RETENTION_DAYS = 14  # Minute rollups are deleted after this, hour rollups are kept
+ANALYTICS_MINUTE_CHART_HOURS = 6  # Longer sessions are charted from hour rollups
+
+# File delivery (see delivery.py): auto offloads to nginx when the proxy sends X-Sendfile-Type,
+# x-accel / x-sendfile always offload, direct always sends from the application
+DELIVERY_MODE = os.environ.get("DELIVERY_MODE", "auto")
+# Directories nginx may serve with X-Accel-Redirect, "/real/dir/=/internal/uri/" comma separated; each internal
+# URI is an internal location aliased to that directory only. Files outside them are sent by the application
+ACCEL_REDIRECT_MAPPING = [tuple(mapping.strip().split('=', 1)) for mapping in os.environ.get(
+    "ACCEL_REDIRECT_MAPPING", f"{UPLOAD_FOLDER.rstrip('/')}/=/_accel/uploads/,/var/hls/=/_accel/hls/"
+).split(',') if '=' in mapping]
+
 # Pagination
 ITEMS_PER_PAGE = 12
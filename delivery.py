@@ -0,0 +1,135 @@
+"""
+File delivery with the byte transfer offloaded to the front-end server.
+
+When nginx proxies a request it announces offload support with the
+X-Sendfile-Type request header (see sample_nginx.conf). The application then
+only checks access and resolves the path, and answers with an
+X-Accel-Redirect header that nginx serves from an internal location.
+Internal locations come from ACCEL_REDIRECT_MAPPING and cover the upload
+and HLS directories only; request headers never choose the mapping.
+Without a proxy the file is returned through wsgi.file_wrapper, which
+gunicorn sends with sendfile(); live segments are served from the shared
+segment cache instead (see segment_cache.py).
+"""
+
+import os
+import logging
+import mimetypes
+from urllib.parse import quote
+from flask import request, current_app, send_file
+from config import DELIVERY_MODE, ACCEL_REDIRECT_MAPPING, HLS_SEGMENT_CACHE_ENABLED
+
+logger = logging.getLogger(__name__)
+
+def _sendfile_type():
+    """Offload header to use for this request, or None to send the file ourselves."""
+    if DELIVERY_MODE == 'direct':
+        return None
+    if DELIVERY_MODE == 'x-accel':
+        return 'X-Accel-Redirect'
+    if DELIVERY_MODE == 'x-sendfile':
+        return 'X-Sendfile'
+    # auto: trust the proxy to announce what it supports
+    sendfile_type = request.headers.get('X-Sendfile-Type')
+    if sendfile_type in ('X-Accel-Redirect', 'X-Sendfile'):
+        return sendfile_type
+    return None
+
+def _accel_uri(file_path):
+    """
+    Map an absolute path to the internal nginx URI that serves it.
+
+    Only the configured ACCEL_REDIRECT_MAPPING is used: a mapping sent by
+    the client would let it point nginx at any file. The path is
+    percent-encoded, as nginx decodes the URI of an X-Accel-Redirect.
+
+    Returns:
+        Internal URI, or None if the file is outside the mapped directories
+    """
+    for real, internal in ACCEL_REDIRECT_MAPPING:
+        real = real.rstrip('/') + '/'
+        if file_path.startswith(real):
+            return internal.rstrip('/') + '/' + quote(file_path[len(real):])
+    return None
+
+def send_media_file(file_path, mimetype=None, headers=None, max_age=None):
+    """
+    Respond with a file that the caller has already authorised and resolved.
+
+    Args:
+        file_path: Path of an existing file
+        mimetype: Content type, guessed from the file name when not given
+        headers: Extra response headers (CORS, caching)
+        max_age: Cache lifetime in seconds when no Cache-Control header is given
+
+    Returns:
+        Flask response
+    """
+    file_path = os.path.abspath(file_path)
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    sendfile_type = _sendfile_type()
+
+    accel_uri = _accel_uri(file_path) if sendfile_type == 'X-Accel-Redirect' else None
+    if sendfile_type == 'X-Accel-Redirect' and accel_uri is None:
+        sendfile_type = None  # No internal location serves this directory
+
+    if sendfile_type:
+        response = current_app.response_class(mimetype=mimetype)
+        if sendfile_type == 'X-Accel-Redirect':
+            response.headers['X-Accel-Redirect'] = accel_uri
+        else:
+            response.headers['X-Sendfile'] = file_path
+        if max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+    else:
+        # Range requests and conditional GETs are handled by send_file
+        response = send_file(file_path, mimetype=mimetype, conditional=True, max_age=max_age)
+
+    if headers:
+        response.headers.update(headers)
+    return response
+
+def send_segment(file_path, stream_key, mimetype=None, headers=None):
+    """
+    Respond with a live HLS segment.
+
+    Offloaded like any other file when the proxy supports it. Otherwise the
+    bytes come from the shared segment cache, so every worker after the first
+    serves the segment with a memory copy instead of reading the disk.
+
+    Args:
+        file_path: Path of an existing segment
+        stream_key: Stream the segment belongs to
+        mimetype: Content type, guessed from the file name when not given
+        headers: Extra response headers (CORS, caching)
+
+    Returns:
+        Flask response
+    """
+    # Range requests are left to send_file
+    if not HLS_SEGMENT_CACHE_ENABLED or _sendfile_type() or request.range:
+        return send_media_file(file_path, mimetype=mimetype, headers=headers)
+
+    from segment_cache import get_segment_cache
+    cache = get_segment_cache()
+    if cache is None:
+        return send_media_file(file_path, mimetype=mimetype, headers=headers)
+
+    file_path = os.path.abspath(file_path)
+    try:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+        data = cache.get(file_path, mtime_ns)
+        if data is None:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            cache.put(file_path, mtime_ns, data, stream_key)
+    except OSError as e:
+        logger.error(f"Error reading segment {file_path}: {str(e)}")
+        return send_media_file(file_path, mimetype=mimetype, headers=headers)
+
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    response = current_app.response_class(data, mimetype=mimetype)
+    if headers:
+        response.headers.update(headers)
+    return response
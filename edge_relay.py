@@ -0,0 +1,215 @@
+"""
+Edge relay for HLS files that live on a remote origin.
+
+An app node that does not receive the RTMP ingest itself relays HLS
+requests to HLS_ORIGIN_URL:
+
+- origin requests reuse pooled keep-alive connections instead of a new
+  TCP/TLS handshake per file;
+- responses are cached in HLS_EDGE_CACHE_FOLDER (shared by all workers),
+  playlists for HLS_EDGE_MANIFEST_TTL, segments for HLS_EDGE_SEGMENT_TTL,
+  and misses or origin errors for HLS_EDGE_NEGATIVE_TTL;
+- a flock() per cache entry makes concurrent misses single-flight: the
+  first request fetches while the others wait and then read its result.
+
+Cache entries are a JSON header line (status, content type, fetch time)
+followed by the body, replaced atomically.
+"""
+
+import os
+import time
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+import http.client
+import collections
+from urllib.parse import urlsplit, quote
+from config import (HLS_ORIGIN_URL, HLS_ORIGIN_TIMEOUT, HLS_ORIGIN_POOL_SIZE, HLS_EDGE_CACHE_FOLDER,
+                    HLS_EDGE_MANIFEST_TTL, HLS_EDGE_SEGMENT_TTL, HLS_EDGE_NEGATIVE_TTL)
+
+logger = logging.getLogger(__name__)
+
+EdgeResponse = collections.namedtuple('EdgeResponse', 'status content_type body')
+
+# Errors of a pooled connection the origin has closed in the meantime
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                            ConnectionResetError, BrokenPipeError)
+
+class OriginPool:
+    """Keep-alive HTTP(S) connections to one origin, reused across requests."""
+
+    def __init__(self, origin_url, size=HLS_ORIGIN_POOL_SIZE, timeout=HLS_ORIGIN_TIMEOUT):
+        parts = urlsplit(origin_url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def get(self, relative_path):
+        """
+        GET a file below the origin URL.
+
+        Returns:
+            Tuple of (status, content type, body)
+        """
+        path = f"{self.base_path}/{quote(relative_path)}"
+        for attempt in range(2):
+            with self._lock:
+                conn = self._idle.pop() if attempt == 0 and self._idle else None
+            reused = conn is not None
+            conn = conn or self._connect()
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+                body = response.read()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused:
+                    continue  # The origin closed an idle connection, retry on a new one
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    if len(self._idle) < self.size:
+                        self._idle.append(conn)
+                        conn = None
+                if conn:
+                    conn.close()
+            return response.status, response.getheader('Content-Type', 'application/octet-stream'), body
+
+class EdgeRelay:
+    """Cached, single-flight access to the HLS origin."""
+
+    def __init__(self, origin_url=HLS_ORIGIN_URL, cache_folder=HLS_EDGE_CACHE_FOLDER):
+        self.pool = OriginPool(origin_url)
+        self.cache_folder = cache_folder
+        self._last_cleanup = 0
+        os.makedirs(cache_folder, exist_ok=True)
+
+    @staticmethod
+    def _ttl(relative_path, status):
+        if status != 200:
+            return HLS_EDGE_NEGATIVE_TTL
+        if relative_path.endswith('.m3u8'):
+            return HLS_EDGE_MANIFEST_TTL
+        return HLS_EDGE_SEGMENT_TTL
+
+    def _read_cached(self, cache_path):
+        """Cached (header, body), or None."""
+        try:
+            with open(cache_path, 'rb') as f:
+                header = json.loads(f.readline())
+                return header, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def _write_cached(self, cache_path, header, body):
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(body)
+        os.replace(temp_path, cache_path)
+
+    def _fresh(self, relative_path, cached):
+        if cached is None:
+            return False
+        header = cached[0]
+        return time.time() - header['fetched_at'] < self._ttl(relative_path, header['status'])
+
+    def fetch(self, relative_path):
+        """
+        Fetch an HLS file (path relative to the HLS root) through the cache.
+
+        Returns:
+            EdgeResponse; status 502 when the origin could not be reached
+        """
+        key = hashlib.sha1(relative_path.encode('utf-8', errors='surrogateescape')).hexdigest()
+        cache_path = os.path.join(self.cache_folder, key)
+
+        cached = self._read_cached(cache_path)
+        if not self._fresh(relative_path, cached):
+            with open(f"{cache_path}.lock", 'wb') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another worker may have fetched it while we waited
+                cached = self._read_cached(cache_path)
+                if not self._fresh(relative_path, cached):
+                    cached = self._fetch_origin(relative_path, cache_path, cached)
+
+        self._maybe_cleanup()
+        header, body = cached
+        return EdgeResponse(header['status'], header['content_type'], body)
+
+    def _fetch_origin(self, relative_path, cache_path, stale):
+        try:
+            status, content_type, body = self.pool.get(relative_path)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning(f"Origin request for {relative_path} failed: {str(e)}")
+            if stale and stale[0]['status'] == 200 and not relative_path.endswith('.m3u8'):
+                return stale  # Segments never change, an old copy is still correct
+            status, content_type, body = 502, 'text/plain', b''
+
+        if status != 200:
+            body = b''
+        header = {'status': status, 'content_type': content_type, 'fetched_at': time.time()}
+        try:
+            self._write_cached(cache_path, header, body)
+        except OSError as e:
+            logger.error(f"Error caching {relative_path}: {str(e)}")
+        return header, body
+
+    def _maybe_cleanup(self):
+        """Remove expired entries, at most once a minute per process."""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+
+        max_age = max(HLS_EDGE_SEGMENT_TTL, HLS_EDGE_MANIFEST_TTL, HLS_EDGE_NEGATIVE_TTL) + 60
+        try:
+            entries = list(os.scandir(self.cache_folder))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+_relay = None
+_relay_pid = None
+_relay_lock = threading.Lock()
+
+def get_edge_relay():
+    """The edge relay of this process, or None when no origin is configured.
+
+    Created per process so pooled connections are never shared across fork.
+    """
+    global _relay, _relay_pid
+    if not HLS_ORIGIN_URL:
+        return None
+    if _relay_pid != os.getpid():
+        with _relay_lock:
+            if _relay_pid != os.getpid():
+                try:
+                    _relay = EdgeRelay()
+                except OSError as e:
+                    logger.error(f"Edge relay unavailable: {str(e)}")
+                    _relay = None
+                _relay_pid = os.getpid()
+    return _relay
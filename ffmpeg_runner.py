@@ -0,0 +1,265 @@
+import os
+import signal
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from config import FFMPEG_TIMEOUT, FFMPEG_TIMEOUT_PER_MEDIA_SECOND, FFPROBE_TIMEOUT, FFMPEG_MAX_OUTPUT_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Keys ffmpeg writes with -progress; a block ends with "progress=continue|end"
+PROGRESS_KEYS = {'frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms', 'out_time',
+                 'dup_frames', 'drop_frames', 'speed', 'progress'}
+
+# How often the watchdog checks for cancellation and output limits (seconds)
+WATCHDOG_INTERVAL = 0.5
+
+# Limits and callbacks that apply to every process started inside job_context()
+_job_context = contextvars.ContextVar('ffmpeg_job_context', default={})
+
+@contextmanager
+def job_context(**options):
+    """Apply runner options to every ffmpeg/ffprobe call made inside the block.
+
+    Accepts the keyword arguments of run_process (timeout, max_output_bytes,
+    on_progress, cancel_event) plus scheduler and lane for run_ffmpeg.
+    Nested blocks override the outer values.
+    """
+    token = _job_context.set(dict(_job_context.get(), **options))
+    try:
+        yield
+    finally:
+        _job_context.reset(token)
+
+def job_option(name, default=None):
+    """Value of an option set by the enclosing job_context()."""
+    return _job_context.get().get(name, default)
+
+class ProcessResult:
+    """Outcome of a process started by run_process.
+
+    Mirrors subprocess.CompletedProcess (returncode, stdout, stderr) but only
+    the tail of stderr is kept; stderr_line_count counts every log line.
+    """
+
+    def __init__(self, cmd, returncode, stdout, stderr_lines, timed_out=False, cancelled=False, limit_exceeded=False,
+                 stderr_line_count=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = '\n'.join(stderr_lines)
+        self.stderr_line_count = len(stderr_lines) if stderr_line_count is None else stderr_line_count
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.limit_exceeded = limit_exceeded
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not (self.timed_out or self.cancelled or self.limit_exceeded)
+
+    def __repr__(self):
+        return f'<ProcessResult {os.path.basename(self.cmd[0])} rc={self.returncode}>'
+
+def parse_progress(values):
+    """Turn one block of ffmpeg -progress output into a progress event.
+
+    Returns a dictionary with frame, fps, speed (x realtime), out_time
+    (seconds of output written), total_size (bytes) and done.
+    """
+    def number(key, cast=float):
+        value = values.get(key, '').rstrip('x').strip()
+        try:
+            return cast(value)
+        except ValueError:
+            return None
+
+    out_time_us = number('out_time_us', int)
+    if out_time_us is None:
+        out_time_us = number('out_time_ms', int)  # Despite the name, also microseconds
+
+    return {
+        'frame': number('frame', int),
+        'fps': number('fps'),
+        'speed': number('speed'),
+        'out_time': out_time_us / 1000000.0 if out_time_us is not None and out_time_us >= 0 else None,
+        'total_size': number('total_size', int),
+        'done': values.get('progress') == 'end'
+    }
+
+def _kill(proc):
+    """Kill a process and everything it started."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+async def run_process_async(cmd, timeout=None, max_output_bytes=None, on_progress=None, cancel_event=None,
+                            capture_stdout=True, stderr_lines=50):
+    """Run a command, streaming its stderr instead of buffering all of it.
+
+    Args:
+        cmd: Command and arguments
+        timeout: Wall-clock limit in seconds; the process is killed when it is reached
+        max_output_bytes: Kill the process once it has written more than this
+            (from ffmpeg's total_size progress value, or bytes read from stdout)
+        on_progress: Callable receiving progress events (see parse_progress)
+        cancel_event: threading.Event (or anything with is_set) that cancels the run
+        capture_stdout: Collect stdout and return it as bytes
+        stderr_lines: Number of trailing stderr lines to keep
+
+    Returns:
+        ProcessResult
+    """
+    # Own session and process group, so a kill also reaches helper processes. Unlike a
+    # preexec_fn this is safe while other threads start processes too.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+
+    tail = deque(maxlen=stderr_lines)
+    stdout = bytearray()
+    state = {'output_bytes': 0, 'reason': None, 'stderr_lines': 0}
+
+    def stop(reason):
+        if state['reason'] is None:
+            state['reason'] = reason
+            _kill(proc)
+
+    async def read_stderr():
+        block = {}
+        while True:
+            try:
+                line = await proc.stderr.readline()
+            except ValueError:
+                # A line longer than the stream limit; the process is not
+                # writing the log or progress output it was started for
+                stop('unreadable output')
+                break
+            if not line:
+                break
+            text = line.decode('utf-8', errors='replace').rstrip()
+            key, sep, value = text.partition('=')
+            if sep and key in PROGRESS_KEYS and ' ' not in key:
+                block[key] = value.strip()
+                if key == 'progress':
+                    event = parse_progress(block)
+                    block = {}
+                    if event['total_size']:
+                        state['output_bytes'] = max(state['output_bytes'], event['total_size'])
+                    if on_progress:
+                        try:
+                            on_progress(event)
+                        except Exception as e:
+                            logger.error(f"Progress callback failed: {str(e)}")
+            elif text:
+                tail.append(text)
+                state['stderr_lines'] += 1
+
+    async def read_stdout():
+        while True:
+            data = await proc.stdout.read(65536)
+            if not data:
+                break
+            stdout.extend(data)
+            state['output_bytes'] = max(state['output_bytes'], len(stdout))
+            if max_output_bytes and len(stdout) > max_output_bytes:
+                # Checked here rather than by the watchdog so the buffer stays bounded
+                stop('limit')
+                break
+
+    async def watchdog():
+        while proc.returncode is None:
+            if cancel_event is not None and cancel_event.is_set():
+                stop('cancelled')
+            elif max_output_bytes and state['output_bytes'] > max_output_bytes:
+                stop('limit')
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+
+    readers = [asyncio.ensure_future(read_stderr())]
+    if capture_stdout:
+        readers.append(asyncio.ensure_future(read_stdout()))
+    guard = asyncio.ensure_future(watchdog())
+
+    try:
+        await asyncio.wait_for(asyncio.gather(proc.wait(), *readers), timeout=timeout)
+    except asyncio.TimeoutError:
+        stop('timeout')
+        await proc.wait()
+    except asyncio.CancelledError:
+        stop('cancelled')
+        await proc.wait()
+        raise
+    finally:
+        guard.cancel()
+        for reader in readers:
+            reader.cancel()
+
+    reason = state['reason']
+    if reason:
+        logger.warning(f"{os.path.basename(cmd[0])} stopped ({reason}) after writing {state['output_bytes']} bytes")
+
+    return ProcessResult(cmd, proc.returncode, bytes(stdout), list(tail),
+                         timed_out=reason == 'timeout',
+                         cancelled=reason == 'cancelled',
+                         limit_exceeded=reason == 'limit',
+                         stderr_line_count=state['stderr_lines'])
+
+def run_process(cmd, **options):
+    """Synchronous wrapper around run_process_async.
+
+    Options not given explicitly are taken from the enclosing job_context().
+    """
+    options = dict(_job_context.get(), **options)
+    # Scheduling options are only used by run_ffmpeg
+    options.pop('scheduler', None)
+    options.pop('lane', None)
+    return asyncio.run(run_process_async(cmd, **options))
+
+def run_ffmpeg(cmd, **options):
+    """Run an ffmpeg command with machine-readable progress on stderr.
+
+    The default wall-clock and output-size limits come from FFMPEG_TIMEOUT and
+    FFMPEG_MAX_OUTPUT_BYTES unless a job_context() or the caller sets them.
+    When the context carries a scheduler (see transcode_scheduler), the
+    process waits for admission in its lane and runs with the granted
+    number of threads at the lane's CPU and I/O priority.
+    """
+    context = _job_context.get()
+    cmd = [cmd[0], '-nostats', '-progress', 'pipe:2'] + list(cmd[1:])
+    options.setdefault('timeout', context.get('timeout', FFMPEG_TIMEOUT))
+    options.setdefault('max_output_bytes', context.get('max_output_bytes', FFMPEG_MAX_OUTPUT_BYTES))
+
+    scheduler = options.pop('scheduler', context.get('scheduler'))
+    if scheduler is None:
+        return run_process(cmd, **options)
+
+    from transcode_scheduler import apply_lane
+
+    lane = options.pop('lane', context.get('lane'))
+    lane_config = scheduler.lanes[scheduler.lane_names[scheduler.lane_index(lane)]]
+    requested = int(cmd[cmd.index('-threads') + 1]) if '-threads' in cmd else None
+    cancel_event = options.get('cancel_event', context.get('cancel_event'))
+
+    with scheduler.admit(lane, requested, cancel_event=cancel_event) as threads:
+        if not threads:
+            return ProcessResult(cmd, None, b'', [], cancelled=True)
+        return run_process(apply_lane(cmd, lane_config, threads), **options)
+
+def encode_timeout(duration_seconds):
+    """Wall-clock limit for an encode of duration_seconds of media, so long sources are not cut off."""
+    return FFMPEG_TIMEOUT + (duration_seconds or 0) * FFMPEG_TIMEOUT_PER_MEDIA_SECOND
+
+def run_ffprobe_command(cmd, **options):
+    """Run an ffprobe command, capturing its stdout, with the FFPROBE_TIMEOUT limit."""
+    options.setdefault('timeout', FFPROBE_TIMEOUT)
+    options.setdefault('on_progress', None)
+    return run_process(cmd, **options)
@@ -1,20 +1,69 @@
 import os
-import subprocess
+import shutil
+import tempfile
 import json
 import logging
-from config import FFMPEG_PATH, FFPROBE_PATH, THUMBNAIL_POSITION, THUMBNAIL_FOLDER
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from ffmpeg_runner import run_ffmpeg, run_ffprobe_command, job_option, encode_timeout
+from config import (FFMPEG_PATH, FFPROBE_PATH, FFMPEG_TIMEOUT, THUMBNAIL_POSITION, THUMBNAIL_FOLDER,
+                    TRANSCODE_PARALLEL_PROCESSES, TRANSCODE_SEGMENT_SECONDS, TRANSCODE_PARALLEL_MIN_DURATION)
 
 logger = logging.getLogger(__name__)
 
-def get_media_info(file_path):
+# Codec properties every browser can play from an MP4 without re-encoding
+WEB_VIDEO_CODECS = {'h264'}
+WEB_VIDEO_PROFILES = {'constrained baseline', 'baseline', 'main', 'high'}
+WEB_PIXEL_FORMATS = {'yuv420p', 'yuvj420p'}
+WEB_AUDIO_CODECS = {'aac'}
+
+# Folder of the shared audio rendition of HLS ladders encoded in chunks
+HLS_AUDIO_RENDITION = 'audio'
+
+def is_faststart(file_path):
     """
-    Use ffprobe to get media file information.
+    Check whether an MP4/MOV file has its moov atom ahead of the media data.
     
-    Returns a dictionary with:
-    - duration: in seconds
-    - format: container format
-    - width and height: for video files
-    - bitrate: in kbps
+    Only the top-level box headers are read, so this is cheap even for large files.
+    
+    Returns:
+        True if moov comes before mdat, False if after, None if not an ISO BMFF file
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            offset = 0
+            while offset + 8 <= file_size:
+                f.seek(offset)
+                header = f.read(16)
+                if len(header) < 8:
+                    break
+                
+                size = int.from_bytes(header[0:4], 'big')
+                box_type = header[4:8]
+                if size == 1 and len(header) == 16:
+                    size = int.from_bytes(header[8:16], 'big')  # 64-bit box size
+                elif size == 0:
+                    size = file_size - offset  # Box extends to end of file
+                
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                if size < 8:
+                    break
+                offset += size
+    except OSError as e:
+        logger.error(f"Error reading boxes of {file_path}: {str(e)}")
+    
+    return None
+
+def run_ffprobe(file_path):
+    """
+    Run ffprobe on a file and return its full format/streams JSON.
+    
+    Returns:
+        Parsed ffprobe output as a dictionary, or None if failed
     """
     try:
         # Run ffprobe to get JSON output of media info
@@ -27,37 +76,101 @@ def get_media_info(file_path):
             file_path
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_ffprobe_command(cmd)
         
-        if result.returncode != 0:
+        if not result.ok:
             logger.error(f"Error running ffprobe: {result.stderr}")
             return None
         
-        info = json.loads(result.stdout)
+        return json.loads(result.stdout)
+    
+    except Exception as e:
+        logger.error(f"Error running ffprobe: {str(e)}")
+        return None
+
+def get_media_info(file_path, content_hash=None):
+    """
+    Get media file information, probing the file only once.
+    
+    The ffprobe output is cached (see media_analysis) by content hash, size
+    and modification time, so repeated calls for an unchanged file are served
+    without spawning ffprobe again.
+    
+    Args:
+        file_path: Path to the media file
+        content_hash: Optional SHA-256 of the file, used as the cache key
+    
+    Returns a dictionary with:
+    - duration: in whole seconds (duration_seconds keeps the fraction)
+    - start_time: timestamp of the start of the file in seconds (non-zero for MPEG-TS and edit lists)
+    - format: container format
+    - width and height: for video files
+    - bitrate: in kbps
+    - video_codec, video_profile, pix_fmt: for the first video stream
+    - audio_codec, audio_channels, sample_rate: for the first audio stream
+    - faststart: moov atom placement for MP4/MOV files (None for other containers)
+    """
+    from media_analysis import load_probe, store_probe
+    
+    try:
+        info = load_probe(file_path, content_hash)
+        
+        if info is None:
+            info = run_ffprobe(file_path)
+            if info is None:
+                return None
+            store_probe(file_path, info, content_hash)
         
         # Initialize response object
         media_info = {
             'duration': 0,
+            'duration_seconds': 0.0,
+            'start_time': 0.0,
             'format': '',
+            'format_names': [],
             'width': 0,
             'height': 0,
             'bitrate': 0,
-            'filesize': 0
+            'filesize': 0,
+            'has_audio': False,
+            'video_codec': None,
+            'video_profile': None,
+            'pix_fmt': None,
+            'audio_codec': None,
+            'audio_channels': 0,
+            'sample_rate': 0,
+            'faststart': None
         }
         
         # Extract format information
         if 'format' in info:
-            media_info['format'] = info['format'].get('format_name', '').split(',')[0]
-            media_info['duration'] = int(float(info['format'].get('duration', 0)))
+            media_info['format_names'] = info['format'].get('format_name', '').split(',')
+            media_info['format'] = media_info['format_names'][0]
+            media_info['duration_seconds'] = float(info['format'].get('duration', 0))
+            media_info['duration'] = int(media_info['duration_seconds'])
+            media_info['start_time'] = float(info['format'].get('start_time', 0) or 0)
             media_info['filesize'] = int(info['format'].get('size', 0))
             media_info['bitrate'] = int(info['format'].get('bit_rate', 0)) // 1000  # Convert to kbps
         
-        # Extract video stream information if available
+        # Extract the first video and audio stream; embedded cover art is not video
         for stream in info.get('streams', []):
-            if stream.get('codec_type') == 'video':
+            codec_type = stream.get('codec_type')
+            if codec_type == 'video' and not media_info['video_codec']:
+                if stream.get('disposition', {}).get('attached_pic'):
+                    continue
                 media_info['width'] = stream.get('width', 0)
                 media_info['height'] = stream.get('height', 0)
-                break
+                media_info['video_codec'] = stream.get('codec_name')
+                media_info['video_profile'] = stream.get('profile')
+                media_info['pix_fmt'] = stream.get('pix_fmt')
+            elif codec_type == 'audio' and not media_info['has_audio']:
+                media_info['has_audio'] = True
+                media_info['audio_codec'] = stream.get('codec_name')
+                media_info['audio_channels'] = stream.get('channels', 0)
+                media_info['sample_rate'] = int(stream.get('sample_rate', 0) or 0)
+        
+        if 'mp4' in media_info['format_names'] or 'mov' in media_info['format_names']:
+            media_info['faststart'] = is_faststart(file_path)
         
         return media_info
     
@@ -65,13 +178,213 @@ def get_media_info(file_path):
         logger.error(f"Error retrieving media info: {str(e)}")
         return None
 
-def generate_thumbnail(file_path, media_id):
+def analyze_compatibility(media_info, quality_preset="medium", max_height=None):
+    """
+    Decide how much work is needed to turn a source into a web-ready MP4.
+    
+    Args:
+        media_info: Result of get_media_info for the source
+        quality_preset: Quality preset the output should not exceed
+        max_height: Height limit of the output, overrides the preset's (for
+            HLS ladders this is the highest rung)
+    
+    Returns:
+        One of:
+        - 'remux': streams are web compatible, only the container/moov placement changes
+        - 'audio': video can be copied, audio must be re-encoded to AAC
+        - 'transcode': video must be re-encoded
+    """
+    from config import VIDEO_QUALITY_PRESETS
+    
+    quality = VIDEO_QUALITY_PRESETS.get(quality_preset, VIDEO_QUALITY_PRESETS['medium'])
+    audio_ok = not media_info.get('has_audio') or media_info.get('audio_codec') in WEB_AUDIO_CODECS
+    
+    # Audio-only sources
+    if not media_info.get('video_codec'):
+        return 'remux' if audio_ok else 'audio'
+    
+    video_ok = (
+        media_info.get('video_codec') in WEB_VIDEO_CODECS
+        and (media_info.get('video_profile') or '').lower() in WEB_VIDEO_PROFILES
+        and media_info.get('pix_fmt') in WEB_PIXEL_FORMATS
+        # Copying cannot scale down, so the source must fit within the preset
+        and media_info.get('height', 0) <= (max_height or int(quality['resolution'].split('x')[1]))
+    )
+    
+    if not video_ok:
+        return 'transcode'
+    return 'remux' if audio_ok else 'audio'
+
+def scan_integrity(file_path, media_info=None):
+    """
+    Classify a file before processing by demuxing every packet without decoding.
+    
+    The first video and audio streams are copied into the null muxer, so the
+    scan costs about one read of the file. The verdict names the pipeline
+    the file should go through:
+    - clean: no demux errors, regular processing
+    - recoverable: corrupt packets or truncated data, process with error recovery
+    - audio-only: clean file without a video stream
+    - unrecoverable: no readable streams, processing would only waste an encode
+    
+    Returns:
+        Tuple of (verdict, number of errors reported), verdict is None if the
+        scan was cancelled or timed out
+    """
+    media_info = media_info or get_media_info(file_path)
+    if not media_info or not (media_info.get('width') or media_info.get('has_audio')):
+        return 'unrecoverable', 0
+    
+    demuxed = {'out_time': None}
+    report_progress = job_option('on_progress')
+    
+    def track(event):
+        if event['out_time'] is not None:
+            demuxed['out_time'] = event['out_time']
+        if report_progress:
+            report_progress(event)
+    
+    cmd = [
+        FFMPEG_PATH,
+        '-v', 'error',
+        '-i', file_path,
+        '-map', '0:v:0?',
+        '-map', '0:a:0?',
+        '-c', 'copy',
+        '-f', 'null',
+        '-'
+    ]
+    
+    try:
+        result = run_ffmpeg(cmd, capture_stdout=False, on_progress=track)
+    except Exception as e:
+        logger.error(f"Exception scanning {file_path}: {str(e)}")
+        return None, 0
+    
+    if result.cancelled or result.timed_out:
+        return None, 0
+    
+    errors = result.stderr_line_count
+    if not result.ok and not demuxed['out_time']:
+        logger.warning(f"Integrity scan could not read {file_path}: {result.stderr}")
+        return 'unrecoverable', errors
+    
+    # Far fewer seconds demuxed than the container claims means the file was cut short
+    duration = media_info.get('duration_seconds', 0)
+    truncated = duration > 0 and (demuxed['out_time'] or 0) < duration * 0.9
+    
+    if errors or truncated or not result.ok:
+        logger.info(f"Integrity scan of {file_path}: {errors} errors, truncated={truncated}")
+        return 'recoverable', errors
+    
+    return ('clean' if media_info.get('width') else 'audio-only'), 0
+
+def score_frames(frames):
+    """
+    Score grayscale frames as thumbnail candidates.
+    
+    All frames are scored at once with NumPy: contrast (standard deviation),
+    sharpness (variance of a Laplacian) and exposure (distance of the mean
+    brightness from mid-grey). Near-black and near-white frames, such as fades
+    and blank title cards, are pushed to the bottom.
+    
+    Args:
+        frames: uint8 array of shape (count, height, width)
+    
+    Returns:
+        Array of scores, higher is better
+    """
+    import numpy as np
+    
+    pixels = frames.astype(np.float32) / 255.0
+    brightness = pixels.mean(axis=(1, 2))
+    contrast = pixels.std(axis=(1, 2))
+    
+    # 4-neighbour Laplacian over the interior of every frame
+    laplacian = (pixels[:, 1:-1, :-2] + pixels[:, 1:-1, 2:] + pixels[:, :-2, 1:-1] + pixels[:, 2:, 1:-1]
+                 - 4 * pixels[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+    
+    def normalize(values):
+        spread = values.max() - values.min()
+        return (values - values.min()) / spread if spread > 0 else np.zeros_like(values)
+    
+    exposure = 1.0 - np.abs(brightness - 0.5) * 2
+    scores = 0.4 * normalize(contrast) + 0.4 * normalize(sharpness) + 0.2 * exposure
+    
+    # Fades, black frames and blank cards
+    scores[(brightness < 0.08) | (brightness > 0.95) | (contrast < 0.03)] -= 1.0
+    return scores
+
+def pick_thumbnail_time(file_path, duration):
+    """
+    Choose the best thumbnail timestamp from a handful of sampled frames.
+    
+    One ffmpeg process decodes only keyframes, samples THUMBNAIL_CANDIDATES
+    small grayscale frames spread over the video and pipes them as raw bytes.
+    
+    Returns:
+        Timestamp in seconds, or None if sampling was not possible
+    """
+    from config import THUMBNAIL_CANDIDATES
+    
+    try:
+        import numpy as np
+    except ImportError:
+        logger.warning("NumPy is not installed, using the fixed thumbnail position")
+        return None
+    
+    if duration <= 0:
+        return None
+    
+    width, height = 160, 90
+    rate = THUMBNAIL_CANDIDATES / duration
+    cmd = [
+        FFMPEG_PATH,
+        '-v', 'error',
+        '-skip_frame', 'nokey',
+        '-i', file_path,
+        '-an',
+        '-vf', f"fps={rate:.6f},scale={width}:{height}",
+        '-frames:v', str(THUMBNAIL_CANDIDATES),
+        '-f', 'rawvideo',
+        '-pix_fmt', 'gray',
+        'pipe:1'
+    ]
+    
+    try:
+        result = run_ffmpeg(cmd)
+        
+        if not result.ok:
+            logger.error(f"Error sampling thumbnail frames: {result.stderr}")
+            return None
+        
+        frame_size = width * height
+        count = len(result.stdout) // frame_size
+        if count == 0:
+            return None
+        
+        frames = np.frombuffer(result.stdout[:count * frame_size], dtype=np.uint8).reshape(count, height, width)
+        best = int(np.argmax(score_frames(frames)))
+        
+        # The fps filter emits frame n at n / rate seconds
+        return min(best / rate, max(0.0, duration - 0.1))
+    
+    except Exception as e:
+        logger.error(f"Exception sampling thumbnail frames: {str(e)}")
+        return None
+
+def generate_thumbnail(file_path, media_id, media_info=None):
     """
     Generate a thumbnail from a video file using ffmpeg.
     
+    The frame is picked by pick_thumbnail_time; without NumPy it falls back to
+    THUMBNAIL_POSITION, clamped so short clips still get a thumbnail.
+    
     Args:
         file_path: Path to the video file
         media_id: ID of the media record to use for thumbnail naming
+        media_info: Optional result of get_media_info for the source
     
     Returns:
         Path to the generated thumbnail or None if failed
@@ -83,20 +396,28 @@ def generate_thumbnail(file_path, media_id):
         # Make sure the thumbnails directory exists
         os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
         
-        # Run ffmpeg to extract a frame at the specified position
+        media_info = media_info or get_media_info(file_path)
+        duration = media_info.get('duration_seconds', 0) if media_info else 0
+        
+        position = pick_thumbnail_time(file_path, duration)
+        if position is None:
+            position = min(THUMBNAIL_POSITION, duration / 2)
+        
+        # Seeking before the input jumps to the nearest keyframe instead of decoding up to it
         cmd = [
             FFMPEG_PATH,
+            '-y',
+            '-ss', f"{position:.3f}",
             '-i', file_path,
-            '-ss', str(THUMBNAIL_POSITION),
             '-vframes', '1',
             '-vf', 'scale=640:-1',
             '-q:v', '2',
             thumbnail_path
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_ffmpeg(cmd, capture_stdout=False)
         
-        if result.returncode != 0:
+        if not result.ok or not os.path.exists(thumbnail_path):
             logger.error(f"Error generating thumbnail: {result.stderr}")
             return None
         
@@ -106,14 +427,250 @@ def generate_thumbnail(file_path, media_id):
         logger.error(f"Exception generating thumbnail: {str(e)}")
         return None
 
-def transcode_media(file_path, output_path, quality_preset="medium"):
+def format_vtt_timestamp(seconds):
+    """Format seconds as a WebVTT timestamp (HH:MM:SS.mmm)."""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    secs, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{milliseconds:03d}"
+
+def generate_storyboard(file_path, output_dir, media_info=None):
+    """
+    Generate seek-preview sprite sheets and a WebVTT index for a video.
+    
+    Frames are sampled at a fixed interval and tiled into sheets by ffmpeg's
+    fps and tile filters, so the whole storyboard comes from one decode pass.
+    Each WebVTT cue points at its frame with a #xywh media fragment.
+    
+    Args:
+        file_path: Path to the video file
+        output_dir: Folder for the generated files, created if needed
+        media_info: Optional result of get_media_info for the source
+    
+    Returns:
+        Path to the generated WebVTT file or None if failed
+    """
+    from config import (STORYBOARD_INTERVAL, STORYBOARD_MAX_FRAMES, STORYBOARD_TILE_WIDTH, STORYBOARD_GRID,
+                        STORYBOARD_FORMAT)
+    
+    try:
+        media_info = media_info or get_media_info(file_path)
+        if not media_info or not media_info.get('width') or not media_info.get('duration'):
+            logger.error(f"Cannot build storyboard for {file_path}: no video duration")
+            return None
+        
+        duration = media_info['duration']
+        interval = max(STORYBOARD_INTERVAL, duration / STORYBOARD_MAX_FRAMES)
+        frame_count = max(1, int(-(-duration // interval)))
+        
+        columns, rows = STORYBOARD_GRID
+        tile_width = STORYBOARD_TILE_WIDTH
+        tile_height = int(round(tile_width * media_info['height'] / media_info['width'] / 2)) * 2
+        
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir, exist_ok=True)
+        
+        cmd = [
+            FFMPEG_PATH,
+            '-y',
+            '-i', file_path,
+            '-an',
+            '-vf', f"fps=1/{interval:.3f},scale={tile_width}:{tile_height},tile={columns}x{rows}",
+            '-q:v', '5',
+            os.path.join(output_dir, f"sprite_%03d.{STORYBOARD_FORMAT}")
+        ]
+        
+        result = run_ffmpeg(cmd, capture_stdout=False)
+        
+        if not result.ok:
+            logger.error(f"Error generating storyboard: {result.stderr}")
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return None
+        
+        # Sprite URLs are relative, so they resolve next to the VTT file
+        tiles_per_sheet = columns * rows
+        lines = ['WEBVTT', '']
+        for index in range(frame_count):
+            sheet, position = divmod(index, tiles_per_sheet)
+            x = (position % columns) * tile_width
+            y = (position // columns) * tile_height
+            start = index * interval
+            end = min((index + 1) * interval, duration)
+            lines.append(f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}")
+            lines.append(f"sprite_{sheet + 1:03d}.{STORYBOARD_FORMAT}#xywh={x},{y},{tile_width},{tile_height}")
+            lines.append('')
+        
+        vtt_path = os.path.join(output_dir, 'storyboard.vtt')
+        with open(vtt_path, 'w') as f:
+            f.write('\n'.join(lines))
+        
+        return vtt_path
+    
+    except Exception as e:
+        logger.error(f"Exception generating storyboard: {str(e)}")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return None
+
+def generate_waveform(file_path, output_dir, media_info=None):
+    """
+    Precompute the waveform of an audio file (see waveform.py).
+    
+    The audio is decoded once to mono 16-bit PCM in a temporary file, which
+    is memory-mapped so long recordings are reduced block by block.
+    
+    Args:
+        file_path: Path to the audio file
+        output_dir: Folder for the generated files, created if needed
+        media_info: Optional result of get_media_info for the source
+    
+    Returns:
+        Path to the generated waveform file or None if failed
+    """
+    from config import WAVEFORM_SAMPLE_RATE, WAVEFORM_BITS
+    from waveform import compute_levels, write_waveform
+    
+    try:
+        import numpy as np
+    except ImportError:
+        logger.warning("NumPy is not installed, skipping waveform generation")
+        return None
+    
+    pcm_path = None
+    
+    try:
+        media_info = media_info or get_media_info(file_path)
+        if not media_info or not media_info.get('has_audio'):
+            logger.error(f"Cannot build waveform for {file_path}: no audio stream")
+            return None
+        
+        os.makedirs(output_dir, exist_ok=True)
+        fd, pcm_path = tempfile.mkstemp(prefix='.pcm_', dir=output_dir)
+        os.close(fd)
+        
+        cmd = [
+            FFMPEG_PATH,
+            '-y',
+            '-v', 'error',
+            '-i', file_path,
+            '-vn',
+            '-map', '0:a:0',
+            '-ac', '1',
+            '-ar', str(WAVEFORM_SAMPLE_RATE),
+            '-f', 's16le',
+            pcm_path
+        ]
+        
+        result = run_ffmpeg(cmd, capture_stdout=False)
+        
+        if not result.ok:
+            logger.error(f"Error decoding audio for waveform: {result.stderr}")
+            return None
+        
+        if os.path.getsize(pcm_path) < 2:
+            logger.error(f"No audio samples decoded from {file_path}")
+            return None
+        
+        pcm = np.memmap(pcm_path, dtype='<i2', mode='r')
+        levels = compute_levels(pcm)
+        del pcm
+        
+        waveform_path = os.path.join(output_dir, 'waveform.dat')
+        tmp_path = waveform_path + '.tmp'
+        write_waveform(tmp_path, levels, WAVEFORM_SAMPLE_RATE, WAVEFORM_BITS)
+        os.replace(tmp_path, waveform_path)
+        
+        return waveform_path
+    
+    except Exception as e:
+        logger.error(f"Exception generating waveform: {str(e)}")
+        return None
+    
+    finally:
+        if pcm_path and os.path.exists(pcm_path):
+            os.remove(pcm_path)
+
+def video_encode_args(quality):
+    """ffmpeg output options for the standard H.264 encode of a quality preset."""
+    return [
+        '-c:v', 'libx264',  # Use H.264 for maximum compatibility
+        '-profile:v', 'main',  # Main profile for better compatibility
+        '-pix_fmt', 'yuv420p',  # Standard pixel format for compatibility
+        '-preset', 'medium',  # Balance between speed and quality
+        '-b:v', quality['bitrate'],
+        '-vf', f"scale={quality['resolution']}"
+    ]
+
+def audio_encode_args(quality):
+    """ffmpeg output options for the standard AAC encode of a quality preset."""
+    return [
+        '-c:a', 'aac',
+        '-b:a', quality['audio_bitrate'],
+        '-ar', '44100'  # Standard audio sample rate
+    ]
+
+def stream_copy_media(file_path, output_path, strategy, quality_preset="medium", audio_only=False):
+    """
+    Produce a web-ready MP4 without re-encoding the video.
+    
+    Args:
+        file_path: Path to the source media file
+        output_path: Path where the output file should be saved
+        strategy: 'remux' to copy every stream, 'audio' to copy video and re-encode audio
+        quality_preset: Quality preset used for the audio bitrate
+        audio_only: The source has no video stream
+    
+    Returns:
+        True if the stream copy succeeded, False otherwise
+    """
+    from config import VIDEO_QUALITY_PRESETS
+    
+    quality = VIDEO_QUALITY_PRESETS.get(quality_preset, VIDEO_QUALITY_PRESETS['medium'])
+    
+    cmd = [FFMPEG_PATH, '-y', '-i', file_path]
+    
+    if audio_only:
+        # Leave out embedded cover art, which is exposed as a video stream
+        cmd += ['-vn', '-map', '0:a:0']
+    else:
+        cmd += ['-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy']
+    
+    if strategy == 'audio':
+        cmd += ['-c:a', 'aac', '-b:a', quality['audio_bitrate'], '-ar', '44100']
+    else:
+        cmd += ['-c:a', 'copy']
+    
+    cmd += ['-movflags', '+faststart', output_path]
+    
+    try:
+        result = run_ffmpeg(cmd, capture_stdout=False)
+        
+        if not result.ok:
+            logger.warning(f"Stream copy ({strategy}) failed for {file_path}: {result.stderr}")
+            return False
+        
+        return True
+    
+    except Exception as e:
+        logger.error(f"Exception during stream copy: {str(e)}")
+        return False
+
+def transcode_media(file_path, output_path, quality_preset="medium", media_info=None, integrity=None):
     """
     Transcode a media file to a different format or quality.
     
+    The scan_integrity verdict picks a single pipeline up front: damaged
+    files go straight to the error recovery encode, unreadable ones are not
+    encoded at all. Sources that are already web compatible are remuxed (or
+    only have their audio re-encoded) instead of going through a full video
+    encode.
+    
     Args:
         file_path: Path to the source media file
         output_path: Path where the transcoded file should be saved
         quality_preset: Quality preset to use (low, medium, high)
+        media_info: Optional result of get_media_info for the source
+        integrity: Optional scan_integrity verdict, scanned when not given
     
     Returns:
         True if transcoding succeeded, False otherwise
@@ -124,12 +681,35 @@ def transcode_media(file_path, output_path, quality_preset="medium"):
         quality = VIDEO_QUALITY_PRESETS.get(quality_preset, VIDEO_QUALITY_PRESETS['medium'])
         
         # Get media info to determine if it's audio or video
-        media_info = get_media_info(file_path)
+        media_info = media_info or get_media_info(file_path)
+        
+        if integrity is None:
+            integrity = scan_integrity(file_path, media_info)[0]
+        
+        if integrity == 'unrecoverable':
+            logger.error(f"Not transcoding {file_path}: no readable streams")
+            return False
+        
+        if integrity == 'recoverable':
+            logger.info(f"Transcoding damaged file {file_path} with error recovery")
+            return transcode_with_error_recovery(file_path, output_path, quality_preset,
+                                                 audio_only=not media_info.get('width'))
+        
+        # Fast path: copy streams that browsers can already play
+        strategy = analyze_compatibility(media_info, quality_preset)
+        if strategy != 'transcode':
+            logger.info(f"Using stream copy ({strategy}) for {file_path}")
+            if stream_copy_media(file_path, output_path, strategy, quality_preset,
+                                 audio_only=not media_info.get('video_codec')):
+                return True
+            logger.warning(f"Stream copy failed for {file_path}, falling back to a full transcode")
         
-        if not media_info:
-            # Try with more aggressive error recovery options
-            logger.warning(f"Could not get media info for {file_path}, trying with error recovery")
-            return transcode_with_error_recovery(file_path, output_path, quality_preset)
+        # Long videos are split at keyframes and encoded in parallel
+        if (media_info.get('width', 0) > 0 and TRANSCODE_PARALLEL_PROCESSES > 1
+                and media_info.get('duration', 0) >= TRANSCODE_PARALLEL_MIN_DURATION):
+            if transcode_media_parallel(file_path, output_path, quality_preset, media_info):
+                return True
+            logger.warning(f"Parallel transcode failed for {file_path}, falling back to a single process")
         
         # For video files
         if media_info.get('width', 0) > 0:
@@ -137,16 +717,8 @@ def transcode_media(file_path, output_path, quality_preset="medium"):
                 FFMPEG_PATH,
                 '-y',  # Overwrite output file if it exists
                 '-err_detect', 'ignore_err',  # Ignore errors
-                '-i', file_path,
-                '-c:v', 'libx264',  # Use H.264 for maximum compatibility
-                '-profile:v', 'main',  # Main profile for better compatibility
-                '-pix_fmt', 'yuv420p',  # Standard pixel format for compatibility
-                '-preset', 'medium',  # Balance between speed and quality
-                '-b:v', quality['bitrate'],
-                '-vf', f"scale={quality['resolution']}",
-                '-c:a', 'aac',
-                '-b:a', quality['audio_bitrate'],
-                '-ar', '44100',  # Standard audio sample rate
+                '-i', file_path
+            ] + video_encode_args(quality) + audio_encode_args(quality) + [
                 '-movflags', '+faststart',  # Web optimization
                 output_path
             ]
@@ -156,19 +728,19 @@ def transcode_media(file_path, output_path, quality_preset="medium"):
                 FFMPEG_PATH,
                 '-y',  # Overwrite output file if it exists
                 '-err_detect', 'ignore_err',  # Ignore errors
-                '-i', file_path,
-                '-c:a', 'aac',
-                '-b:a', quality['audio_bitrate'],
-                '-ar', '44100',  # Standard audio sample rate
-                output_path
-            ]
+                '-i', file_path
+            ] + audio_encode_args(quality) + [output_path]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_ffmpeg(cmd, capture_stdout=False)
         
-        if result.returncode != 0:
+        if result.timed_out or result.cancelled or result.limit_exceeded:
+            # Another attempt would hit the same limit
+            return False
+        
+        if not result.ok:
+            # The scan found nothing for the recovery options to work around
             logger.error(f"Error transcoding media: {result.stderr}")
-            # Try with more aggressive error recovery options
-            return transcode_with_error_recovery(file_path, output_path, quality_preset)
+            return False
         
         return True
     
@@ -176,7 +748,171 @@ def transcode_media(file_path, output_path, quality_preset="medium"):
         logger.error(f"Exception during transcoding: {str(e)}")
         return False
 
-def transcode_with_error_recovery(file_path, output_path, quality_preset="medium"):
+def get_keyframe_times(file_path, start_time=0.0):
+    """
+    List the keyframe timestamps of the first video stream.
+    
+    Only packets are read (flags K), so the video is demuxed but not decoded.
+    Packet timestamps are absolute while an input -ss is counted from the
+    start of the file, so start_time (the format start time) is subtracted.
+    
+    Returns:
+        Sorted list of keyframe times in seconds from the start of the file, or None if failed
+    """
+    cmd = [
+        FFPROBE_PATH,
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        file_path
+    ]
+    
+    try:
+        # Long files list a packet per frame, so this gets the ffmpeg time limit
+        result = run_ffprobe_command(cmd, timeout=FFMPEG_TIMEOUT)
+        
+        if not result.ok:
+            logger.error(f"Error listing keyframes: {result.stderr}")
+            return None
+        
+        keyframes = []
+        for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+            parts = line.split(',')
+            if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ('', 'N/A'):
+                keyframes.append(float(parts[0]) - start_time)
+        
+        return sorted(keyframes)
+    
+    except Exception as e:
+        logger.error(f"Exception listing keyframes: {str(e)}")
+        return None
+
+def plan_segments(keyframes, duration, segment_seconds):
+    """
+    Group keyframes into segments of roughly segment_seconds each.
+    
+    Every segment after the first starts on a keyframe, so it can be cut
+    without re-encoding its neighbours. The first segment starts at 0 so
+    nothing before the first keyframe is lost and the video stays aligned
+    with the audio; the last segment runs to the end of the file (end=None).
+    
+    Returns:
+        List of (start, end) tuples in seconds
+    """
+    if not keyframes:
+        return []
+    
+    boundaries = [0.0]
+    for keyframe in keyframes:
+        if keyframe - boundaries[-1] >= segment_seconds and duration - keyframe >= segment_seconds / 2:
+            boundaries.append(keyframe)
+    
+    return [(start, boundaries[i + 1] if i + 1 < len(boundaries) else None)
+            for i, start in enumerate(boundaries)]
+
+def transcode_media_parallel(file_path, output_path, quality_preset="medium", media_info=None, processes=None):
+    """
+    Transcode a long video by encoding keyframe-aligned segments concurrently.
+    
+    Each segment is encoded by its own ffmpeg process with the same settings
+    as transcode_media, the audio is encoded once alongside them, and the
+    results are joined with the concat demuxer without re-encoding.
+    
+    Args:
+        file_path: Path to the source video file
+        output_path: Path where the transcoded MP4 should be saved
+        quality_preset: Quality preset to use (low, medium, high)
+        media_info: Optional result of get_media_info for the source
+        processes: Number of concurrent ffmpeg processes, defaults to TRANSCODE_PARALLEL_PROCESSES
+    
+    Returns:
+        True if transcoding succeeded, False otherwise
+    """
+    from config import VIDEO_QUALITY_PRESETS
+    
+    quality = VIDEO_QUALITY_PRESETS.get(quality_preset, VIDEO_QUALITY_PRESETS['medium'])
+    processes = processes or TRANSCODE_PARALLEL_PROCESSES
+    work_dir = None
+    
+    try:
+        media_info = media_info or get_media_info(file_path)
+        if not media_info or not media_info.get('width'):
+            return False
+        
+        keyframes = get_keyframe_times(file_path, media_info.get('start_time', 0.0))
+        segments = plan_segments(keyframes, media_info['duration'], TRANSCODE_SEGMENT_SECONDS)
+        if len(segments) < 2:
+            logger.info(f"Not enough keyframe segments in {file_path} for a parallel transcode")
+            return False
+        
+        # Work next to the output so the final file does not cross filesystems
+        work_dir = tempfile.mkdtemp(prefix='.transcode_', dir=os.path.dirname(os.path.abspath(output_path)))
+        
+        # Under the media workers' scheduler every encoder gets the threads its lane
+        # grants; otherwise split the cores between the concurrent encoders
+        threads = [] if job_option('scheduler') else ['-threads', str(max(1, (os.cpu_count() or 1) // processes))]
+        
+        jobs = []
+        for index, (start, end) in enumerate(segments):
+            segment_path = os.path.join(work_dir, f"segment_{index:05d}.mp4")
+            cmd = [FFMPEG_PATH, '-y', '-err_detect', 'ignore_err']
+            if start > 0:
+                cmd += ['-ss', f"{start:.6f}"]
+            cmd += ['-i', file_path]
+            if end is not None:
+                cmd += ['-t', f"{end - start:.6f}"]
+            cmd += ['-map', '0:v:0', '-an'] + threads + video_encode_args(quality) + [segment_path]
+            jobs.append((segment_path, cmd))
+        
+        audio_path = None
+        if media_info.get('has_audio'):
+            audio_path = os.path.join(work_dir, 'audio.m4a')
+            jobs.append((audio_path, [FFMPEG_PATH, '-y', '-err_detect', 'ignore_err', '-i', file_path,
+                                      '-map', '0:a:0', '-vn'] + audio_encode_args(quality) + [audio_path]))
+        
+        def run(cmd):
+            return run_ffmpeg(cmd, capture_stdout=False)
+        
+        # Every job is an ffmpeg process; the threads only wait on them. Each call
+        # runs in a copy of the caller's context so job limits apply to it too.
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, run, cmd) for path, cmd in jobs]
+            results = [future.result() for future in futures]
+        
+        for (path, cmd), result in zip(jobs, results):
+            if not result.ok:
+                logger.error(f"Error encoding {os.path.basename(path)}: {result.stderr}")
+                return False
+        
+        concat_list = os.path.join(work_dir, 'segments.txt')
+        with open(concat_list, 'w') as f:
+            for path, cmd in jobs[:len(segments)]:
+                f.write(f"file '{path}'\n")
+        
+        cmd = [FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', concat_list]
+        if audio_path:
+            cmd += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0']
+        cmd += ['-c', 'copy', '-movflags', '+faststart', output_path]
+        
+        result = run_ffmpeg(cmd, capture_stdout=False)
+        
+        if not result.ok:
+            logger.error(f"Error joining transcoded segments: {result.stderr}")
+            return False
+        
+        logger.info(f"Transcoded {file_path} in {len(segments)} segments across {processes} processes")
+        return True
+    
+    except Exception as e:
+        logger.error(f"Exception during parallel transcoding: {str(e)}")
+        return False
+    
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def transcode_with_error_recovery(file_path, output_path, quality_preset="medium", audio_only=None):
     """
     Attempt to transcode a problematic media file with more aggressive error recovery options.
     
@@ -184,6 +920,7 @@ def transcode_with_error_recovery(file_path, output_path, quality_preset="medium
         file_path: Path to the source media file
         output_path: Path where the transcoded file should be saved
         quality_preset: Quality preset to use (low, medium, high)
+        audio_only: Whether the file has no video, guessed from the extension when not given
     
     Returns:
         True if transcoding succeeded, False otherwise
@@ -198,7 +935,7 @@ def transcode_with_error_recovery(file_path, output_path, quality_preset="medium
         
         # Common video extensions
         video_exts = {'.mp4', '.avi', '.mkv', '.mov', '.webm', '.flv', '.wmv', '.m4v', '.mpg', '.mpeg', '.ts', '.mts'}
-        is_video = file_ext in video_exts
+        is_video = file_ext in video_exts if audio_only is None else not audio_only
         
         # Use more aggressive error recovery flags
         if is_video:
@@ -239,9 +976,9 @@ def transcode_with_error_recovery(file_path, output_path, quality_preset="medium
             ]
         
         logger.info(f"Attempting transcoding with error recovery for {file_path}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_ffmpeg(cmd, capture_stdout=False)
         
-        if result.returncode != 0:
+        if not result.ok:
             logger.error(f"Error during recovery transcoding: {result.stderr}")
             return False
         
@@ -250,3 +987,423 @@ def transcode_with_error_recovery(file_path, output_path, quality_preset="medium
     except Exception as e:
         logger.error(f"Exception during recovery transcoding: {str(e)}")
         return False
+
+def hls_ladder(media_info, presets=None):
+    """
+    Renditions of the HLS ladder for a source, lowest first.
+    
+    Renditions taller than the source are skipped since upscaling only wastes
+    bandwidth; the lowest one is always kept.
+    
+    Args:
+        media_info: Result of get_media_info for the source
+        presets: Optional list of preset names, defaults to every VIDEO_QUALITY_PRESETS entry
+    
+    Returns:
+        List of (preset name, quality preset) tuples
+    """
+    from config import VIDEO_QUALITY_PRESETS
+    
+    names = presets or list(VIDEO_QUALITY_PRESETS.keys())
+    ladder = sorted(
+        ((name, VIDEO_QUALITY_PRESETS[name]) for name in names if name in VIDEO_QUALITY_PRESETS),
+        key=lambda item: int(item[1]['resolution'].split('x')[1])
+    )
+    renditions = [item for item in ladder if int(item[1]['resolution'].split('x')[1]) <= media_info['height']]
+    return renditions or ladder[:1]
+
+def hls_copy_rendition(media_info, presets=None):
+    """
+    Rung of the HLS ladder that the source can fill without re-encoding.
+    
+    A web-compatible source (see analyze_compatibility) no taller than the
+    highest rung is stream copied as the lowest rung it fits in, as long as
+    its bitrate is within HLS_VOD_COPY_MAX_BITRATE_RATIO of that rung's. Its
+    segments are cut at the source's own keyframes.
+    
+    Args:
+        media_info: Result of get_media_info for the source
+        presets: Optional list of preset names, defaults to every VIDEO_QUALITY_PRESETS entry
+    
+    Returns:
+        Tuple of (preset name, quality preset, strategy) where strategy is
+        'remux' (copy the audio too) or 'audio' (encode the audio), or None
+    """
+    from config import VIDEO_QUALITY_PRESETS, HLS_VOD_COPY_MAX_BITRATE_RATIO
+    
+    names = presets or list(VIDEO_QUALITY_PRESETS.keys())
+    ladder = sorted(
+        ((name, VIDEO_QUALITY_PRESETS[name]) for name in names if name in VIDEO_QUALITY_PRESETS),
+        key=lambda item: int(item[1]['resolution'].split('x')[1])
+    )
+    if not ladder or not media_info.get('height'):
+        return None
+    
+    strategy = analyze_compatibility(media_info, max_height=int(ladder[-1][1]['resolution'].split('x')[1]))
+    if strategy == 'transcode':
+        return None
+    
+    name, quality = next(item for item in ladder if int(item[1]['resolution'].split('x')[1]) >= media_info['height'])
+    rung_bitrate = int(quality['bitrate'].rstrip('k'))
+    if media_info.get('bitrate') and media_info['bitrate'] > rung_bitrate * HLS_VOD_COPY_MAX_BITRATE_RATIO:
+        return None
+    return name, quality, strategy
+
+def _ladder_video_args(renditions, threads=None):
+    """
+    filter_complex graph and per-rendition encoder options of an HLS ladder.
+    
+    The source is decoded once and split into one scaled branch per rendition.
+    
+    Args:
+        renditions: Result of hls_ladder()
+        threads: Encoder threads for the whole ladder, split between the renditions
+    
+    Returns:
+        List of ffmpeg arguments, to follow the input
+    """
+    from config import HLS_VOD_SEGMENT_DURATION
+    
+    count = len(renditions)
+    if not count:
+        return []
+    filters = [f"[0:v]split={count}" + ''.join(f"[v{i}]" for i in range(count))]
+    for i, (name, quality) in enumerate(renditions):
+        height = int(quality['resolution'].split('x')[1])
+        filters.append(f"[v{i}]scale=-2:{height}[v{i}out]")
+    
+    # Options are per output stream, so a stream-copied rendition can follow these
+    args = ['-filter_complex', ';'.join(filters)]
+    for i, (name, quality) in enumerate(renditions):
+        args += [
+            '-map', f"[v{i}out]",
+            f"-c:v:{i}", 'libx264',
+            f"-profile:v:{i}", 'main',
+            f"-pix_fmt:v:{i}", 'yuv420p',
+            f"-preset:v:{i}", 'medium',
+            f"-b:v:{i}", quality['bitrate'],
+            f"-maxrate:v:{i}", quality['bitrate'],
+            f"-bufsize:v:{i}", f"{int(quality['bitrate'].rstrip('k')) * 2}k",
+            # Aligned keyframes let players switch renditions on any segment boundary
+            f"-force_key_frames:v:{i}", f"expr:gte(t,n_forced*{HLS_VOD_SEGMENT_DURATION})",
+            f"-sc_threshold:v:{i}", '0'
+        ]
+        if threads:
+            args += [f"-threads:v:{i}", str(max(1, threads // count))]
+    return args
+
+def _hls_output_args(segment_type='mpegts'):
+    """ffmpeg options of the HLS muxer shared by every VOD packaging command."""
+    from config import HLS_VOD_SEGMENT_DURATION
+    
+    return [
+        '-f', 'hls',
+        '-hls_time', str(HLS_VOD_SEGMENT_DURATION),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_type', segment_type
+    ]
+
+def package_hls_vod(file_path, output_dir, media_info=None, presets=None, integrity=None):
+    """
+    Package a video as an adaptive HLS ladder in a single decode pass.
+    
+    The source is decoded once and split into one scaled branch per quality
+    preset; every branch is encoded and segmented side by side and a master
+    playlist referencing all renditions is written. A web-compatible source
+    is stream copied as its own rung (see hls_copy_rendition). Long videos are encoded
+    in keyframe-aligned chunks by concurrent processes instead (see
+    package_hls_vod_parallel).
+    
+    Args:
+        file_path: Path to the source video file
+        output_dir: Directory for the master playlist and rendition folders
+        media_info: Optional result of get_media_info for the source
+        presets: Optional list of preset names, defaults to every VIDEO_QUALITY_PRESETS entry
+        integrity: Optional scan_integrity verdict; damaged sources are read with error recovery
+    
+    Returns:
+        Dictionary with the master playlist path and rendition names, or None if failed
+    
+    Raises:
+        TimeoutError: The encode ran longer than encode_timeout() allows for the source
+    """
+    from config import HLS_VOD_SEGMENT_TYPE
+    
+    try:
+        media_info = media_info or get_media_info(file_path)
+        if not media_info or not media_info.get('height'):
+            logger.error(f"Cannot package {file_path} as HLS: no video stream found")
+            return None
+        
+        renditions = hls_ladder(media_info, presets)
+        has_audio = media_info.get('has_audio', False)
+        
+        # A web-compatible source becomes its rung as is, only the rungs below it are encoded.
+        # Damaged files are always encoded.
+        copy = hls_copy_rendition(media_info, presets) if integrity != 'recoverable' else None
+        if copy:
+            renditions = [item for item in renditions
+                          if int(item[1]['resolution'].split('x')[1]) < media_info['height']]
+        
+        # Long videos are split at keyframes and the chunks encoded in parallel. Damaged
+        # files are not, seeking into them is unreliable.
+        if (HLS_VOD_SEGMENT_TYPE == 'mpegts' and integrity != 'recoverable' and TRANSCODE_PARALLEL_PROCESSES > 1
+                and renditions and media_info.get('duration', 0) >= TRANSCODE_PARALLEL_MIN_DURATION):
+            result = package_hls_vod_parallel(file_path, output_dir, renditions, media_info, copy=copy)
+            if result:
+                return result
+            logger.warning(f"Parallel HLS packaging failed for {file_path}, falling back to a single pass")
+            shutil.rmtree(output_dir, ignore_errors=True)
+        
+        for name, quality in renditions + ([copy[:2]] if copy else []):
+            os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+        
+        cmd = [FFMPEG_PATH, '-y', '-err_detect', 'ignore_err']
+        if integrity == 'recoverable':
+            cmd += ['-fflags', '+genpts+discardcorrupt']
+        cmd += ['-i', file_path] + _ladder_video_args(renditions)
+        if copy:
+            cmd += ['-map', '0:v:0', f"-c:v:{len(renditions)}", 'copy']
+        
+        stream_map = []
+        for i, (name, quality) in enumerate(renditions + ([copy[:2]] if copy else [])):
+            if has_audio:
+                cmd += ['-map', 'a:0']
+                if copy and i == len(renditions) and copy[2] == 'remux':
+                    cmd += [f"-c:a:{i}", 'copy']
+                else:
+                    cmd += [f"-c:a:{i}", 'aac', f"-b:a:{i}", quality['audio_bitrate'], f"-ar:a:{i}", '44100']
+                stream_map.append(f"v:{i},a:{i},name:{name}")
+            else:
+                stream_map.append(f"v:{i},name:{name}")
+        
+        cmd += _hls_output_args(HLS_VOD_SEGMENT_TYPE) + [
+            '-master_pl_name', 'master.m3u8',
+            '-var_stream_map', ' '.join(stream_map)
+        ]
+        
+        if HLS_VOD_SEGMENT_TYPE == 'fmp4':
+            cmd += ['-hls_fmp4_init_filename', 'init.mp4',
+                    '-hls_segment_filename', os.path.join(output_dir, '%v', 'segment_%04d.m4s')]
+        else:
+            cmd += ['-hls_segment_filename', os.path.join(output_dir, '%v', 'segment_%04d.ts')]
+        
+        cmd.append(os.path.join(output_dir, '%v', 'index.m3u8'))
+        
+        timeout = encode_timeout(media_info.get('duration_seconds'))
+        result = run_ffmpeg(cmd, capture_stdout=False, timeout=timeout)
+        
+        if result.timed_out:
+            raise TimeoutError(f"HLS packaging of {file_path} did not finish within {timeout:.0f} seconds")
+        if not result.ok:
+            logger.error(f"Error packaging HLS ladder: {result.stderr}")
+            return None
+        
+        if copy:
+            logger.info(f"Copied {file_path} into its HLS ladder as the {copy[0]} rendition ({copy[2]})")
+        return {
+            'master': os.path.join(output_dir, 'master.m3u8'),
+            'renditions': [name for name, quality in renditions] + ([copy[0]] if copy else []),
+            'segment_type': HLS_VOD_SEGMENT_TYPE
+        }
+    
+    except TimeoutError:
+        raise
+    except Exception as e:
+        logger.error(f"Exception packaging HLS ladder: {str(e)}")
+        return None
+
+def _write_media_playlist(path, segments):
+    """
+    Write a VOD media playlist.
+    
+    Args:
+        path: Playlist path; segment URIs are relative to its folder
+        segments: List of (segment file name, duration in seconds)
+    """
+    import math
+    
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(duration for name, duration in segments)))}",
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD'
+    ]
+    for name, duration in segments:
+        lines += [f"#EXTINF:{duration:.6f},", name]
+    lines.append('#EXT-X-ENDLIST')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def _playlist_bandwidth(folder, segments):
+    """Peak and average bits per second of a rendition's segments."""
+    peak = 0
+    total_bytes = 0
+    total_duration = 0.0
+    for name, duration in segments:
+        size = os.path.getsize(os.path.join(folder, name))
+        if duration:
+            peak = max(peak, size * 8 / duration)
+        total_bytes += size
+        total_duration += duration or 0
+    average = total_bytes * 8 / total_duration if total_duration else peak
+    return int(peak), int(average)
+
+def package_hls_vod_parallel(file_path, output_dir, renditions, media_info, copy=None, processes=None):
+    """
+    Package a long video as an HLS ladder by encoding keyframe-aligned chunks concurrently.
+    
+    Every chunk (see plan_segments) is decoded once and encoded into all video
+    renditions by its own ffmpeg process, with its timestamps offset to its
+    position in the source so the segments of consecutive chunks play as one
+    stream. The audio is encoded once, alongside the chunks, as an audio
+    rendition shared by every variant. The chunk playlists are then joined
+    into one media playlist per rendition and the master playlist is written.
+    A stream-copied top rendition is segmented by one more process.
+    Only MPEG-TS segments are produced; fMP4 would need an init segment per chunk.
+    
+    Args:
+        file_path: Path to the source video file
+        output_dir: Directory for the master playlist and rendition folders
+        renditions: Renditions to encode, from hls_ladder()
+        media_info: Result of get_media_info for the source
+        copy: Optional result of hls_copy_rendition(), copied on top of the encoded renditions
+        processes: Number of concurrent ffmpeg processes, defaults to TRANSCODE_PARALLEL_PROCESSES
+    
+    Returns:
+        Same as package_hls_vod, or None if failed
+    
+    Raises:
+        TimeoutError: One of the encodes ran longer than encode_timeout() allows
+    """
+    from live_archive import playlist_segments
+    
+    processes = processes or TRANSCODE_PARALLEL_PROCESSES
+    
+    keyframes = get_keyframe_times(file_path, media_info.get('start_time', 0.0))
+    chunks = plan_segments(keyframes, media_info['duration'], TRANSCODE_SEGMENT_SECONDS)
+    if len(chunks) < 2:
+        logger.info(f"Not enough keyframe segments in {file_path} for parallel HLS packaging")
+        return None
+    
+    for name, quality in renditions:
+        os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+    
+    # Under the media workers' scheduler every process gets the threads its lane
+    # grants; otherwise split the cores between the concurrent processes
+    threads = None if job_option('scheduler') else max(1, (os.cpu_count() or 1) // processes)
+    stream_map = ' '.join(f"v:{i},name:{name}" for i, (name, quality) in enumerate(renditions))
+    
+    jobs = []
+    for index, (start, end) in enumerate(chunks):
+        cmd = [FFMPEG_PATH, '-y', '-err_detect', 'ignore_err']
+        if start > 0:
+            cmd += ['-ss', f"{start:.6f}"]
+        cmd += ['-i', file_path]
+        if end is not None:
+            cmd += ['-t', f"{end - start:.6f}"]
+        cmd += _ladder_video_args(renditions, threads) + ['-an', '-output_ts_offset', f"{start:.6f}"]
+        cmd += _hls_output_args() + [
+            '-var_stream_map', stream_map,
+            '-hls_segment_filename', os.path.join(output_dir, '%v', f"chunk{index:04d}_%04d.ts"),
+            os.path.join(output_dir, '%v', f"chunk{index:04d}.m3u8")
+        ]
+        length = (end if end is not None else media_info['duration_seconds']) - start
+        jobs.append((cmd, encode_timeout(length)))
+    
+    if copy:
+        os.makedirs(os.path.join(output_dir, copy[0]), exist_ok=True)
+        cmd = [FFMPEG_PATH, '-y', '-i', file_path, '-map', '0:v:0', '-c:v', 'copy', '-an']
+        cmd += _hls_output_args() + [
+            '-hls_segment_filename', os.path.join(output_dir, copy[0], 'segment_%04d.ts'),
+            os.path.join(output_dir, copy[0], 'index.m3u8')
+        ]
+        jobs.append((cmd, encode_timeout(media_info.get('duration_seconds'))))
+    
+    audio_bitrate = None
+    if media_info.get('has_audio'):
+        # One audio track for every variant, at the bitrate of the top rendition
+        audio_bitrate = (copy or renditions[-1])[1]['audio_bitrate']
+        os.makedirs(os.path.join(output_dir, HLS_AUDIO_RENDITION), exist_ok=True)
+        cmd = [FFMPEG_PATH, '-y', '-err_detect', 'ignore_err', '-i', file_path,
+               '-map', '0:a:0', '-vn', '-c:a', 'aac', '-b:a', audio_bitrate, '-ar', '44100']
+        cmd += _hls_output_args() + [
+            '-hls_segment_filename', os.path.join(output_dir, HLS_AUDIO_RENDITION, 'segment_%04d.ts'),
+            os.path.join(output_dir, HLS_AUDIO_RENDITION, 'index.m3u8')
+        ]
+        jobs.append((cmd, encode_timeout(media_info.get('duration_seconds'))))
+    
+    def run(cmd, timeout):
+        return run_ffmpeg(cmd, capture_stdout=False, timeout=timeout)
+    
+    # Every job is an ffmpeg process; the threads only wait on them. Each call
+    # runs in a copy of the caller's context so job limits apply to it too.
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, cmd, timeout) for cmd, timeout in jobs]
+        results = [future.result() for future in futures]
+    
+    if any(result.timed_out for result in results):
+        raise TimeoutError(f"Parallel HLS packaging of {file_path} did not finish within its time limit")
+    for result in results:
+        if not result.ok:
+            logger.error(f"Error encoding HLS chunk of {file_path}: {result.stderr}")
+            return None
+    
+    audio_peak = audio_average = 0
+    if audio_bitrate:
+        audio_folder = os.path.join(output_dir, HLS_AUDIO_RENDITION)
+        audio_segments = [(os.path.basename(path), duration or 0.0)
+                          for path, duration in playlist_segments(os.path.join(audio_folder, 'index.m3u8'))]
+        audio_peak, audio_average = _playlist_bandwidth(audio_folder, audio_segments)
+    
+    master = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    if audio_bitrate:
+        master.append(f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",DEFAULT=YES,AUTOSELECT=YES,'
+                      f'URI="{HLS_AUDIO_RENDITION}/index.m3u8"')
+    
+    for name, quality in renditions:
+        folder = os.path.join(output_dir, name)
+        segments = []
+        for index in range(len(chunks)):
+            chunk_playlist = os.path.join(folder, f"chunk{index:04d}.m3u8")
+            chunk_segments = playlist_segments(chunk_playlist)
+            if not chunk_segments:
+                logger.error(f"Chunk {index} of {file_path} produced no {name} segments")
+                return None
+            segments += [(os.path.basename(path), duration or 0.0) for path, duration in chunk_segments]
+            os.remove(chunk_playlist)
+        _write_media_playlist(os.path.join(folder, 'index.m3u8'), segments)
+        
+        peak, average = _playlist_bandwidth(folder, segments)
+        height = int(quality['resolution'].split('x')[1])
+        width = int(round(media_info['width'] * height / media_info['height'] / 2)) * 2
+        attributes = (f"BANDWIDTH={peak + audio_peak},AVERAGE-BANDWIDTH={average + audio_average},"
+                      f"RESOLUTION={width}x{height}")
+        if audio_bitrate:
+            attributes += ',AUDIO="audio"'
+        master += [f"#EXT-X-STREAM-INF:{attributes}", f"{name}/index.m3u8"]
+    
+    if copy:
+        folder = os.path.join(output_dir, copy[0])
+        segments = [(os.path.basename(path), duration or 0.0)
+                    for path, duration in playlist_segments(os.path.join(folder, 'index.m3u8'))]
+        if not segments:
+            logger.error(f"Copying {file_path} into its HLS ladder produced no segments")
+            return None
+        peak, average = _playlist_bandwidth(folder, segments)
+        attributes = (f"BANDWIDTH={peak + audio_peak},AVERAGE-BANDWIDTH={average + audio_average},"
+                      f"RESOLUTION={media_info['width']}x{media_info['height']}")
+        if audio_bitrate:
+            attributes += ',AUDIO="audio"'
+        master += [f"#EXT-X-STREAM-INF:{attributes}", f"{copy[0]}/index.m3u8"]
+    
+    with open(os.path.join(output_dir, 'master.m3u8'), 'w') as f:
+        f.write('\n'.join(master) + '\n')
+    
+    logger.info(f"Packaged {file_path} as HLS in {len(chunks)} chunks across {processes} processes")
+    return {
+        'master': os.path.join(output_dir, 'master.m3u8'),
+        'renditions': [name for name, quality in renditions] + ([copy[0]] if copy else []),
+        'segment_type': 'mpegts'
+    }
@@ -0,0 +1,185 @@
+"""
+Minimal inotify directory watcher (Linux), using libc through ctypes.
+
+Used to keep in-memory indexes of HLS directories current without polling
+the filesystem. On platforms without inotify start() returns False and
+callers fall back to stat() calls.
+"""
+
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out: it fires on every write of a growing segment
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct('iIII')
+
+# Seconds between checks for roots that do not exist (yet) or were removed
+ROOT_RETRY_INTERVAL = 5
+
+class DirectoryWatcher:
+    """
+    Watch directory trees and report changes to a callback.
+
+    The callback is called from the watcher thread as callback(kind, path, is_dir)
+    with kind one of 'created', 'modified' (closed after writing) or 'deleted',
+    or as callback('overflow', None, False) when events were lost and the
+    caller should rescan.
+
+    Roots that do not exist are retried every ROOT_RETRY_INTERVAL seconds,
+    and a root that is removed is watched again once it is recreated; both
+    are reported as 'overflow' so callers rescan.
+
+    Args:
+        roots: Directories to watch
+        callback: Function receiving the events
+        depth: Levels of subdirectories to watch below each root
+    """
+
+    def __init__(self, roots, callback, depth=1):
+        self.roots = list(roots)
+        self.callback = callback
+        self.depth = depth
+        self._fd = None
+        self._libc = None
+        self._watches = {}  # watch descriptor -> (path, depth)
+        self._missing = set()  # roots without a watch
+        self._thread = None
+
+    def start(self):
+        """Start watching; returns False when inotify is not available."""
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify not available: {str(e)}")
+            return False
+
+        if fd < 0:
+            logger.warning(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+            return False
+
+        self._fd = fd
+        for root in self.roots:
+            if not self._add_tree(root, 0, announce=False):
+                self._missing.add(root)
+
+        self._thread = threading.Thread(target=self._run, name='fs-watch', daemon=True)
+        self._thread.start()
+        return True
+
+    def _add_watch(self, path, depth, quiet=False):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            if not quiet:
+                logger.warning(f"Cannot watch {path}: {os.strerror(ctypes.get_errno())}")
+            return False
+        self._watches[wd] = (path, depth)
+        return True
+
+    def _add_tree(self, path, depth, announce=True):
+        """Watch a directory and its subdirectories down to self.depth.
+
+        With announce, files already present are reported as created, since
+        they may have appeared before the watch was in place.
+
+        Returns:
+            False if the directory could not be watched
+        """
+        # A missing root is expected (retried later), not worth a warning
+        if not self._add_watch(path, depth, quiet=depth == 0 and not os.path.isdir(path)):
+            return False
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return True
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if announce:
+                self.callback('created', entry.path, is_dir)
+            if is_dir and depth < self.depth:
+                self._add_tree(entry.path, depth + 1, announce)
+        return True
+
+    def _retry_missing(self):
+        added = [root for root in sorted(self._missing) if self._add_tree(root, 0, announce=False)]
+        if added:
+            self._missing.difference_update(added)
+            logger.info(f"Watching {', '.join(added)}")
+            self.callback('overflow', None, False)
+
+    def _run(self):
+        while True:
+            try:
+                ready, _, _ = select.select([self._fd], [], [], ROOT_RETRY_INTERVAL if self._missing else None)
+                if not ready:
+                    self._retry_missing()
+                    continue
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                logger.error(f"Error reading inotify events: {str(e)}")
+                return
+
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+
+                try:
+                    self._dispatch(wd, mask, os.fsdecode(name))
+                except Exception as e:
+                    logger.error(f"Error handling inotify event: {str(e)}")
+
+    def _dispatch(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.callback('overflow', None, False)
+            return
+
+        if mask & IN_IGNORED:
+            watched = self._watches.pop(wd, None)
+            if watched and watched[1] == 0:
+                # The root itself was removed (or unmounted), watch it again once it is back
+                logger.warning(f"Watched directory {watched[0]} was removed")
+                self._missing.add(watched[0])
+                self.callback('overflow', None, False)
+                self._retry_missing()
+            return
+
+        watched = self._watches.get(wd)
+        if not watched or not name:
+            return
+
+        parent, depth = watched
+        path = os.path.join(parent, name)
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.callback('created', path, is_dir)
+            if is_dir and depth < self.depth:
+                self._add_tree(path, depth + 1)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.callback('deleted', path, is_dir)
+        elif mask & IN_CLOSE_WRITE:
+            self.callback('modified', path, is_dir)
@@ -18,6 +18,9 @@ timeout = 300  # 5 minutes for uploading large files
 # Set keepalive for worker processes
 keepalive = 5
 
+# Files the application does not hand to nginx go out through wsgi.file_wrapper with sendfile()
+sendfile = True
+
 # Logging configuration
 errorlog = "/var/log/streamlite/error.log"
 accesslog = "/var/log/streamlite/access.log"
@@ -0,0 +1,194 @@
+"""
+Resolution of live HLS files across the configured HLS roots.
+
+nginx-rtmp may write HLS output under any of HLS_ROOTS, either flat
+(<root>/<key>.m3u8, <root>/<key>-N.ts) or nested with hls_nested on
+(<root>/<key>/index.m3u8). Instead of checking every root on each request:
+
+- with inotify, an in-memory index of all files under the roots answers
+  lookups without any filesystem calls;
+- without it, the root each stream key lives under is learned on first
+  use and cached, so a lookup costs a single stat() until the file
+  disappears and the mapping is invalidated.
+
+Each process builds its own index on first use (after gunicorn forks).
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from config import HLS_ROOTS, HLS_NEGATIVE_CACHE_TTL
+from fs_watch import DirectoryWatcher
+
+logger = logging.getLogger(__name__)
+
+# Flat segment names are <key>-<sequence>.ts
+_SEGMENT_SUFFIX = re.compile(r'-\d+$')
+
+def stream_key_for(relative_path):
+    """Stream key an HLS file belongs to, for flat and nested layouts."""
+    if '/' in relative_path:
+        return relative_path.split('/', 1)[0]
+    base = os.path.splitext(relative_path)[0]
+    return _SEGMENT_SUFFIX.sub('', base)
+
+def playlist_names(stream_key):
+    """Relative playlist paths of a stream in the nested and flat layouts."""
+    return [f"{stream_key}/index.m3u8", f"{stream_key}.m3u8"]
+
+class HlsIndex:
+    """Maps relative HLS paths to the root directory that holds them."""
+
+    def __init__(self, roots=None):
+        # Roots are kept even if they do not exist yet: nginx may create them later
+        self.roots = []
+        for root in roots or HLS_ROOTS:
+            root = os.path.realpath(root)
+            if root not in self.roots:
+                self.roots.append(root)
+
+        self._lock = threading.Lock()
+        self._files = {}  # relative path -> root (inotify mode)
+        self._key_roots = {}  # stream key -> root (stat mode)
+        self._misses = {}  # relative path -> time of the last failed lookup (stat mode)
+        self._listeners = []
+        self.indexed = False
+
+    def available_roots(self):
+        """Roots that currently exist."""
+        return [root for root in self.roots if os.path.isdir(root)]
+
+    def start(self):
+        """Start the inotify index; without inotify lookups use the stat cache."""
+        if not self.available_roots():
+            logger.warning("None of the configured HLS roots exist yet")
+
+        watcher = DirectoryWatcher(self.roots, self._on_event, depth=1)
+        if watcher.start():
+            self._rescan()
+            self.indexed = True
+            logger.info(f"Indexing HLS files under {', '.join(self.roots)}")
+        else:
+            logger.info("Resolving HLS files with a cached root per stream key")
+
+    def add_listener(self, callback):
+        """
+        Also report index changes to callback(kind, relative_path, is_dir, root).
+
+        Called from the watcher thread, with kind as in DirectoryWatcher;
+        on 'overflow' the path and root are None and listeners should rescan.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, kind, relative, is_dir, root):
+        for callback in self._listeners:
+            try:
+                callback(kind, relative, is_dir, root)
+            except Exception as e:
+                logger.error(f"Error in HLS index listener: {str(e)}")
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                return root
+        return None
+
+    def _rescan(self):
+        files = {}
+        for root in reversed(self.roots):  # Earlier roots win, as in the old search order
+            for dirpath, dirnames, filenames in os.walk(root):
+                relative_dir = os.path.relpath(dirpath, root)
+                if relative_dir.count(os.sep) >= 1:
+                    dirnames[:] = []  # Nested layouts are one level deep
+                for filename in filenames:
+                    relative = filename if relative_dir == '.' else f"{relative_dir}/{filename}"
+                    files[relative] = root
+        with self._lock:
+            self._files = files
+
+    def _on_event(self, kind, path, is_dir):
+        if kind == 'overflow':
+            self._rescan()
+            self._notify(kind, None, False, None)
+            return
+
+        root = self._root_of(path)
+        if root is None:
+            return
+        relative = os.path.relpath(path, root).replace(os.sep, '/')
+
+        with self._lock:
+            if kind == 'deleted':
+                if is_dir:
+                    prefix = relative + '/'
+                    for name in [name for name in self._files if name.startswith(prefix)]:
+                        del self._files[name]
+                elif self._files.get(relative) == root:
+                    del self._files[relative]
+            elif not is_dir:
+                self._files.setdefault(relative, root)
+        self._notify(kind, relative, is_dir, root)
+
+    def resolve(self, filename):
+        """
+        Absolute path of an HLS file, or None if no root has it.
+
+        Paths that try to leave the roots are rejected.
+        """
+        relative = os.path.normpath(filename).replace(os.sep, '/')
+        if relative.startswith('../') or relative == '..' or os.path.isabs(relative):
+            return None
+
+        if self.indexed:
+            root = self._files.get(relative)
+            return os.path.join(root, relative) if root else None
+
+        key = stream_key_for(relative)
+        root = self._key_roots.get(key)
+        if root:
+            path = os.path.join(root, relative)
+            if os.path.isfile(path):
+                return path
+            # The stream moved or ended, learn its root again
+            self._key_roots.pop(key, None)
+
+        missed = self._misses.get(relative)
+        if missed and time.time() - missed < HLS_NEGATIVE_CACHE_TTL:
+            return None
+
+        for root in self.roots:
+            path = os.path.join(root, relative)
+            if os.path.isfile(path):
+                self._key_roots[key] = root
+                self._misses.pop(relative, None)
+                return path
+
+        if len(self._misses) > 10000:
+            self._misses.clear()
+        self._misses[relative] = time.time()
+        return None
+
+    def playlist_path(self, stream_key):
+        """Absolute path of a stream's playlist in either layout, or None."""
+        for name in playlist_names(stream_key):
+            path = self.resolve(name)
+            if path:
+                return path
+        return None
+
+_index = None
+_index_pid = None
+_index_lock = threading.Lock()
+
+def get_hls_index():
+    """The HLS index of this process, started on first use."""
+    global _index, _index_pid
+    if _index is None or _index_pid != os.getpid():
+        with _index_lock:
+            if _index is None or _index_pid != os.getpid():
+                index = HlsIndex()
+                index.start()
+                _index, _index_pid = index, os.getpid()
+    return _index
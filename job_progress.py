@@ -0,0 +1,161 @@
+"""
+Progress records for media processing jobs.
+
+Workers write one small JSON file per job type of a media item while its jobs
+run, so jobs of the same item running at the same time (storyboard, waveform,
+HLS ladder) each keep their own record:
+
+    <JOB_PROGRESS_FOLDER>/<media id>/<job type>.json
+
+The web processes only read those files. Watching progress therefore never
+touches the database, however many clients poll it.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+from config import JOB_PROGRESS_FOLDER, JOB_PROGRESS_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+def _media_folder(media_id):
+    return os.path.join(JOB_PROGRESS_FOLDER, str(int(media_id)))
+
+def write_progress(media_id, job_type, record):
+    """Atomically replace the progress record of one job type of a media item."""
+    folder = _media_folder(media_id)
+    path = os.path.join(folder, f"{job_type}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"Error writing {job_type} progress for media {media_id}: {str(e)}")
+
+def read_progress(media_ids):
+    """
+    Read the progress records of several media items.
+
+    Returns:
+        Tuple of (records keyed by media id, version string). The records of
+        a media item are keyed by job type and empty while its first job is
+        still waiting in the queue. The version changes whenever any of the
+        records changes and is used as an ETag.
+    """
+    records = {}
+    version = []
+    for media_id in media_ids:
+        jobs = {}
+        try:
+            entries = sorted(os.scandir(_media_folder(media_id)), key=lambda entry: entry.name)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue  # Record being replaced
+            try:
+                with open(entry.path) as f:
+                    stat = os.fstat(f.fileno())
+                    jobs[entry.name[:-len('.json')]] = json.load(f)
+            except (OSError, ValueError):
+                continue
+            version.append(f"{media_id}/{entry.name}:{stat.st_mtime_ns}")
+        if not jobs:
+            version.append(f"{media_id}:-")
+        records[media_id] = jobs
+    return records, ','.join(version)
+
+def delete_progress(media_id):
+    """Remove the progress records of a deleted media item."""
+    shutil.rmtree(_media_folder(media_id), ignore_errors=True)
+
+def cleanup_progress(max_age=86400):
+    """Delete progress records that have not changed for max_age seconds.
+
+    Returns:
+        Number of records removed
+    """
+    removed = 0
+    cutoff = time.time() - max_age
+    try:
+        folders = list(os.scandir(JOB_PROGRESS_FOLDER))
+    except OSError:
+        return 0
+    for folder in folders:
+        try:
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            os.rmdir(folder.path)  # Only succeeds once every record is gone
+        except OSError:
+            pass
+    return removed
+
+class ProgressTracker:
+    """
+    Turns ffmpeg progress events of one job into its progress record.
+
+    An instance is passed as on_progress to the ffmpeg runner. Handlers call
+    stage() before each ffmpeg step so percent and ETA refer to that step.
+    Records are written at most every JOB_PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, job):
+        self.media_id = job.media_id
+        self.job_type = job.job_type
+        self.record = {
+            'job_id': job.id,
+            'job_type': job.job_type,
+            'status': 'running',
+            'stage': 'starting',
+            'percent': 0,
+            'speed': None,
+            'fps': None,
+            'eta': None,
+            'started_at': time.time(),
+            'updated_at': None
+        }
+        self.duration = None
+        self.last_write = 0
+        self._write()
+
+    def stage(self, name, duration=None):
+        """Start a new step of the job; duration (seconds) enables percent and ETA."""
+        self.duration = duration
+        self.record.update(stage=name, percent=0, speed=None, fps=None, eta=None)
+        self._write()
+
+    def __call__(self, event):
+        record = self.record
+        record['speed'] = event['speed']
+        record['fps'] = event['fps']
+        out_time = event['out_time']
+        if self.duration and out_time is not None:
+            record['percent'] = round(min(100.0, out_time / self.duration * 100), 1)
+            if event['speed']:
+                record['eta'] = round(max(0.0, self.duration - out_time) / event['speed'])
+
+        if event['done'] or time.time() - self.last_write >= JOB_PROGRESS_INTERVAL:
+            self._write()
+
+    def finish(self, status, error=None):
+        """Record the final state of the job ('done' or 'failed')."""
+        self.record.update(status=status, eta=None)
+        if status == 'done':
+            self.record.update(stage='finished', percent=100)
+        if error:
+            self.record['error'] = str(error)[:200]
+        self._write()
+
+    def _write(self):
+        self.last_write = time.time()
+        self.record['updated_at'] = self.last_write
+        if self.media_id is not None:  # Jobs without a media item (live archives) have no record
+            write_progress(self.media_id, self.job_type, self.record)
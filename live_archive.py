@@ -0,0 +1,216 @@
+"""
+Live-to-VOD archiving of live streams.
+
+nginx-rtmp keeps only the last hls_playlist_length seconds of a stream and
+hls_cleanup removes older segments, so the media worker pool copies every
+segment out of the HLS roots while the stream is live. Each session of a
+stream gets a folder
+
+    <LIVE_ARCHIVE_FOLDER>/<stream id>-<started_at>/000001.ts ...
+    <LIVE_ARCHIVE_FOLDER>/<stream id>-<started_at>/segments.txt   concat list with durations
+    <LIVE_ARCHIVE_FOLDER>/<stream id>-<started_at>/sources        archived segment names
+
+Segments are hard linked when the HLS root is on the same filesystem and
+copied otherwise. Once the stream is no longer live an 'archive_live' job
+is queued, which joins the segments with the concat demuxer using stream
+copy only into a faststart MP4 and adds it as a private Media item of the
+stream's owner, who decides whether to publish it. Archiving is off unless
+LIVE_ARCHIVE_ENABLED is set; streams then opt out with
+stream_settings['archive'] = False.
+"""
+
+import os
+import time
+import shutil
+import logging
+import datetime
+from config import LIVE_ARCHIVE_FOLDER, FFMPEG_PATH
+
+logger = logging.getLogger(__name__)
+
+CONCAT_LIST = 'segments.txt'
+SOURCES_FILE = 'sources'
+QUEUED_MARKER = '.queued'
+
+def session_folder_name(stream):
+    """Archive folder name of a stream's current session."""
+    started = int(stream.started_at.replace(tzinfo=datetime.timezone.utc).timestamp()) if stream.started_at else 0
+    return f"{stream.id}-{started}"
+
+def playlist_segments(playlist_path):
+    """
+    Segments listed in a media playlist, oldest first.
+
+    Returns:
+        List of (absolute path, duration in seconds) tuples
+    """
+    try:
+        with open(playlist_path, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    base = os.path.dirname(playlist_path)
+    segments = []
+    duration = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            try:
+                duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+            except ValueError:
+                duration = None
+        elif line and not line.startswith('#'):
+            if '://' not in line:
+                segments.append((os.path.join(base, line.split('?', 1)[0]), duration))
+            duration = None
+    return segments
+
+class LiveArchiver:
+    """Copies the segments of live streams into archive folders and queues their remux."""
+
+    def __init__(self, archive_root=LIVE_ARCHIVE_FOLDER):
+        self.archive_root = archive_root
+        self._sessions = {}  # folder name -> {'stream_key', 'sources', 'count'}
+
+    def _session(self, name, stream_key):
+        session = self._sessions.get(name)
+        if session is None:
+            folder = os.path.join(self.archive_root, name)
+            os.makedirs(folder, exist_ok=True)
+            # Picked up again after a restart of the worker pool
+            try:
+                with open(os.path.join(folder, SOURCES_FILE)) as f:
+                    sources = set(f.read().splitlines())
+            except FileNotFoundError:
+                sources = set()
+            session = {'stream_key': stream_key, 'sources': sources, 'count': len(sources), 'copying': False}
+            self._sessions[name] = session
+        return session
+
+    def _archive_new_segments(self, name, session):
+        """Copy segments of the session's playlist that are not archived yet."""
+        from hls_index import get_hls_index
+
+        playlist = get_hls_index().playlist_path(session['stream_key'])
+        if not playlist:
+            return 0
+
+        folder = os.path.join(self.archive_root, name)
+        added = 0
+        for path, duration in playlist_segments(playlist):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # Already removed by hls_cleanup
+            # Names repeat when the sequence restarts, the mtime tells the segments apart
+            source = f"{os.path.basename(path)} {st.st_mtime_ns}"
+            if source in session['sources']:
+                continue
+
+            target_name = f"{session['count'] + 1:06d}.ts"
+            target = os.path.join(folder, target_name)
+            try:
+                os.link(path, target)
+            except FileExistsError:
+                os.remove(target)
+                os.link(path, target)
+            except OSError as e:
+                if not session['copying']:
+                    # Doubles the disk writes of the stream, worth knowing about
+                    logger.warning(f"Cannot hard link segments of {name} ({str(e)}), copying them instead; "
+                                   f"put LIVE_ARCHIVE_FOLDER on the filesystem of the HLS roots to avoid this")
+                    session['copying'] = True
+                try:
+                    shutil.copyfile(path, target)
+                except FileNotFoundError:
+                    continue
+
+            with open(os.path.join(folder, CONCAT_LIST), 'a') as f:
+                f.write(f"file '{target_name}'\n")
+                if duration:
+                    f.write(f"duration {duration:.3f}\n")
+            with open(os.path.join(folder, SOURCES_FILE), 'a') as f:
+                f.write(source + '\n')
+            session['sources'].add(source)
+            session['count'] += 1
+            added += 1
+        return added
+
+    def follow(self):
+        """
+        Archive new segments of live streams and queue sessions that ended.
+
+        Must be called within an application context.
+
+        Returns:
+            Number of segments archived
+        """
+        from app import db
+        from models import LiveStream
+        from media_queue import enqueue_job
+
+        live = {}
+        for stream in LiveStream.query.filter_by(is_live=True).all():
+            if (stream.stream_settings or {}).get('archive', True):
+                live[session_folder_name(stream)] = stream
+
+        added = 0
+        for name, stream in live.items():
+            added += self._archive_new_segments(name, self._session(name, stream.stream_key))
+
+        try:
+            folders = os.listdir(self.archive_root)
+        except FileNotFoundError:
+            folders = []
+        for name in folders:
+            folder = os.path.join(self.archive_root, name)
+            if name in live or os.path.exists(os.path.join(folder, QUEUED_MARKER)):
+                continue
+
+            session = self._sessions.pop(name, None)
+            if session:
+                # Segments written just before the stream was ended are still listed
+                added += self._archive_new_segments(name, session)
+
+            stream_id = int(name.split('-', 1)[0]) if name.split('-', 1)[0].isdigit() else None
+            stream = LiveStream.query.get(stream_id) if stream_id else None
+            if stream is None or not os.path.exists(os.path.join(folder, CONCAT_LIST)):
+                shutil.rmtree(folder, ignore_errors=True)  # Stream deleted, or nothing was recorded
+                continue
+
+            enqueue_job(None, 'archive_live', payload={'folder': name, 'live_stream_id': stream.id}, commit=False)
+            db.session.commit()
+            open(os.path.join(folder, QUEUED_MARKER), 'w').close()
+            logger.info(f"Queued archive of stream {stream.id} ({session['count'] if session else '?'} segments)")
+
+        return added
+
+def remux_archive(folder, output_path):
+    """
+    Join the segments of an archive folder into a faststart MP4.
+
+    Only stream copy is used, so the cost is reading and writing the file
+    once; the concat demuxer keeps timestamps continuous across segments
+    and encoder reconnects.
+
+    Returns:
+        True on success
+    """
+    from ffmpeg_runner import run_ffmpeg
+
+    cmd = [
+        FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', os.path.join(folder, CONCAT_LIST),
+        '-map', '0:v?', '-map', '0:a?',
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',  # ADTS AAC from MPEG-TS to MP4 framing
+        '-movflags', '+faststart',
+        output_path
+    ]
+    started = time.time()
+    result = run_ffmpeg(cmd, capture_stdout=False)
+    if not result.ok:
+        logger.error(f"Error remuxing live archive {folder}: {result.stderr}")
+        return False
+    logger.info(f"Remuxed live archive {folder} in {time.time() - started:.1f}s")
+    return True
@@ -0,0 +1,239 @@
+"""
+Time series of live stream metrics.
+
+The media worker pool samples every live stream each
+ANALYTICS_SAMPLE_INTERVAL seconds: concurrent viewers (from the heartbeat
+sessions), ingest bitrate (bytes of completed segments reported by the
+live state tracker) and chat messages. Samples go into a bounded in-memory
+ring per stream and every completed minute is rolled up into a
+StreamMetricRollup row; the hour row of that minute is rebuilt from its
+minute rows. Charts read rollups only, so a long stream is a few hundred
+rows rather than thousands of samples.
+"""
+
+import time
+import logging
+import datetime
+import collections
+from config import (ANALYTICS_SAMPLE_INTERVAL, ANALYTICS_RING_SIZE, ANALYTICS_MINUTE_RETENTION_DAYS,
+                    ANALYTICS_MINUTE_CHART_HOURS)
+
+logger = logging.getLogger(__name__)
+
+Sample = collections.namedtuple('Sample', 'time viewers bitrate_kbps chat')
+
+def _bucket(timestamp, seconds):
+    return int(timestamp // seconds) * seconds
+
+def _utc(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+class MetricSampler:
+    """Samples live streams into ring buffers and writes minute and hour rollups."""
+
+    def __init__(self, interval=ANALYTICS_SAMPLE_INTERVAL, ring_size=ANALYTICS_RING_SIZE):
+        self.interval = interval
+        self.ring_size = ring_size
+        self._rings = {}  # stream id -> deque of Sample
+        self._bytes = {}  # stream id -> (time, ingested bytes) at the previous sample
+        self._rolled = {}  # stream id -> start of the first minute not rolled up yet
+        self._last_sample = 0
+        self._last_chat_check = None
+        self._last_prune = 0
+
+    def tick(self):
+        """Sample and roll up when due; call often, within an application context."""
+        now = time.time()
+        if now - self._last_sample < self.interval:
+            return
+        self._last_sample = now
+
+        ended = self.sample(now)
+        self.roll_up(now, ended)
+
+        if now - self._last_prune > 3600:
+            self.prune(now)
+            self._last_prune = now
+
+    def sample(self, now):
+        """
+        Take one sample of every live stream.
+
+        Returns:
+            Set of stream ids that were sampled before but are no longer live
+        """
+        from sqlalchemy import func
+        from app import db
+        from models import LiveStream, ChatMessage
+        from live_state import get_live_state_tracker
+        from viewer_tracker import collect_viewers
+
+        since = self._last_chat_check or now - self.interval
+        chat_counts = dict(db.session.query(ChatMessage.live_stream_id, func.count(ChatMessage.id)).filter(
+            ChatMessage.created_at >= _utc(since),
+            ChatMessage.created_at < _utc(now),
+            ChatMessage.is_system_message == False
+        ).group_by(ChatMessage.live_stream_id).all())
+        self._last_chat_check = now
+
+        tracker = get_live_state_tracker()
+        live_ids = set()
+        for stream in LiveStream.query.filter_by(is_live=True).all():
+            live_ids.add(stream.id)
+            viewers, joins = collect_viewers(stream.id)
+
+            # Bytes are counted as segments complete, the minute average smooths the bursts
+            bitrate = None
+            ingested = tracker.state(stream.stream_key)['bytes']
+            if ingested is not None:
+                previous = self._bytes.get(stream.id)
+                if previous and ingested >= previous[1] and now > previous[0]:
+                    bitrate = (ingested - previous[1]) * 8 / (now - previous[0]) / 1000
+                self._bytes[stream.id] = (now, ingested)
+
+            ring = self._rings.setdefault(stream.id, collections.deque(maxlen=self.ring_size))
+            ring.append(Sample(now, viewers, bitrate, chat_counts.get(stream.id, 0)))
+
+        return set(self._rings) - live_ids
+
+    def roll_up(self, now, ended=()):
+        """Write rollups of completed minutes, and of all samples of ended streams."""
+        from app import db
+
+        current_minute = _bucket(now, 60)
+        hours = set()
+        for stream_id, ring in list(self._rings.items()):
+            final = stream_id in ended
+            first = self._rolled.get(stream_id, 0)
+            minutes = collections.defaultdict(list)
+            for sample in ring:
+                if sample.time >= first and (final or sample.time < current_minute):
+                    minutes[_bucket(sample.time, 60)].append(sample)
+
+            for start, samples in sorted(minutes.items()):
+                self._add_minute(stream_id, start, samples)
+                hours.add((stream_id, _bucket(start, 3600)))
+            if minutes:
+                self._rolled[stream_id] = max(minutes) + 60
+
+            if final:
+                for state in (self._rings, self._bytes, self._rolled):
+                    state.pop(stream_id, None)
+
+        for stream_id, hour in hours:
+            self._rebuild_hour(stream_id, hour)
+        if hours:
+            db.session.commit()
+
+    @staticmethod
+    def _add_minute(stream_id, start, samples):
+        """Add samples to a minute row, merging with a row written before a restart."""
+        from app import db
+        from models import StreamMetricRollup
+
+        row = StreamMetricRollup.query.filter_by(live_stream_id=stream_id, resolution='minute',
+                                                 bucket_start=_utc(start)).first()
+        if row is None:
+            row = StreamMetricRollup(live_stream_id=stream_id, resolution='minute', bucket_start=_utc(start),
+                                     samples=0, viewers_avg=0, viewers_max=0, chat_messages=0)
+            db.session.add(row)
+
+        bitrates = [sample.bitrate_kbps for sample in samples if sample.bitrate_kbps is not None]
+        if bitrates:
+            weight = row.samples if row.bitrate_kbps is not None else 0
+            row.bitrate_kbps = ((row.bitrate_kbps or 0) * weight + sum(bitrates)) / (weight + len(bitrates))
+        total = row.samples + len(samples)
+        row.viewers_avg = (row.viewers_avg * row.samples + sum(sample.viewers for sample in samples)) / total
+        row.viewers_max = max([row.viewers_max] + [sample.viewers for sample in samples])
+        row.chat_messages += sum(sample.chat for sample in samples)
+        row.samples = total
+
+    @staticmethod
+    def _rebuild_hour(stream_id, hour):
+        """Recompute an hour row from its minute rows."""
+        from app import db
+        from models import StreamMetricRollup
+
+        minutes = StreamMetricRollup.query.filter(
+            StreamMetricRollup.live_stream_id == stream_id,
+            StreamMetricRollup.resolution == 'minute',
+            StreamMetricRollup.bucket_start >= _utc(hour),
+            StreamMetricRollup.bucket_start < _utc(hour + 3600)
+        ).all()
+        if not minutes:
+            return
+
+        row = StreamMetricRollup.query.filter_by(live_stream_id=stream_id, resolution='hour',
+                                                 bucket_start=_utc(hour)).first()
+        if row is None:
+            row = StreamMetricRollup(live_stream_id=stream_id, resolution='hour', bucket_start=_utc(hour))
+            db.session.add(row)
+
+        samples = sum(minute.samples for minute in minutes)
+        with_bitrate = [minute for minute in minutes if minute.bitrate_kbps is not None]
+        row.samples = samples
+        row.viewers_avg = sum(minute.viewers_avg * minute.samples for minute in minutes) / max(1, samples)
+        row.viewers_max = max(minute.viewers_max for minute in minutes)
+        row.chat_messages = sum(minute.chat_messages for minute in minutes)
+        if with_bitrate:
+            weight = sum(minute.samples for minute in with_bitrate)
+            row.bitrate_kbps = sum(minute.bitrate_kbps * minute.samples for minute in with_bitrate) / max(1, weight)
+
+    @staticmethod
+    def prune(now):
+        """Delete minute rollups older than the retention period."""
+        from app import db
+        from models import StreamMetricRollup
+
+        cutoff = _utc(now - ANALYTICS_MINUTE_RETENTION_DAYS * 86400)
+        removed = StreamMetricRollup.query.filter(
+            StreamMetricRollup.resolution == 'minute',
+            StreamMetricRollup.bucket_start < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        if removed:
+            logger.info(f"Removed {removed} expired minute rollups")
+
+def load_series(stream):
+    """
+    Rollups of a stream's latest session, for charts.
+
+    Sessions longer than ANALYTICS_MINUTE_CHART_HOURS (or whose minute
+    rollups have expired) are returned at hour resolution.
+
+    Returns:
+        Dictionary with resolution and points (time, viewers_avg,
+        viewers_max, bitrate_kbps, chat_messages), or None without data
+    """
+    from models import StreamMetricRollup
+
+    if not stream.started_at:
+        return None
+    start = stream.started_at.replace(second=0, microsecond=0)
+    end = stream.ended_at if stream.ended_at and stream.ended_at > stream.started_at else datetime.datetime.utcnow()
+
+    retention_start = datetime.datetime.utcnow() - datetime.timedelta(days=ANALYTICS_MINUTE_RETENTION_DAYS)
+    long_session = end - start > datetime.timedelta(hours=ANALYTICS_MINUTE_CHART_HOURS)
+    resolution = 'hour' if long_session or start < retention_start else 'minute'
+    if resolution == 'hour':
+        start = start.replace(minute=0)
+
+    rows = StreamMetricRollup.query.filter(
+        StreamMetricRollup.live_stream_id == stream.id,
+        StreamMetricRollup.resolution == resolution,
+        StreamMetricRollup.bucket_start >= start,
+        StreamMetricRollup.bucket_start <= end
+    ).order_by(StreamMetricRollup.bucket_start).all()
+    if not rows:
+        return None
+
+    return {
+        'resolution': resolution,
+        'points': [{
+            'time': row.bucket_start.isoformat() + 'Z',
+            'viewers_avg': round(row.viewers_avg, 1),
+            'viewers_max': row.viewers_max,
+            'bitrate_kbps': round(row.bitrate_kbps) if row.bitrate_kbps is not None else None,
+            'chat_messages': row.chat_messages
+        } for row in rows]
+    }
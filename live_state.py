@@ -0,0 +1,315 @@
+"""
+In-memory state of live streams, derived from their HLS output.
+
+The tracker follows the HLS index: with inotify every playlist and segment
+write updates the state of its stream, so status checks are a dictionary
+lookup. Without inotify the state is read from the playlist's mtime (one
+stat() per check) since nginx-rtmp rewrites the playlist for every segment.
+
+Streams whose segments stop for LIVE_STALL_GRACE seconds are ended by
+expire_stalled_streams(), run periodically by the media worker pool.
+
+The pool also publishes a snapshot of the live streams on tmpfs
+(refresh_live_status()), including whether streams ingested on another node
+have a playlist at the origin, so status checks from viewer pages need
+neither the database nor an origin request.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from config import (LIVE_STALL_GRACE, LIVE_ABR_ENABLED, LIVE_ABR_FOLDER, LIVE_STATUS_PATH,
+                    LIVE_STATUS_REFRESH_INTERVAL)
+from hls_index import get_hls_index, stream_key_for
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_EXTENSIONS = ('.ts', '.m4s')
+
+class LiveStateTracker:
+    """Per stream key: manifest present, segment count, bytes written and time of the last segment."""
+
+    def __init__(self, index, ignored_roots=()):
+        self.index = index
+        # Roots holding derived output (the live ABR ladder), not the ingest
+        self.ignored_roots = {os.path.realpath(root) for root in ignored_roots}
+        self._lock = threading.Lock()
+        self._streams = {}
+        if index.indexed:
+            index.add_listener(self._on_event)
+            self._rescan()
+
+    @staticmethod
+    def _new_state():
+        return {'manifest': False, 'segments': 0, 'bytes': 0, 'last_segment_at': None}
+
+    def _rescan(self):
+        streams = {}
+        for root in self.index.roots:
+            if root in self.ignored_roots:
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                relative_dir = os.path.relpath(dirpath, root)
+                if relative_dir.count(os.sep) >= 1:
+                    dirnames[:] = []
+                for filename in filenames:
+                    relative = filename if relative_dir == '.' else f"{relative_dir}/{filename}"
+                    state = streams.setdefault(stream_key_for(relative), self._new_state())
+                    if filename.endswith('.m3u8'):
+                        state['manifest'] = True
+                    elif filename.endswith(SEGMENT_EXTENSIONS):
+                        state['segments'] += 1
+                        try:
+                            st = os.stat(os.path.join(dirpath, filename))
+                        except OSError:
+                            continue
+                        state['bytes'] += st.st_size
+                        state['last_segment_at'] = max(state['last_segment_at'] or 0, st.st_mtime)
+        with self._lock:
+            self._streams = streams
+
+    def _on_event(self, kind, relative, is_dir, root):
+        if kind == 'overflow':
+            self._rescan()
+            return
+        if root in self.ignored_roots:
+            return
+
+        key = stream_key_for(relative)
+        size = 0
+        if kind == 'modified' and relative.endswith(SEGMENT_EXTENSIONS):
+            # A segment is closed once it is complete, count its bytes as ingested
+            path = self.index.resolve(relative)
+            try:
+                size = os.path.getsize(path) if path else 0
+            except OSError:
+                pass
+
+        with self._lock:
+            if is_dir:
+                if kind == 'deleted' and '/' not in relative:
+                    self._streams.pop(key, None)  # Nested stream directory removed
+                return
+
+            state = self._streams.setdefault(key, self._new_state())
+            if relative.endswith('.m3u8'):
+                state['manifest'] = kind != 'deleted'
+            elif relative.endswith(SEGMENT_EXTENSIONS):
+                if kind == 'created':
+                    state['segments'] += 1
+                    state['last_segment_at'] = time.time()
+                elif kind == 'modified':
+                    state['last_segment_at'] = time.time()
+                    state['bytes'] += size
+                elif kind == 'deleted':
+                    state['segments'] = max(0, state['segments'] - 1)
+
+    def state(self, stream_key):
+        """
+        Current state of a stream.
+
+        Returns:
+            Dictionary with manifest (bool), segments (count), bytes (total
+            size of completed segments) and last_segment_at (timestamp or
+            None); segments and bytes are None without inotify
+        """
+        if self.index.indexed:
+            with self._lock:
+                return dict(self._streams.get(stream_key) or self._new_state())
+
+        playlist = self.index.playlist_path(stream_key)
+        if not playlist:
+            return self._new_state()
+        try:
+            last_write = os.path.getmtime(playlist)
+        except OSError:
+            return self._new_state()
+        return {'manifest': True, 'segments': None, 'bytes': None, 'last_segment_at': last_write}
+
+    def is_stalled(self, stream_key, started_at=None, grace=LIVE_STALL_GRACE):
+        """
+        Whether a stream has produced no segment for `grace` seconds.
+
+        Args:
+            stream_key: Stream to check
+            started_at: When the stream was started (UTC datetime), the grace
+                period also runs from there so a fresh stream is not ended
+                before the encoder connects
+            grace: Seconds without segments before a stream counts as stalled
+        """
+        state = self.state(stream_key)
+        last_activity = state['last_segment_at'] or 0
+        if started_at:
+            started = started_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+            last_activity = max(last_activity, started)
+        return time.time() - last_activity > grace
+
+_tracker = None
+_tracker_pid = None
+_tracker_lock = threading.Lock()
+
+def get_live_state_tracker():
+    """The live state tracker of this process, created on first use."""
+    global _tracker, _tracker_pid
+    if _tracker is None or _tracker_pid != os.getpid():
+        with _tracker_lock:
+            if _tracker is None or _tracker_pid != os.getpid():
+                ignored = [LIVE_ABR_FOLDER] if LIVE_ABR_ENABLED else []
+                _tracker, _tracker_pid = LiveStateTracker(get_hls_index(), ignored), os.getpid()
+    return _tracker
+
+def end_live_stream(stream, message="Stream has ended"):
+    """
+    Mark a live stream as ended and record its analytics.
+
+    The stream is claimed with a conditional UPDATE so it is ended once even
+    when the broadcaster, the owner and the stall check race each other.
+    Commits the session.
+
+    Returns:
+        True if this call ended the stream, False if it was not live
+    """
+    from app import db
+    from models import LiveStream, StreamAnalytics, ChatMessage
+    from viewer_tracker import reset_viewers, stream_sketch
+
+    ended_at = datetime.datetime.utcnow()
+    claimed = LiveStream.query.filter_by(id=stream.id, is_live=True).update(
+        {'is_live': False, 'ended_at': ended_at}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        return False
+    stream.is_live = False
+    stream.ended_at = ended_at
+
+    # Store analytics, from the viewer stats flushed while the stream was live
+    if stream.started_at:
+        stats = stream.stream_stats or {}
+        total_viewers = stats.get('total_viewers', stream.viewer_count)
+        sketch = stream_sketch(stream)
+
+        analytics = StreamAnalytics(
+            date=stream.ended_at.date(),
+            total_viewers=total_viewers,
+            peak_viewers=max(stats.get('peak_viewers', 0), stream.viewer_count),
+            average_watch_time=int(stats.get('watch_seconds', 0) / max(1, total_viewers)),
+            unique_viewers=sketch.count(),
+            # Kept so unique viewers can be counted across sessions and days
+            engagement_metrics={'viewer_sketch': sketch.to_json()},
+            live_stream_id=stream.id
+        )
+        db.session.add(analytics)
+
+    stream.viewer_count = 0
+    reset_viewers(stream.id)
+
+    # Create a system message in chat
+    system_message = ChatMessage(
+        message=message,
+        is_system_message=True,
+        user_id=stream.user_id,
+        live_stream_id=stream.id
+    )
+    db.session.add(system_message)
+    db.session.commit()
+    return True
+
+def expire_stalled_streams(grace=LIVE_STALL_GRACE):
+    """
+    End live streams whose HLS output stopped for longer than `grace` seconds.
+
+    Must be called within an application context.
+
+    Returns:
+        Number of streams ended
+    """
+    from models import LiveStream
+
+    tracker = get_live_state_tracker()
+    if not tracker.index.available_roots():
+        return 0  # No local HLS output (edge node), nothing to judge streams by
+    ended = 0
+    for stream in LiveStream.query.filter_by(is_live=True).all():
+        if (stream.stream_settings or {}).get('type') == 'webrtc':
+            continue  # WebRTC streams never write HLS
+        if tracker.is_stalled(stream.stream_key, stream.started_at, grace):
+            if end_live_stream(stream, message="Stream has ended (no video received)"):
+                logger.info(f"Ended stalled stream {stream.id} ({stream.stream_key})")
+                ended += 1
+    return ended
+
+def refresh_live_status(path=LIVE_STATUS_PATH):
+    """
+    Write the snapshot of live streams read by status checks.
+
+    Streams without a local playlist are looked up through the edge relay
+    here, in the background, rather than in the status request. The lookups
+    run concurrently and the pass waits for them at most one refresh
+    interval; a stream whose lookup is still pending keeps its value of the
+    previous snapshot. Must be called within an application context.
+
+    Returns:
+        Number of live streams in the snapshot
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from models import LiveStream
+    from edge_relay import get_edge_relay
+    from config import HLS_ORIGIN_POOL_SIZE
+
+    tracker = get_live_state_tracker()
+    relay = get_edge_relay()
+    streams = {}
+    lookups = {}
+    for stream in LiveStream.query.filter_by(is_live=True).all():
+        streams[str(stream.id)] = {'stream_key': stream.stream_key, 'origin_manifest': None}
+        if relay and not tracker.state(stream.stream_key)['manifest'] \
+                and (stream.stream_settings or {}).get('type') != 'webrtc':
+            lookups[str(stream.id)] = f"{stream.stream_key}.m3u8"
+
+    if lookups:
+        previous = read_live_status(path) or {}
+        executor = ThreadPoolExecutor(max_workers=HLS_ORIGIN_POOL_SIZE)
+        futures = {stream_id: executor.submit(relay.fetch, playlist) for stream_id, playlist in lookups.items()}
+        wait(futures.values(), timeout=LIVE_STATUS_REFRESH_INTERVAL)
+        # Lookups still running finish in the background and land in the relay cache
+        executor.shutdown(wait=False)
+        for stream_id, future in futures.items():
+            if future.done() and not future.exception():
+                streams[stream_id]['origin_manifest'] = future.result().status == 200
+            else:
+                streams[stream_id]['origin_manifest'] = previous.get(stream_id, {}).get('origin_manifest')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'updated_at': time.time(), 'streams': streams}, f)
+    os.replace(tmp_path, path)
+    return len(streams)
+
+_status = None
+_status_mtime = None
+
+def read_live_status(path=LIVE_STATUS_PATH):
+    """
+    Live streams of the latest snapshot, by stream id (as a string).
+
+    The file is parsed again only when it changed, so a check costs one
+    stat().
+
+    Returns:
+        Dictionary of stream_key and origin_manifest per live stream, or
+        None if the pool has not written a snapshot recently
+    """
+    global _status, _status_mtime
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime != _status_mtime:
+            with open(path) as f:
+                _status, _status_mtime = json.load(f), mtime
+    except (OSError, ValueError):
+        return None
+    if time.time() - _status.get('updated_at', 0) > 3 * LIVE_STATUS_REFRESH_INTERVAL:
+        return None
+    return _status.get('streams', {})
@@ -0,0 +1,324 @@
+"""
+Adaptive bitrate ladder for live streams.
+
+nginx-rtmp packages each publish into HLS at the broadcaster's bitrate. With
+LIVE_ABR_ENABLED the media worker pool also runs one ffmpeg per live stream
+that pulls the ingest back from the RTMP server and encodes every rendition
+of LIVE_ABR_LADDER in a single process (one decode, split and scaled per
+rendition), written as
+
+    <LIVE_ABR_FOLDER>/<key>/master.m3u8
+    <LIVE_ABR_FOLDER>/<key>/<rendition>.m3u8
+    <LIVE_ABR_FOLDER>/<key>/<rendition>_<sequence>.ts
+
+LIVE_ABR_FOLDER is one of the HLS roots, so the master playlist is served
+like any other HLS file. Keyframes are forced on segment boundaries so
+players can switch renditions at every segment.
+
+LiveTranscodeSupervisor.reconcile() runs every LIVE_ABR_CHECK_INTERVAL
+seconds: it starts an encoder for each live stream whose ingest is
+producing segments, restarts encoders that exited (with a backoff when
+they keep failing) and stops encoders of streams that were unpublished.
+"""
+
+import os
+import re
+import time
+import shutil
+import signal
+import logging
+import subprocess
+from config import (FFMPEG_PATH, LIVE_ABR_FOLDER, LIVE_ABR_INPUT_URL, LIVE_ABR_LADDER, LIVE_ABR_SEGMENT_DURATION,
+                    LIVE_ABR_LIST_SIZE)
+
+logger = logging.getLogger(__name__)
+
+MASTER_PLAYLIST = 'master.m3u8'
+LOG_FILE = 'ffmpeg.log'
+# An encoder that ran this long before exiting is restarted without backoff
+STABLE_RUN_SECONDS = 60
+# Scheduler lane of the encoders (see TRANSCODE_LANES)
+LIVE_LANE = 'live'
+
+def _height(resolution):
+    """Height of a resolution setting such as '720p' or '1280x720', or None."""
+    match = re.match(r'^(?:\d+x)?(\d+)p?$', str(resolution or '').strip().lower())
+    return int(match.group(1)) if match else None
+
+def renditions_for(stream):
+    """
+    Renditions to encode for a stream.
+
+    Uses stream_settings['renditions'] when the stream has its own ladder,
+    otherwise LIVE_ABR_LADDER. Renditions taller than the stream's
+    resolution setting are dropped since upscaling only wastes bandwidth;
+    the lowest rendition is always kept.
+
+    Returns:
+        List of rendition dictionaries (name, height, video_bitrate,
+        audio_bitrate), highest first
+    """
+    settings = stream.stream_settings or {}
+    ladder = settings.get('renditions') or LIVE_ABR_LADDER
+    ladder = sorted(ladder, key=lambda rendition: rendition['height'], reverse=True)
+
+    source_height = _height(settings.get('resolution'))
+    if source_height is None:
+        return ladder
+    renditions = [rendition for rendition in ladder if rendition['height'] <= source_height]
+    return renditions or ladder[-1:]
+
+def _bufsize(bitrate):
+    """Rate control buffer of two seconds' worth of a bitrate such as '2800k'."""
+    match = re.match(r'^(\d+(?:\.\d+)?)([kKmM]?)$', str(bitrate))
+    if not match:
+        return bitrate
+    return f"{float(match.group(1)) * 2:g}{match.group(2)}"
+
+def build_ladder_command(input_url, output_dir, renditions, has_audio=True, threads=None):
+    """
+    ffmpeg command encoding a live input into an HLS rendition ladder.
+
+    Args:
+        input_url: Live input, normally the stream on the local RTMP server
+        output_dir: Directory for the master playlist, variant playlists
+            and segments
+        renditions: Renditions as returned by renditions_for()
+        has_audio: Whether the input has an audio track; without one the
+            variants are video only
+        threads: Encoder threads granted for the whole ladder, split between
+            the renditions (ffmpeg's default when None)
+
+    Returns:
+        Command as a list of arguments
+    """
+    count = len(renditions)
+    split = f"[0:v]split={count}" + ''.join(f"[s{i}]" for i in range(count))
+    scales = [f"[s{i}]scale=-2:{rendition['height']}[v{i}]" for i, rendition in enumerate(renditions)]
+
+    cmd = [FFMPEG_PATH, '-nostdin', '-hide_banner', '-loglevel', 'warning']
+    if threads:
+        # Decoder threads count against the grant as well
+        cmd += ['-threads', str(threads)]
+    cmd += [
+        '-i', input_url,
+        '-filter_complex', ';'.join([split] + scales),
+    ]
+    for i in range(count):
+        cmd += ['-map', f"[v{i}]"]
+        if has_audio:
+            cmd += ['-map', '0:a:0?']
+
+    cmd += [
+        '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency', '-profile:v', 'main',
+        # Aligned keyframes in every rendition, so players can switch at any segment
+        '-force_key_frames', f"expr:gte(t,n_forced*{LIVE_ABR_SEGMENT_DURATION})", '-sc_threshold', '0',
+    ]
+    if has_audio:
+        cmd += ['-c:a', 'aac', '-ac', '2']
+    if threads:
+        # The grant covers the whole ladder: split it between the encoders below
+        cmd += ['-filter_complex_threads', '1']
+    for i, rendition in enumerate(renditions):
+        cmd += [
+            f"-b:v:{i}", rendition['video_bitrate'],
+            f"-maxrate:v:{i}", rendition['video_bitrate'],
+            f"-bufsize:v:{i}", _bufsize(rendition['video_bitrate']),
+        ]
+        if threads:
+            cmd += [f"-threads:v:{i}", str(max(1, threads // count))]
+        if has_audio:
+            cmd += [f"-b:a:{i}", rendition['audio_bitrate']]
+
+    cmd += [
+        '-f', 'hls',
+        '-hls_time', str(LIVE_ABR_SEGMENT_DURATION),
+        '-hls_list_size', str(LIVE_ABR_LIST_SIZE),
+        '-hls_flags', 'delete_segments+independent_segments+temp_file',
+        '-master_pl_name', MASTER_PLAYLIST,
+        '-var_stream_map', ' '.join(f"v:{i},{f'a:{i},' if has_audio else ''}name:{rendition['name']}"
+                                    for i, rendition in enumerate(renditions)),
+        '-hls_segment_filename', os.path.join(output_dir, '%v_%05d.ts'),
+        os.path.join(output_dir, '%v.m3u8'),
+    ]
+    return cmd
+
+def ingest_has_audio(stream_key):
+    """
+    Whether a stream's ingest has an audio track, probed from its newest
+    local HLS segment.
+
+    Returns:
+        False only when the probe found no audio; True when it found audio
+        or there was nothing to probe (the audio map is optional either way)
+    """
+    from hls_index import get_hls_index
+    from live_archive import playlist_segments
+    from ffmpeg_utils import run_ffprobe
+
+    playlist = get_hls_index().playlist_path(stream_key)
+    segments = playlist_segments(playlist) if playlist else []
+    if not segments:
+        return True
+    info = run_ffprobe(segments[-1][0])
+    if info is None:
+        return True
+    return any(stream.get('codec_type') == 'audio' for stream in info.get('streams', []))
+
+class LiveTranscodeSupervisor:
+    """
+    Runs, restarts and stops the ladder encoders of live streams.
+
+    With a scheduler every encoder holds threads of the shared CPU budget
+    (lane 'live') while it runs, so live encoders and media jobs together
+    stay within TRANSCODE_CPU_BUDGET.
+    """
+
+    def __init__(self, output_root=LIVE_ABR_FOLDER, scheduler=None):
+        self.output_root = output_root
+        self.scheduler = scheduler
+        # stream key -> {'process', 'started_at', 'failures', 'retry_at', 'log', 'threads', 'queued'}
+        self._encoders = {}
+
+    def _output_dir(self, stream_key):
+        return os.path.join(self.output_root, stream_key)
+
+    def _admit(self, encoder):
+        """Reserve encoder threads; False while the budget is used up."""
+        if self.scheduler is None:
+            return True
+        granted = self.scheduler.try_admit(LIVE_LANE, queued=encoder['queued'])
+        encoder['queued'] = not granted
+        encoder['threads'] = granted
+        return bool(granted)
+
+    def _release(self, encoder):
+        if self.scheduler is None:
+            return
+        if encoder['queued']:
+            self.scheduler.cancel_queued(LIVE_LANE)
+            encoder['queued'] = False
+        self.scheduler.release(LIVE_LANE, encoder['threads'])
+        encoder['threads'] = 0
+
+    def _start(self, stream, encoder):
+        output_dir = self._output_dir(stream.stream_key)
+        # Leftovers of a previous run would be listed in the new playlists
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir, exist_ok=True)
+
+        renditions = renditions_for(stream)
+        has_audio = ingest_has_audio(stream.stream_key)
+        cmd = build_ladder_command(LIVE_ABR_INPUT_URL.format(stream_key=stream.stream_key), output_dir, renditions,
+                                   has_audio=has_audio, threads=encoder['threads'] or None)
+        log = open(os.path.join(output_dir, LOG_FILE), 'ab')
+        try:
+            # Own process group, so stopping it also stops anything ffmpeg started
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log,
+                                       start_new_session=True)
+        except OSError:
+            log.close()
+            raise
+
+        encoder.update(process=process, started_at=time.time(), retry_at=None, log=log)
+        logger.info(f"Started ABR encoder for stream {stream.id} "
+                    f"({', '.join(rendition['name'] for rendition in renditions)}"
+                    f"{'' if has_audio else ', no audio'}, {encoder['threads'] or 'unlimited'} threads)")
+
+    def _backoff(self, encoder, now):
+        """Schedule the next start, backing off while the encoder keeps failing."""
+        if encoder['started_at'] and now - encoder['started_at'] > STABLE_RUN_SECONDS:
+            encoder['failures'] = 0
+        encoder['failures'] += 1
+        delay = min(60, 2 ** encoder['failures'])
+        encoder['retry_at'] = now + delay
+        return delay
+
+    def _stop(self, stream_key):
+        encoder = self._encoders.pop(stream_key, None)
+        if encoder is None:
+            return
+        process = encoder['process']
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(timeout=5)
+            except (ProcessLookupError, PermissionError):
+                pass
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    process.kill()
+                process.wait()
+        if encoder['log']:
+            encoder['log'].close()
+        self._release(encoder)
+        shutil.rmtree(self._output_dir(stream_key), ignore_errors=True)
+        logger.info(f"Stopped ABR encoder for stream {stream_key}")
+
+    def wanted_streams(self):
+        """Live streams whose ingest is producing segments, by stream key."""
+        from models import LiveStream
+        from live_state import get_live_state_tracker
+
+        tracker = get_live_state_tracker()
+        wanted = {}
+        for stream in LiveStream.query.filter_by(is_live=True).all():
+            if tracker.state(stream.stream_key)['manifest'] and not tracker.is_stalled(stream.stream_key):
+                wanted[stream.stream_key] = stream
+        return wanted
+
+    def reconcile(self):
+        """
+        Start, restart and stop encoders to match the live streams.
+
+        Must be called within an application context.
+
+        Returns:
+            Number of encoders running
+        """
+        wanted = self.wanted_streams()
+
+        for stream_key in list(self._encoders):
+            if stream_key not in wanted:
+                self._stop(stream_key)
+
+        now = time.time()
+        for stream_key, stream in wanted.items():
+            encoder = self._encoders.setdefault(stream_key, {
+                'process': None, 'started_at': None, 'failures': 0, 'retry_at': None, 'log': None,
+                'threads': 0, 'queued': False
+            })
+
+            process = encoder['process']
+            if process is not None:
+                if process.poll() is None:
+                    continue
+                # Exited while the ingest is still live: hand its threads back and retry later
+                encoder['process'] = None
+                encoder['log'].close()
+                encoder['log'] = None
+                self._release(encoder)
+                delay = self._backoff(encoder, now)
+                logger.warning(f"ABR encoder for stream {stream.id} exited with code {process.returncode}, "
+                               f"restarting in {delay}s")
+
+            if encoder['retry_at'] and now < encoder['retry_at']:
+                continue
+            if not self._admit(encoder):
+                continue  # Queued in the live lane until threads are free
+            try:
+                self._start(stream, encoder)
+            except OSError as e:
+                self._release(encoder)
+                delay = self._backoff(encoder, now)
+                logger.error(f"Error starting ABR encoder for stream {stream.id}, retrying in {delay}s: {str(e)}")
+
+        return sum(1 for encoder in self._encoders.values()
+                   if encoder['process'] is not None and encoder['process'].poll() is None)
+
+    def stop_all(self):
+        """Stop every encoder, on shutdown."""
+        for stream_key in list(self._encoders):
+            self._stop(stream_key)
@@ -0,0 +1,367 @@
+"""
+Low-latency HLS (LL-HLS) playlist server.
+
+Runs beside the Flask application (see llhls.service) and serves the same
+HLS roots under /live/llhls/. It is an asyncio (aiohttp) server, so a
+playlist request parked until new media exists costs a coroutine, not a
+gunicorn worker:
+
+- Blocking playlist reload: a playlist request with _HLS_msn (and
+  optionally _HLS_part) is held until the playlist contains that media
+  segment or partial segment, up to three target durations (then 503).
+- Preload hints: a request for a segment or part that does not exist yet is
+  held until the packager writes it, as players request the
+  EXT-X-PRELOAD-HINT resource ahead of time.
+
+Changes are picked up from the inotify HLS index (or by polling mtimes of
+the watched playlists without inotify) and wake all requests waiting on
+that file at once.
+
+Partial segments and preload hints are served when the packager writes
+them (EXT-X-PART / EXT-X-PRELOAD-HINT in the playlist); nginx-rtmp output
+has whole segments only, and blocking reload then works per segment.
+Live media playlists are served with the EXT-X-SERVER-CONTROL tag players
+need to use blocking reload, and with PART-INF / PRELOAD-HINT when the
+packager lists parts but leaves those out.
+"""
+
+import os
+import re
+import sys
+import asyncio
+import logging
+import contextlib
+from aiohttp import web
+from config import LLHLS_HOST, LLHLS_PORT, LLHLS_HOLD_TIMEOUT, LLHLS_POLL_INTERVAL
+from hls_index import HlsIndex, stream_key_for
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.aac': 'audio/aac',
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept',
+}
+
+def playlist_position(text):
+    """
+    Position of a live media playlist.
+
+    Parts listed after the last EXTINF belong to the segment in progress.
+
+    Returns:
+        Dictionary with last_msn (last complete segment, -1 if none),
+        parts (parts of the segment in progress), target_duration and ended
+    """
+    media_sequence = 0
+    segments = 0
+    parts = 0
+    target_duration = None
+    ended = False
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            segments += 1
+            parts = 0
+        elif line.startswith('#EXT-X-PART:'):
+            parts += 1
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+    return {
+        'last_msn': media_sequence + segments - 1,
+        'parts': parts,
+        'target_duration': target_duration,
+        'ended': ended
+    }
+
+def request_satisfied(position, msn, part):
+    """Whether a playlist already contains segment `msn` (or part `part` of it)."""
+    if position['ended'] or position['last_msn'] >= msn:
+        return True
+    return part is not None and msn == position['last_msn'] + 1 and position['parts'] > part
+
+def _next_part_uri(uri, new_segment):
+    """
+    Guess the URI of the part after `uri` from the numbers in its name.
+
+    The last number is the part; when the next part starts a new segment and
+    the name also numbers segments (e.g. seg12.part3.m4s), the segment number
+    is incremented and the part restarts at 0. Zero padding is kept.
+    """
+    head, name = uri.rsplit('/', 1) if '/' in uri else ('', uri)
+    name, extension = os.path.splitext(name)
+    numbers = list(re.finditer(r'\d+', name))
+    if not numbers:
+        return None
+    if new_segment and len(numbers) >= 2:
+        changes = {len(numbers) - 2: int(numbers[-2].group()) + 1, len(numbers) - 1: 0}
+    else:
+        changes = {len(numbers) - 1: int(numbers[-1].group()) + 1}
+    for i in sorted(changes, reverse=True):
+        match = numbers[i]
+        name = name[:match.start()] + str(changes[i]).zfill(len(match.group())) + name[match.end():]
+    name += extension
+    return f"{head}/{name}" if head else name
+
+def annotate_playlist(text):
+    """
+    Add the LL-HLS tags a live media playlist needs and the packager left out.
+
+    EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES tells players this server
+    honours _HLS_msn/_HLS_part; without it they never send them. When the
+    playlist lists parts, PART-HOLD-BACK, EXT-X-PART-INF and an
+    EXT-X-PRELOAD-HINT for the next part are added as well. Master and
+    ended playlists are returned unchanged.
+    """
+    if '#EXT-X-TARGETDURATION:' not in text or '#EXT-X-ENDLIST' in text:
+        return text
+
+    lines = text.splitlines()
+    part_target = 0.0
+    last_part = None
+    new_segment = False
+    for line in lines:
+        if line.startswith('#EXT-X-PART:'):
+            duration = re.search(r'DURATION=([\d.]+)', line)
+            uri = re.search(r'URI="([^"]+)"', line)
+            if duration:
+                part_target = max(part_target, float(duration.group(1)))
+            if uri:
+                last_part = uri.group(1)
+            new_segment = False
+        elif line.startswith('#EXTINF:'):
+            new_segment = True
+
+    header = []
+    if not any(line.startswith('#EXT-X-SERVER-CONTROL:') for line in lines):
+        control = 'CAN-BLOCK-RELOAD=YES'
+        if part_target:
+            control += f",PART-HOLD-BACK={3 * part_target:.3f}"
+        header.append(f"#EXT-X-SERVER-CONTROL:{control}")
+    else:
+        lines = [line + ',CAN-BLOCK-RELOAD=YES'
+                 if line.startswith('#EXT-X-SERVER-CONTROL:') and 'CAN-BLOCK-RELOAD' not in line else line
+                 for line in lines]
+    if part_target and not any(line.startswith('#EXT-X-PART-INF:') for line in lines):
+        header.append(f"#EXT-X-PART-INF:PART-TARGET={part_target:.3f}")
+
+    index = next(i for i, line in enumerate(lines) if line.startswith('#EXT-X-TARGETDURATION:'))
+    lines[index + 1:index + 1] = header
+
+    if last_part and not any(line.startswith('#EXT-X-PRELOAD-HINT:') for line in lines):
+        hint = _next_part_uri(last_part, new_segment)
+        if hint:
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{hint}"')
+    return '\n'.join(lines) + '\n'
+
+def _relative(filename):
+    """Normalised relative path, or None if it leaves the HLS roots."""
+    relative = os.path.normpath(filename).replace(os.sep, '/')
+    if relative.startswith('../') or relative == '..' or os.path.isabs(relative):
+        return None
+    return relative
+
+class ChangeNotifier:
+    """Futures resolved when an HLS file changes, shared by all waiting requests."""
+
+    def __init__(self, index, loop):
+        self.index = index
+        self.loop = loop
+        self._futures = {}  # relative path -> future
+        self._waiters = {}  # relative path -> number of requests waiting on it
+        self._mtimes = {}  # relative path -> last seen mtime (polling mode)
+        if index.indexed:
+            index.add_listener(self._on_event)
+
+    def _on_event(self, kind, relative, is_dir, root):
+        # Called from the watcher thread
+        if kind == 'overflow':
+            self.loop.call_soon_threadsafe(self._changed_all)
+        elif not is_dir:
+            self.loop.call_soon_threadsafe(self._changed, relative)
+
+    def _changed(self, relative):
+        future = self._futures.pop(relative, None)
+        if future and not future.done():
+            future.set_result(None)
+
+    def _changed_all(self):
+        for relative in list(self._futures):
+            self._changed(relative)
+
+    @contextlib.contextmanager
+    def watch(self, relative):
+        """
+        Future resolved on the next change of a file; enter before reading the file.
+
+        The file stays watched while any request is inside watch() for it, so
+        requests that time out or give up do not leave futures behind.
+        """
+        future = self._futures.get(relative)
+        if future is None or future.done():
+            future = self.loop.create_future()
+            self._futures[relative] = future
+        self._waiters[relative] = self._waiters.get(relative, 0) + 1
+        try:
+            yield future
+        finally:
+            self._waiters[relative] -= 1
+            if not self._waiters[relative]:
+                del self._waiters[relative]
+                future = self._futures.pop(relative, None)
+                if future and not future.done():
+                    future.cancel()
+
+    async def poll(self):
+        """Without inotify, detect changes of waited-on files by their mtime."""
+        while True:
+            await asyncio.sleep(LLHLS_POLL_INTERVAL)
+            for relative in list(self._futures):
+                path = self.index.resolve(relative)
+                try:
+                    mtime = os.stat(path).st_mtime_ns if path else None
+                except OSError:
+                    mtime = None
+                if self._mtimes.get(relative, mtime) != mtime:
+                    self._changed(relative)
+                self._mtimes[relative] = mtime
+            for relative in list(self._mtimes):
+                if relative not in self._futures:
+                    del self._mtimes[relative]
+
+async def _wait(future, timeout):
+    try:
+        await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+def _read(path):
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read()
+    except OSError:
+        return None
+
+async def serve_playlist(request, relative):
+    notifier = request.app['notifier']
+    loop = asyncio.get_running_loop()
+
+    try:
+        msn = int(request.query['_HLS_msn']) if '_HLS_msn' in request.query else None
+        part = int(request.query['_HLS_part']) if '_HLS_part' in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text='Invalid _HLS_msn or _HLS_part')
+    if part is not None and msn is None:
+        raise web.HTTPBadRequest(text='_HLS_part requires _HLS_msn')
+
+    if msn is None:
+        path = request.app['index'].resolve(relative)
+        text = _read(path) if path else None
+        if text is None:
+            raise web.HTTPNotFound()
+
+    deadline = None
+    while msn is not None:
+        # Watched before reading, so a change right after the read is not missed
+        with notifier.watch(relative) as change:
+            path = request.app['index'].resolve(relative)
+            text = _read(path) if path else None
+
+            if text is not None:
+                position = playlist_position(text)
+                if request_satisfied(position, msn, part):
+                    break
+                if msn > position['last_msn'] + 2:
+                    raise web.HTTPBadRequest(text='_HLS_msn is too far ahead of the playlist')
+                if deadline is None:
+                    hold = 3 * position['target_duration'] if position['target_duration'] else LLHLS_HOLD_TIMEOUT
+                    deadline = loop.time() + hold
+            elif deadline is None:
+                deadline = loop.time() + LLHLS_HOLD_TIMEOUT
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise web.HTTPServiceUnavailable(text='Playlist did not reach the requested segment in time')
+            await _wait(change, remaining)
+
+    headers = dict(CORS_HEADERS)
+    # A blocking response is final for its URL; plain reloads must not be cached
+    headers['Cache-Control'] = 'public, max-age=60' if msn is not None else 'no-cache'
+    return web.Response(text=annotate_playlist(text), content_type='application/vnd.apple.mpegurl',
+                        headers=headers)
+
+async def serve_media(request, relative):
+    notifier = request.app['notifier']
+    index = request.app['index']
+    loop = asyncio.get_running_loop()
+
+    path = index.resolve(relative)
+    if path is None and index.playlist_path(stream_key_for(relative)):
+        # Probably a preload hint: hold the request until the packager writes it
+        deadline = loop.time() + LLHLS_HOLD_TIMEOUT
+        while path is None and loop.time() < deadline:
+            with notifier.watch(relative) as change:
+                path = index.resolve(relative)
+                if path is None:
+                    await _wait(change, deadline - loop.time())
+                    path = index.resolve(relative)
+    if path is None:
+        raise web.HTTPNotFound()
+
+    headers = dict(CORS_HEADERS)
+    headers['Cache-Control'] = 'public, max-age=60'
+    headers['Content-Type'] = CONTENT_TYPES.get(os.path.splitext(relative)[1].lower(), 'application/octet-stream')
+    return web.FileResponse(path, headers=headers)
+
+async def handle(request):
+    relative = _relative(request.match_info['filename'])
+    if relative is None:
+        raise web.HTTPNotFound()
+    if relative.endswith('.m3u8'):
+        return await serve_playlist(request, relative)
+    return await serve_media(request, relative)
+
+async def handle_options(request):
+    return web.Response(headers=CORS_HEADERS)
+
+async def on_startup(app):
+    index = HlsIndex()
+    index.start()
+    notifier = ChangeNotifier(index, asyncio.get_running_loop())
+    app['index'] = index
+    app['notifier'] = notifier
+    if not index.indexed:
+        app['poller'] = asyncio.ensure_future(notifier.poll())
+        logger.info(f"inotify unavailable, polling waited-on files every {LLHLS_POLL_INTERVAL}s")
+
+async def on_cleanup(app):
+    poller = app.get('poller')
+    if poller:
+        poller.cancel()
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/live/llhls/{filename:.+}', handle)
+    app.router.add_route('OPTIONS', '/live/llhls/{filename:.+}', handle_options)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s",
+                        stream=sys.stdout)
+    web.run_app(create_app(), host=LLHLS_HOST, port=LLHLS_PORT)
+
+if __name__ == "__main__":
+    main()
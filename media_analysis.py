@@ -0,0 +1,116 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import has_app_context
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Most recently used probes in this process, keyed by (path, size, mtime_ns)
+MEMO_SIZE = 256
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+def file_fingerprint(file_path, sample_size=1024 * 1024):
+    """Cheap content fingerprint from the file size and its first and last megabyte.
+    
+    Used as the cache key for files whose full SHA-256 was not computed at upload.
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            digest.update(f.read(sample_size))
+    return f"sample:{digest.hexdigest()}"
+
+def _stat_key(file_path):
+    stat = os.stat(file_path)
+    return (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+
+def _remember(memo_key, probe):
+    with _memo_lock:
+        _memo[memo_key] = probe
+        _memo.move_to_end(memo_key)
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+
+def load_probe(file_path, content_hash=None):
+    """Return the cached ffprobe JSON for a file, or None on a cache miss.
+    
+    A changed size or mtime invalidates the entry. The database is only
+    consulted inside an application context.
+    """
+    try:
+        memo_key = _stat_key(file_path)
+    except OSError:
+        return None
+    
+    with _memo_lock:
+        if memo_key in _memo:
+            _memo.move_to_end(memo_key)
+            return _memo[memo_key]
+    
+    if not has_app_context():
+        return None
+    
+    from app import db
+    from models import MediaAnalysis
+    
+    path, size, mtime_ns = memo_key
+    query = MediaAnalysis.query.filter_by(file_size=size, mtime_ns=mtime_ns)
+    if content_hash:
+        query = query.filter_by(content_hash=content_hash)
+    else:
+        query = query.filter_by(file_path=path)
+    
+    try:
+        analysis = query.first()
+    except Exception as e:
+        logger.error(f"Error reading media analysis cache: {str(e)}")
+        return None
+    
+    if analysis is None:
+        return None
+    
+    _remember(memo_key, analysis.probe)
+    return analysis.probe
+
+def store_probe(file_path, probe, content_hash=None):
+    """Cache the ffprobe JSON for a file in memory and in the MediaAnalysis table.
+    
+    The row is written in its own session so it does not join (or commit)
+    whatever transaction the caller has open.
+    """
+    try:
+        memo_key = _stat_key(file_path)
+    except OSError:
+        return
+    
+    _remember(memo_key, probe)
+    
+    if not has_app_context():
+        return
+    
+    from app import db
+    from models import MediaAnalysis
+    
+    path, size, mtime_ns = memo_key
+    try:
+        with Session(db.engine) as session:
+            session.add(MediaAnalysis(
+                content_hash=content_hash or file_fingerprint(file_path),
+                file_size=size,
+                mtime_ns=mtime_ns,
+                file_path=path,
+                probe=probe
+            ))
+            session.commit()
+    except IntegrityError:
+        pass  # Another worker stored the same analysis first
+    except Exception as e:
+        logger.error(f"Error writing media analysis cache: {str(e)}")
@@ -0,0 +1,132 @@
+import logging
+import socket
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from app import db
+from models import ProcessingJob
+from config import JOB_MAX_ATTEMPTS, JOB_STALE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Job priorities - lower values are claimed first
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 100
+PRIORITY_LOW = 200
+
+def get_worker_id(index=0):
+    """Build an identifier for a worker process that is unique across hosts."""
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+def enqueue_job(media_id, job_type='process_media', priority=PRIORITY_NORMAL, payload=None, commit=True):
+    """Add a processing job to the persistent queue.
+
+    Args:
+        media_id: ID of the media record the job works on (may be None)
+        job_type: Name of the handler that should run the job
+        priority: Lower values are picked up first
+        payload: Optional dictionary of job parameters
+        commit: Commit the session after adding the job
+
+    Returns:
+        The new ProcessingJob
+    """
+    job = ProcessingJob(
+        job_type=job_type,
+        media_id=media_id,
+        priority=priority,
+        payload=payload or {},
+        status='pending'
+    )
+    db.session.add(job)
+
+    if commit:
+        db.session.commit()
+
+    logger.info(f"Queued {job_type} job for media {media_id}")
+    return job
+
+def claim_next_job(worker_id, job_types=None):
+    """Atomically claim the next pending job.
+
+    The claim is a conditional UPDATE on the job status, so several worker
+    processes (or hosts) can poll the same table without picking up the same job.
+
+    Returns:
+        The claimed ProcessingJob or None if the queue is empty
+    """
+    query = ProcessingJob.query.filter_by(status='pending')
+    if job_types:
+        query = query.filter(ProcessingJob.job_type.in_(job_types))
+
+    candidates = query.order_by(ProcessingJob.priority, ProcessingJob.created_at).with_entities(ProcessingJob.id).limit(5).all()
+
+    for (job_id,) in candidates:
+        claimed = ProcessingJob.query.filter_by(id=job_id, status='pending').update({
+            'status': 'running',
+            'worker_id': worker_id,
+            'started_at': datetime.utcnow(),
+            'heartbeat_at': datetime.utcnow(),
+            'attempts': ProcessingJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+
+        if claimed:
+            return ProcessingJob.query.get(job_id)
+
+    return None
+
+def complete_job(job):
+    """Mark a job as finished successfully."""
+    job.status = 'done'
+    job.error = None
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+def fail_job(job, error, retry=True):
+    """Record a job failure, requeueing it while attempts remain (unless retry is False)."""
+    job.error = str(error)
+
+    if retry and job.attempts < JOB_MAX_ATTEMPTS:
+        job.status = 'pending'
+        job.worker_id = None
+        logger.warning(f"Job {job.id} failed (attempt {job.attempts}), requeued: {error}")
+    else:
+        job.status = 'failed'
+        job.finished_at = datetime.utcnow()
+        logger.error(f"Job {job.id} failed permanently after {job.attempts} attempts: {error}")
+
+    db.session.commit()
+
+def heartbeat_job(job_id, engine):
+    """Record that a job is still being worked on.
+
+    Uses its own connection from engine, so it can run in a thread next to
+    the job handler without touching the handler's session.
+    """
+    table = ProcessingJob.__table__
+    with engine.begin() as connection:
+        connection.execute(table.update()
+                           .where(table.c.id == job_id, table.c.status == 'running')
+                           .values(heartbeat_at=datetime.utcnow()))
+
+def requeue_stale_jobs(timeout=JOB_STALE_TIMEOUT):
+    """Return jobs left running by a crashed worker to the queue.
+
+    Running jobs send a heartbeat every JOB_HEARTBEAT_INTERVAL seconds, so
+    only jobs whose worker is gone are picked up, however long a healthy
+    encode takes.
+
+    Returns:
+        Number of jobs that were requeued
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    stale_jobs = ProcessingJob.query.filter(
+        ProcessingJob.status == 'running',
+        func.coalesce(ProcessingJob.heartbeat_at, ProcessingJob.started_at) < cutoff
+    ).all()
+
+    for job in stale_jobs:
+        fail_job(job, f"Worker {job.worker_id} sent no heartbeat for {timeout} seconds")
+
+    return len(stale_jobs)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+StreamLite Media Worker
+Runs a pool of worker processes that own all ffmpeg/ffprobe work.
+
+Uploads only store the file and queue a ProcessingJob; the workers pick jobs
+up from the database, run the processing pipeline and mark the media as
+processed when it has finished.
+
+Usage: python media_worker.py [--processes N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import datetime
+import signal
+import logging
+import threading
+import multiprocessing
+
+# Marks this process tree so app.py does not spawn helper processes again
+os.environ.setdefault("STREAMLITE_MEDIA_WORKER", "1")
+
+from config import (MEDIA_WORKER_PROCESSES, MEDIA_WORKER_LOCK_PATH, JOB_POLL_INTERVAL, JOB_HEARTBEAT_INTERVAL,
+                    UPLOAD_FOLDER, HLS_VOD_ENABLED, HLS_VOD_FOLDER, STORYBOARD_FOLDER, WAVEFORM_FOLDER,
+                    LIVE_STALL_CHECK_INTERVAL, LIVE_STATUS_REFRESH_INTERVAL, VIEWER_FLUSH_INTERVAL,
+                    LIVE_ABR_ENABLED, LIVE_ABR_CHECK_INTERVAL, LIVE_ARCHIVE_ENABLED, LIVE_ARCHIVE_FOLDER,
+                    LIVE_ARCHIVE_CHECK_INTERVAL)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+logger = logging.getLogger("media_worker")
+
+class JobError(Exception):
+    """Raised by a job handler when the job cannot be completed.
+
+    retry=False marks failures that another attempt cannot fix.
+    """
+
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+def process_media(job, media, progress):
+    """Probe and scan a freshly uploaded file, generate its thumbnail and publish it."""
+    from app import db
+    from ffmpeg_utils import get_media_info, scan_integrity, generate_thumbnail
+    from media_queue import enqueue_job, PRIORITY_LOW
+
+    progress.stage('probe')
+    media_info = get_media_info(media.file_path, media.content_hash)
+    if not media_info:
+        raise JobError(f"Could not read media information from {media.file_path}")
+
+    media.file_size = media_info['filesize'] or media.file_size
+    media.duration = media_info['duration']
+    media.format = media_info['format']
+
+    # The verdict decides how later jobs read the file
+    progress.stage('scan', media_info['duration_seconds'])
+    verdict, errors = scan_integrity(media.file_path, media_info)
+    if verdict:
+        media.integrity = verdict
+        media.integrity_errors = errors
+    if verdict == 'unrecoverable':
+        # Keep the verdict, the job itself fails without further attempts
+        db.session.commit()
+        raise JobError(f"No readable streams in {media.file_path}", retry=False)
+
+    if media.media_type == 'video':
+        progress.stage('thumbnail', media_info['duration_seconds'])
+        thumbnail_path = generate_thumbnail(media.file_path, media.id, media_info=media_info)
+        if thumbnail_path:
+            media.thumbnail_path = thumbnail_path
+
+        # The progressive file is playable right away, previews and the adaptive ladder follow
+        enqueue_job(media.id, 'generate_storyboard', priority=PRIORITY_LOW, commit=False)
+        if HLS_VOD_ENABLED:
+            enqueue_job(media.id, 'package_hls', priority=PRIORITY_LOW, commit=False)
+    elif media_info.get('has_audio'):
+        # Audio is playable right away, the waveform follows
+        enqueue_job(media.id, 'generate_waveform', commit=False)
+
+    media.is_processed = True
+
+def package_hls(job, media, progress):
+    """Package a processed video as an adaptive HLS ladder."""
+    from ffmpeg_utils import get_media_info, package_hls_vod
+    from utils import generate_output_folder, remove_generated_folder
+
+    output_dir = generate_output_folder(HLS_VOD_FOLDER)
+
+    # Served from the analysis cache filled when the upload was processed
+    media_info = get_media_info(media.file_path, media.content_hash)
+    progress.stage('encode', media_info['duration_seconds'] if media_info else None)
+    try:
+        result = package_hls_vod(media.file_path, output_dir, media_info=media_info, integrity=media.integrity)
+    except TimeoutError as e:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        # Another attempt would run into the same limit after spending as much CPU again
+        raise JobError(str(e), retry=False)
+    if not result:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise JobError(f"HLS packaging failed for {media.file_path}")
+
+    # Reassign the JSON column so SQLAlchemy notices the change
+    encoding_settings = dict(media.encoding_settings or {})
+    remove_generated_folder((encoding_settings.get('hls') or {}).get('master'))  # Ladder of an earlier run
+    encoding_settings['hls'] = {
+        'master': os.path.relpath(result['master'], UPLOAD_FOLDER),
+        'renditions': result['renditions'],
+        'segment_type': result['segment_type']
+    }
+    media.encoding_settings = encoding_settings
+
+def generate_storyboard(job, media, progress):
+    """Build the seek-preview sprite sheets and WebVTT index of a video."""
+    from ffmpeg_utils import get_media_info, generate_storyboard as build_storyboard
+    from utils import generate_output_folder, remove_generated_folder
+
+    media_info = get_media_info(media.file_path, media.content_hash)
+    progress.stage('storyboard', media_info['duration_seconds'] if media_info else None)
+    vtt_path = build_storyboard(media.file_path, generate_output_folder(STORYBOARD_FOLDER), media_info=media_info)
+    if not vtt_path:
+        raise JobError(f"Storyboard generation failed for {media.file_path}")
+
+    encoding_settings = dict(media.encoding_settings or {})
+    remove_generated_folder(encoding_settings.get('storyboard'))
+    encoding_settings['storyboard'] = os.path.relpath(vtt_path, UPLOAD_FOLDER)
+    media.encoding_settings = encoding_settings
+
+def generate_waveform(job, media, progress):
+    """Precompute the waveform peaks of an audio upload."""
+    from ffmpeg_utils import get_media_info, generate_waveform as build_waveform
+    from utils import generate_output_folder, remove_generated_folder
+
+    media_info = get_media_info(media.file_path, media.content_hash)
+    progress.stage('waveform', media_info['duration_seconds'] if media_info else None)
+    waveform_path = build_waveform(media.file_path, generate_output_folder(WAVEFORM_FOLDER), media_info=media_info)
+    if not waveform_path:
+        raise JobError(f"Waveform generation failed for {media.file_path}")
+
+    encoding_settings = dict(media.encoding_settings or {})
+    remove_generated_folder(encoding_settings.get('waveform'))
+    encoding_settings['waveform'] = os.path.relpath(waveform_path, UPLOAD_FOLDER)
+    media.encoding_settings = encoding_settings
+
+def archive_live(job, media, progress):
+    """
+    Remux the archived segments of an ended live stream into a video and add it
+    as a private Media item of the stream's owner.
+
+    Safe to retry: the random filename of the video is kept in the job payload,
+    so an attempt that failed after moving it into place reuses the file, and
+    one that failed after committing finds the Media item.
+    """
+    from app import db
+    from models import LiveStream, Media
+    from utils import generate_unique_filename
+    from ffmpeg_utils import get_media_info, generate_thumbnail
+    from live_archive import remux_archive
+    from media_queue import enqueue_job, PRIORITY_LOW
+
+    folder = os.path.join(LIVE_ARCHIVE_FOLDER, job.payload['folder'])
+    if not job.payload.get('filename'):
+        # Reassign the JSON column so SQLAlchemy notices the change
+        job.payload = dict(job.payload, filename=generate_unique_filename('live.mp4'))
+        db.session.commit()
+    filename = job.payload['filename']
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    stream = LiveStream.query.get(job.payload['live_stream_id'])
+    if Media.query.filter_by(file_path=file_path).first() is not None:
+        shutil.rmtree(folder, ignore_errors=True)
+        return  # Already published by an earlier attempt
+    if stream is None:
+        shutil.rmtree(folder, ignore_errors=True)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+
+    if os.path.exists(file_path):
+        media_info = get_media_info(file_path)  # Moved into place by an earlier attempt
+    elif os.path.isdir(folder):
+        progress.stage('remux')
+        partial = os.path.join(folder, filename)
+        if not remux_archive(folder, partial):
+            raise JobError(f"Remuxing live archive {job.payload['folder']} failed")
+        media_info = get_media_info(partial)
+        if media_info:
+            shutil.move(partial, file_path)  # A rename unless the archive folder is on another filesystem
+    else:
+        return  # Nothing left to archive
+    if not media_info:
+        raise JobError(f"Could not read media information from {file_path}")
+
+    started = stream.started_at or datetime.datetime.utcnow()
+    media = Media(
+        title=f"{stream.title} ({started.strftime('%Y-%m-%d %H:%M')})"[:128],
+        description=stream.description,
+        filename=filename,
+        original_filename=filename,
+        file_path=file_path,
+        media_type='video',
+        file_size=os.path.getsize(file_path),
+        duration=media_info['duration'],
+        format='mp4',
+        is_public=False,  # The owner publishes recordings deliberately
+        is_processed=True,
+        encoding_settings={'live_stream_id': stream.id},
+        user_id=stream.user_id,
+        category_id=stream.category_id
+    )
+    db.session.add(media)
+    db.session.flush()  # The thumbnail is named after the media id
+
+    progress.stage('thumbnail', media_info['duration_seconds'])
+    thumbnail_path = generate_thumbnail(file_path, media.id, media_info=media_info)
+    if thumbnail_path:
+        media.thumbnail_path = thumbnail_path
+
+    enqueue_job(media.id, 'generate_storyboard', priority=PRIORITY_LOW, commit=False)
+    if HLS_VOD_ENABLED:
+        enqueue_job(media.id, 'package_hls', priority=PRIORITY_LOW, commit=False)
+    db.session.commit()
+    shutil.rmtree(folder, ignore_errors=True)
+    logger.info(f"Archived stream {stream.id} as media {media.id}")
+
+# Maps ProcessingJob.job_type to the function that runs it
+JOB_HANDLERS = {
+    'process_media': process_media,
+    'package_hls': package_hls,
+    'generate_storyboard': generate_storyboard,
+    'generate_waveform': generate_waveform,
+    'archive_live': archive_live,
+}
+
+# Scheduler lane (see TRANSCODE_LANES) of each job type, new uploads are published first
+JOB_LANES = {
+    'process_media': 'interactive',
+    'package_hls': 'bulk',
+    'generate_storyboard': 'bulk',
+    'generate_waveform': 'bulk',
+    'archive_live': 'interactive',  # Stream copy only, the recording is published within seconds
+}
+
+def _heartbeat(job_id, engine, stop):
+    """Send job heartbeats until stop is set."""
+    from media_queue import heartbeat_job
+
+    while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            heartbeat_job(job_id, engine)
+        except Exception as e:
+            logger.error(f"Error sending heartbeat of job {job_id}: {str(e)}")
+
+def run_job(job, cancel_event=None, scheduler=None):
+    """Run a single claimed job with its registered handler.
+
+    Setting cancel_event kills the job's running ffmpeg process. Progress is
+    published through job_progress while the job runs, and with a scheduler
+    every ffmpeg process of the job is admitted in the job type's lane.
+    """
+    from app import db
+    from media_queue import complete_job, fail_job
+    from ffmpeg_runner import job_context
+    from job_progress import ProgressTracker
+
+    handler = JOB_HANDLERS.get(job.job_type)
+    if not handler:
+        fail_job(job, f"Unknown job type: {job.job_type}")
+        return
+
+    started = time.time()
+    progress = ProgressTracker(job)
+    # Keeps requeue_stale_jobs away from the job however long its encodes run
+    heartbeat_stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job.id, db.engine, heartbeat_stop), daemon=True,
+                     name=f"job-{job.id}-heartbeat").start()
+    try:
+        with job_context(cancel_event=cancel_event, on_progress=progress,
+                         scheduler=scheduler, lane=JOB_LANES.get(job.job_type, 'bulk')):
+            handler(job, job.media, progress)
+        db.session.commit()
+        complete_job(job)
+        progress.finish('done')
+        logger.info(f"Job {job.id} ({job.job_type}) finished in {time.time() - started:.1f}s")
+    except Exception as e:
+        db.session.rollback()
+        logger.exception(f"Job {job.id} ({job.job_type}) failed")
+        fail_job(job, e, retry=getattr(e, 'retry', True))
+        progress.finish('retrying' if job.status == 'pending' else 'failed', error=e)
+    finally:
+        heartbeat_stop.set()
+
+def worker_loop(index, scheduler=None):
+    """Main loop of a single worker process."""
+    from app import app, db
+    from media_queue import claim_next_job, get_worker_id
+
+    worker_id = get_worker_id(index)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    logger.info(f"Media worker {worker_id} started")
+
+    with app.app_context():
+        while not stopping.is_set():
+            try:
+                job = claim_next_job(worker_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error polling job queue: {str(e)}")
+                job = None
+
+            if job is None:
+                time.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            run_job(job, cancel_event=stopping, scheduler=scheduler)
+            db.session.remove()
+
+    logger.info(f"Media worker {worker_id} stopped")
+
+def acquire_pool_lock(path=MEDIA_WORKER_LOCK_PATH):
+    """
+    Take the lock that allows one media worker pool per host.
+
+    Returns:
+        File descriptor holding the lock (kept open while the pool runs), or
+        None if another pool holds it
+    """
+    import fcntl
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        owner = os.pread(fd, 32, 0).decode('ascii', errors='replace').strip()
+        os.close(fd)
+        logger.warning(f"Another media worker pool is running (pid {owner or 'unknown'}), exiting")
+        return None
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, str(os.getpid()).encode('ascii'), 0)
+    return fd
+
+def run_pool(processes=MEDIA_WORKER_PROCESSES):
+    """
+    Start the worker processes and restart any that exit unexpectedly.
+
+    Returns:
+        False if another pool is already running on this host
+    """
+    lock_fd = acquire_pool_lock()
+    if lock_fd is None:
+        return False
+
+    from app import app
+    from media_queue import requeue_stale_jobs
+    from utils import cleanup_upload_sessions
+    from job_progress import cleanup_progress
+    from transcode_scheduler import CpuScheduler
+    from live_state import expire_stalled_streams, refresh_live_status
+    from viewer_tracker import flush_viewer_counts, flush_media_viewers
+    from live_metrics import MetricSampler
+    from live_transcoder import LiveTranscodeSupervisor
+    from live_archive import LiveArchiver
+
+    # Workers start from a fresh interpreter so no database connections are shared
+    ctx = multiprocessing.get_context("spawn")
+    # One CPU budget shared by the ffmpeg processes of all workers
+    scheduler = CpuScheduler(ctx=ctx)
+    # Live stream metrics are sampled here, the one process that runs for the whole deployment
+    sampler = MetricSampler()
+    # ABR encoders draw from the same CPU budget as the media jobs
+    transcoder = LiveTranscodeSupervisor(scheduler=scheduler) if LIVE_ABR_ENABLED else None
+    archiver = LiveArchiver() if LIVE_ARCHIVE_ENABLED else None
+    workers = {}
+    running = [True]
+
+    def shutdown(signum, frame):
+        running[0] = False
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info(f"Starting media worker pool with {processes} processes and a budget of {scheduler.budget} threads")
+
+    last_requeue = 0
+    last_stall_check = 0
+    last_status_refresh = 0
+    last_viewer_flush = 0
+    last_abr_check = 0
+    last_archive_check = 0
+    while running[0]:
+        for index in range(processes):
+            proc = workers.get(index)
+            if proc is None or not proc.is_alive():
+                if proc is not None:
+                    logger.warning(f"Worker {index} exited with code {proc.exitcode}, restarting")
+                    # Threads it was granted would otherwise stay taken for the life of the pool
+                    scheduler.reclaim(proc.pid)
+                proc = ctx.Process(target=worker_loop, args=(index, scheduler), name=f"media-worker-{index}")
+                proc.start()
+                workers[index] = proc
+
+        if time.time() - last_requeue > 60:
+            with app.app_context():
+                try:
+                    requeued = requeue_stale_jobs()
+                    if requeued:
+                        logger.warning(f"Requeued {requeued} stale jobs")
+                    removed = cleanup_upload_sessions()
+                    if removed:
+                        logger.info(f"Removed {removed} abandoned upload sessions")
+                    cleanup_progress()
+                    scheduler.reclaim()
+                except Exception as e:
+                    logger.error(f"Error during queue maintenance: {str(e)}")
+            last_requeue = time.time()
+
+        if time.time() - last_stall_check > LIVE_STALL_CHECK_INTERVAL:
+            with app.app_context():
+                try:
+                    expire_stalled_streams()
+                except Exception as e:
+                    logger.error(f"Error checking live streams: {str(e)}")
+            last_stall_check = time.time()
+
+        if time.time() - last_status_refresh > LIVE_STATUS_REFRESH_INTERVAL:
+            with app.app_context():
+                try:
+                    refresh_live_status()
+                except Exception as e:
+                    logger.error(f"Error refreshing live stream status: {str(e)}")
+            last_status_refresh = time.time()
+
+        if time.time() - last_viewer_flush > VIEWER_FLUSH_INTERVAL:
+            with app.app_context():
+                try:
+                    flush_viewer_counts()
+                    flush_media_viewers()
+                except Exception as e:
+                    logger.error(f"Error flushing viewer counts: {str(e)}")
+            last_viewer_flush = time.time()
+
+        if transcoder and time.time() - last_abr_check > LIVE_ABR_CHECK_INTERVAL:
+            with app.app_context():
+                try:
+                    transcoder.reconcile()
+                except Exception as e:
+                    logger.error(f"Error supervising ABR encoders: {str(e)}")
+            last_abr_check = time.time()
+
+        if archiver and time.time() - last_archive_check > LIVE_ARCHIVE_CHECK_INTERVAL:
+            with app.app_context():
+                try:
+                    archiver.follow()
+                except Exception as e:
+                    logger.error(f"Error archiving live streams: {str(e)}")
+            last_archive_check = time.time()
+
+        with app.app_context():
+            try:
+                sampler.tick()
+            except Exception as e:
+                logger.error(f"Error sampling live metrics: {str(e)}")
+
+        scheduler.write_metrics()
+        time.sleep(1)
+
+    logger.info("Stopping media worker pool")
+    if transcoder:
+        transcoder.stop_all()
+    for proc in workers.values():
+        proc.terminate()
+    for proc in workers.values():
+        proc.join(timeout=30)
+    os.close(lock_fd)
+    return True
+
+def main():
+    processes = MEDIA_WORKER_PROCESSES
+    if "--processes" in sys.argv:
+        processes = int(sys.argv[sys.argv.index("--processes") + 1])
+    run_pool(max(1, processes))
+
+if __name__ == "__main__":
+    main()
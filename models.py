@@ -44,9 +44,12 @@ class Media(db.Model):
     file_path = db.Column(db.String(512), nullable=False)
     thumbnail_path = db.Column(db.String(512))
     media_type = db.Column(db.String(16), nullable=False)  # video, audio
-    file_size = db.Column(db.Integer)  # Size in bytes
+    file_size = db.Column(db.BigInteger)  # Size in bytes, chunked uploads go past 2GB
     duration = db.Column(db.Integer)   # Duration in seconds
     format = db.Column(db.String(32))  # mp4, mkv, etc.
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the uploaded file, when known
+    integrity = db.Column(db.String(16))  # Pre-flight scan verdict: clean, recoverable, audio-only, unrecoverable
+    integrity_errors = db.Column(db.Integer)  # Demux errors reported by the pre-flight scan
     is_public = db.Column(db.Boolean, default=True)
     is_processed = db.Column(db.Boolean, default=False)
     views = db.Column(db.Integer, default=0)
@@ -62,9 +65,91 @@ class Media(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     
+    # Relationships
+    processing_jobs = db.relationship('ProcessingJob', backref='media', lazy=True, cascade="all, delete-orphan")
+    
     def __repr__(self):
         return f'<Media {self.title}>'
 
+class ProcessingJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(32), nullable=False, default='process_media')
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)  # pending, running, done, failed
+    priority = db.Column(db.Integer, default=100)  # Lower values are claimed first
+    attempts = db.Column(db.Integer, default=0)
+    payload = db.Column(JSON, default={})
+    error = db.Column(db.Text)
+    worker_id = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Updated by the worker while the job runs
+    finished_at = db.Column(db.DateTime)
+    
+    # Foreign keys
+    media_id = db.Column(db.Integer, db.ForeignKey('media.id'), nullable=True)
+    
+    def __repr__(self):
+        return f'<ProcessingJob {self.id} {self.job_type} {self.status}>'
+
+class MediaAnalysis(db.Model):
+    """Cached ffprobe output for a file, so each file is probed only once."""
+    __table_args__ = (db.UniqueConstraint('content_hash', 'file_size', 'mtime_ns'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(80), nullable=False)  # SHA-256, or a sampled fingerprint when no hash is known
+    file_size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    file_path = db.Column(db.String(512), index=True)  # Lets callers without a hash find the entry
+    probe = db.Column(JSON, nullable=False)  # Full ffprobe format/streams JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MediaAnalysis {self.content_hash[:12]}>'
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # Random hex token used in upload URLs
+    original_filename = db.Column(db.String(256), nullable=False)
+    unique_filename = db.Column(db.String(256), nullable=False)
+    part_path = db.Column(db.String(512), nullable=False)  # Preallocated file the chunks are written into
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), default='uploading')  # uploading, assembling, complete
+    form_data = db.Column(JSON, default={})  # Title, description, category and visibility for the media record
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Foreign keys
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    media_id = db.Column(db.Integer, db.ForeignKey('media.id', ondelete='SET NULL'), nullable=True)
+    
+    # Relationships
+    chunks = db.relationship('UploadChunk', backref='session', lazy='dynamic', cascade="all, delete-orphan")
+    
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.total_size // self.chunk_size))
+    
+    def chunk_length(self, index):
+        """Expected number of bytes in the chunk with the given index."""
+        return min(self.chunk_size, self.total_size - index * self.chunk_size)
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id}>'
+
+class UploadChunk(db.Model):
+    __table_args__ = (db.UniqueConstraint('upload_session_id', 'chunk_index'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Foreign keys
+    upload_session_id = db.Column(db.String(32), db.ForeignKey('upload_session.id'), nullable=False)
+    
+    def __repr__(self):
+        return f'<UploadChunk {self.upload_session_id}:{self.chunk_index}>'
+
 class LiveStream(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), nullable=False)
@@ -123,6 +208,26 @@ class StreamAnalytics(db.Model):
         return f'<StreamAnalytics {self.id}>'
 
 
+class StreamMetricRollup(db.Model):
+    """Per-stream metrics aggregated over one minute or one hour (see live_metrics.py)."""
+    __table_args__ = (db.UniqueConstraint('live_stream_id', 'resolution', 'bucket_start'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.String(8), nullable=False)  # minute, hour
+    bucket_start = db.Column(db.DateTime, nullable=False)  # UTC start of the minute or hour
+    samples = db.Column(db.Integer, default=0)
+    viewers_avg = db.Column(db.Float, default=0)
+    viewers_max = db.Column(db.Integer, default=0)
+    bitrate_kbps = db.Column(db.Float)  # Average ingest bitrate, None when unknown
+    chat_messages = db.Column(db.Integer, default=0)
+    
+    # Foreign keys
+    live_stream_id = db.Column(db.Integer, db.ForeignKey('live_stream.id'), nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<StreamMetricRollup {self.live_stream_id} {self.resolution} {self.bucket_start}>'
+
+
 class SiteSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     site_name = db.Column(db.String(128), default='StreamLite')
@@ -1,11 +1,12 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user
 from app import db
-from models import User, Media, Category, SiteSettings, SupportChat, SupportMessage, LiveStream
+from models import User, Media, Category, SiteSettings, SupportChat, SupportMessage, LiveStream, ProcessingJob
 import logging
 import os
 from werkzeug.utils import secure_filename
 from utils import allowed_file, save_uploaded_file
+from transcode_scheduler import read_metrics
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -45,6 +46,20 @@ def dashboard():
                            recent_media=recent_media,
                            total_storage=total_storage)
 
+@admin_bp.route('/processing')
+@admin_required
+def processing_status():
+    """Media job queue depth and ffmpeg scheduler admission metrics as JSON."""
+    counts = db.session.query(ProcessingJob.job_type, ProcessingJob.status, db.func.count(ProcessingJob.id)) \
+        .group_by(ProcessingJob.job_type, ProcessingJob.status).all()
+    
+    queue = {}
+    for job_type, status, count in counts:
+        queue.setdefault(job_type, {})[status] = count
+    
+    # Published by the media worker pool; None when it is not running
+    return jsonify({'queue': queue, 'scheduler': read_metrics()})
+
 @admin_bp.route('/users')
 @admin_required
 def manage_users():
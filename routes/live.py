@@ -6,12 +6,23 @@ from werkzeug.utils import secure_filename
 import datetime
 from sqlalchemy import desc
 import time
+import logging
 
 from app import db
-from models import LiveStream, Category, ChatMessage, StreamAnalytics, User, SupportChat
+from models import LiveStream, Category, ChatMessage, StreamAnalytics, StreamMetricRollup, User, SupportChat
 from utils import allowed_file, save_uploaded_file
+from delivery import send_media_file, send_segment
+from hls_index import get_hls_index, stream_key_for
+from edge_relay import get_edge_relay
+from live_state import get_live_state_tracker, end_live_stream, read_live_status
+from viewer_tracker import heartbeat, begin_viewer_tracking, viewer_identity
+from hyperloglog import HyperLogLog
+from live_metrics import load_series
+from config import (HLS_EDGE_SEGMENT_TTL, LIVE_STATUS_POLL_INTERVAL, VIEWER_HEARTBEAT_INTERVAL, LLHLS_ENABLED,
+                    LIVE_ABR_ENABLED)
 
 live_bp = Blueprint('live', __name__, url_prefix='/live')
+logger = logging.getLogger(__name__)
 
 
 @live_bp.route('/')
@@ -41,6 +52,21 @@ def index():
                           now=datetime.datetime.utcnow())
 
 
+def _playlist_url(stream):
+    """
+    Playlist URL for players: the low-latency server when enabled, else serve_hls.
+
+    While the ABR encoder of the stream is running its master playlist is
+    used, so players pick a rendition; otherwise the source playlist.
+    """
+    filename = stream.stream_key + '.m3u8'
+    if LIVE_ABR_ENABLED and get_hls_index().resolve(f"{stream.stream_key}/master.m3u8"):
+        filename = f"{stream.stream_key}/master.m3u8"
+    if LLHLS_ENABLED:
+        return f"/live/llhls/{filename}"
+    return url_for('live.serve_hls', filename=filename)
+
+
 @live_bp.route('/<int:stream_id>')
 def view_stream(stream_id):
     """View a specific live stream."""
@@ -51,10 +77,7 @@ def view_stream(stream_id):
         flash('This stream is private.', 'warning')
         return redirect(url_for('live.index'))
     
-    # Increment viewer count if live
-    if stream.is_live:
-        stream.viewer_count += 1
-        db.session.commit()
+    # Viewers are counted from player heartbeats, see viewer_heartbeat
     
     # Get related streams
     related_streams = []
@@ -98,6 +121,9 @@ def view_stream(stream_id):
                           related_streams=related_streams,
                           recent_media=recent_media,
                           active_support_chat=active_support_chat,
+                          status_interval=LIVE_STATUS_POLL_INTERVAL,
+                          heartbeat_interval=VIEWER_HEARTBEAT_INTERVAL,
+                          hls_url=_playlist_url(stream),
                           now=datetime.datetime.utcnow())
 
 
@@ -142,7 +168,7 @@ def setup_stream():
         if 'thumbnail' in request.files:
             thumbnail_file = request.files['thumbnail']
             if thumbnail_file and thumbnail_file.filename and allowed_file(thumbnail_file.filename):
-                file_path = save_uploaded_file(thumbnail_file, subfolder='thumbnails')
+                file_path = save_uploaded_file(thumbnail_file, subfolder='thumbnails').get('file_path')
                 if file_path:
                     new_stream.thumbnail_path = file_path
         
@@ -197,37 +223,13 @@ def toggle_stream(stream_id):
     # Toggle the stream status
     if stream.is_live:
         # Stop the stream
-        stream.is_live = False
-        stream.ended_at = datetime.datetime.utcnow()
-        
-        # Store analytics
-        if stream.started_at:
-            duration = (stream.ended_at - stream.started_at).total_seconds()
-            
-            analytics = StreamAnalytics(
-                date=stream.ended_at.date(),
-                total_viewers=stream.viewer_count,
-                peak_viewers=stream.viewer_count,
-                average_watch_time=int(duration / max(1, stream.viewer_count)),
-                unique_viewers=stream.viewer_count,
-                live_stream_id=stream.id
-            )
-            db.session.add(analytics)
-        
-        # Create a system message in chat
-        system_message = ChatMessage(
-            message="Stream has ended",
-            is_system_message=True,
-            user_id=stream.user_id,
-            live_stream_id=stream.id
-        )
-        db.session.add(system_message)
+        end_live_stream(stream)
         flash('Stream has been stopped.', 'success')
     else:
         # Start the stream
         stream.is_live = True
         stream.started_at = datetime.datetime.utcnow()
-        stream.viewer_count = 0
+        begin_viewer_tracking(stream)
         
         # Create a system message in chat
         system_message = ChatMessage(
@@ -254,7 +256,7 @@ def start_stream(stream_key):
     # Update stream status
     stream.is_live = True
     stream.started_at = datetime.datetime.utcnow()
-    stream.viewer_count = 0
+    begin_viewer_tracking(stream)
     db.session.commit()
     
     # Create a system message in chat
@@ -278,34 +280,7 @@ def end_stream(stream_key):
     if not stream:
         return jsonify({'success': False, 'message': 'Invalid stream key'}), 404
     
-    # Update stream status
-    stream.is_live = False
-    stream.ended_at = datetime.datetime.utcnow()
-    
-    # Store analytics
-    if stream.started_at:
-        duration = (stream.ended_at - stream.started_at).total_seconds()
-        
-        analytics = StreamAnalytics(
-            date=stream.ended_at.date(),
-            total_viewers=stream.viewer_count,
-            peak_viewers=stream.viewer_count,  # Ideally this would be tracked throughout the stream
-            average_watch_time=int(duration / max(1, stream.viewer_count)),
-            unique_viewers=stream.viewer_count,  # Ideally this would track unique IPs/users
-            live_stream_id=stream.id
-        )
-        db.session.add(analytics)
-    
-    # Create a system message in chat
-    system_message = ChatMessage(
-        message="Stream has ended",
-        is_system_message=True,
-        user_id=stream.user_id,
-        live_stream_id=stream.id
-    )
-    db.session.add(system_message)
-    
-    db.session.commit()
+    end_live_stream(stream)
     
     return jsonify({'success': True, 'message': 'Stream ended successfully'})
 
@@ -421,6 +396,15 @@ def get_chat(stream_id):
     })
 
 
+@live_bp.route('/api/heartbeat/<int:stream_id>', methods=['POST'])
+def viewer_heartbeat(stream_id):
+    """Heartbeat of a viewer page; touches shared memory only, never the database."""
+    data = request.get_json(silent=True) or request.form
+    if not heartbeat(stream_id, data.get('session'), leaving=bool(data.get('leaving')), identity=viewer_identity()):
+        return jsonify({'success': False, 'message': 'Invalid session'}), 400
+    return jsonify({'success': True, 'interval': VIEWER_HEARTBEAT_INTERVAL})
+
+
 @live_bp.route('/api/viewers/<int:stream_id>')
 def get_viewers(stream_id):
     """API endpoint to get current viewer count."""
@@ -429,65 +413,39 @@ def get_viewers(stream_id):
     
 @live_bp.route('/api/stream/check_status/<int:stream_id>')
 def check_stream_status(stream_id):
-    """Check if a stream is actually live by verifying the manifest file exists."""
-    stream = LiveStream.query.get_or_404(stream_id)
-    
-    # Get the HLS manifest URL - check different possible locations
-    possible_paths = [
-        f"/var/hls/{stream.stream_key}.m3u8",  # Default nginx-rtmp path
-        f"/var/www/hls/{stream.stream_key}.m3u8",  # Alternative nginx path
-        os.path.join(os.getcwd(), f"hls/{stream.stream_key}.m3u8"),  # Local development path
-        f"/hls/{stream.stream_key}.m3u8",  # Path relative to web root
-        f"/live/hls/{stream.stream_key}.m3u8",  # Additional path for /live/hls
-        f"/var/www/html/live/hls/{stream.stream_key}.m3u8",  # Common aapanel path
-        f"/home/wwwroot/default/live/hls/{stream.stream_key}.m3u8"  # Another common path
-    ]
-    
-    manifest_exists = False
-    for path in possible_paths:
-        if os.path.exists(path):
-            manifest_exists = True
-            break
-    
-    # Also attempt to directly check if the file is accessible via HTTP
-    if not manifest_exists:
-        try:
-            import urllib.request
-            import urllib.error
-            
-            # Try both HTTP and HTTPS
-            urls = [
-                f"http://hwosecurity.org/live/hls/{stream.stream_key}.m3u8",
-                f"https://hwosecurity.org/live/hls/{stream.stream_key}.m3u8"
-            ]
-            
-            for url in urls:
-                try:
-                    # Simple HEAD request with a timeout
-                    req = urllib.request.Request(url, method="HEAD")
-                    response = urllib.request.urlopen(req, timeout=2)
-                    if response.status == 200:
-                        manifest_exists = True
-                        break
-                except (urllib.error.URLError, urllib.error.HTTPError, TimeoutError):
-                    # File not accessible via this URL, try next one
-                    continue
-        except Exception as e:
-            # Log the error but continue
-            print(f"Error checking HTTP access to manifest: {str(e)}")
-    
-    is_actually_live = manifest_exists and stream.is_live
-    
-    # If it claims to be live but the file doesn't exist for more than 30 seconds, update the status
-    if stream.is_live and not manifest_exists:
-        # Just report the discrepancy for now
-        pass
+    """
+    Check if a stream is actually live, answered from in-memory state.
+
+    Live streams come from the snapshot the media worker pool refreshes
+    (which also checks the origin for streams ingested elsewhere) and HLS
+    state from the live state tracker, so a poll touches neither the
+    database nor the network. The database is only read while there is no
+    recent snapshot.
+    """
+    snapshot = read_live_status()
+    if snapshot is None:
+        stream = LiveStream.query.get_or_404(stream_id)
+        is_live, stream_key, origin_manifest = stream.is_live, stream.stream_key, None
+    else:
+        entry = snapshot.get(str(stream_id))
+        is_live = entry is not None
+        stream_key = entry['stream_key'] if entry else None
+        origin_manifest = entry['origin_manifest'] if entry else None
+    
+    state = {'manifest': False, 'segments': None, 'last_segment_at': None}
+    if stream_key:
+        state = get_live_state_tracker().state(stream_key)
+    manifest_exists = state['manifest'] or bool(origin_manifest)
+    is_actually_live = manifest_exists and is_live
+    last_segment_at = state['last_segment_at']
     
     return jsonify({
-        'is_live': stream.is_live,
+        'is_live': is_live,
         'has_manifest': manifest_exists,
         'status': 'active' if is_actually_live else 'inactive',
-        'stream_key': stream.stream_key,
+        'stream_key': stream_key,
+        'segment_count': state['segments'],
+        'last_segment_age': round(time.time() - last_segment_at, 1) if last_segment_at else None,
         'timestamp': time.time()
     })
 
@@ -527,7 +485,7 @@ def edit_stream(stream_id):
         if 'thumbnail' in request.files:
             thumbnail_file = request.files['thumbnail']
             if thumbnail_file and thumbnail_file.filename and allowed_file(thumbnail_file.filename):
-                file_path = save_uploaded_file(thumbnail_file, subfolder='thumbnails')
+                file_path = save_uploaded_file(thumbnail_file, subfolder='thumbnails').get('file_path')
                 if file_path:
                     # Remove old thumbnail if it exists
                     if stream.thumbnail_path:
@@ -542,7 +500,9 @@ def edit_stream(stream_id):
         bitrate = request.form.get('bitrate', '2500k')
         fps = request.form.get('fps', 30, type=int)
         
+        # Keep settings the form does not edit (type, archive, renditions)
         stream.stream_settings = {
+            **(stream.stream_settings or {}),
             'resolution': resolution,
             'bitrate': bitrate,
             'fps': fps,
@@ -575,6 +535,7 @@ def delete_stream(stream_id):
     
     # Delete associated analytics
     StreamAnalytics.query.filter_by(live_stream_id=stream_id).delete()
+    StreamMetricRollup.query.filter_by(live_stream_id=stream_id).delete()
     
     # Delete the stream
     db.session.delete(stream)
@@ -598,7 +559,22 @@ def stream_analytics(stream_id):
     # Get analytics for this stream
     analytics = StreamAnalytics.query.filter_by(live_stream_id=stream_id).all()
     
-    return render_template('live/analytics.html', stream=stream, analytics=analytics)
+    # Viewers, ingest bitrate and chat over the latest session, from minute or hour rollups
+    series = load_series(stream)
+    
+    # Session sketches are merged so viewers returning on several days count once
+    sketch = HyperLogLog()
+    unique_viewers = 0
+    for session in analytics:
+        session_sketch = (session.engagement_metrics or {}).get('viewer_sketch')
+        if session_sketch:
+            sketch.merge(HyperLogLog.from_json(session_sketch))
+        else:
+            unique_viewers += session.unique_viewers or 0  # Recorded before sketches were kept
+    unique_viewers += sketch.count()
+    
+    return render_template('live/analytics.html', stream=stream, analytics=analytics, series=series,
+                           unique_viewers=unique_viewers)
 
 
 @live_bp.route('/streaming-guide')
@@ -611,118 +587,95 @@ def streaming_guide():
 @live_bp.route('/live/hls/<path:filename>')  # Adding additional route for the /live/hls path
 def serve_hls(filename):
     """Serve HLS manifest files and segments."""
-    # Check different possible locations for HLS files
-    possible_paths = [
-        "/var/hls",  # Default nginx-rtmp path
-        "/var/www/hls",  # Alternative nginx path
-        os.path.join(os.getcwd(), "hls"),  # Local development path
-        "/var/www/html/live/hls",  # Common aapanel path
-        "/home/wwwroot/default/live/hls",  # Another common path
-    ]
-    
-    for base_path in possible_paths:
-        file_path = os.path.join(base_path, filename)
-        if os.path.exists(file_path):
-            # Determine content type based on file extension
-            ext = os.path.splitext(filename)[1].lower()
-            content_type = 'application/octet-stream'  # Default content type
+    # Resolved from the in-memory HLS index instead of probing every root
+    file_path = get_hls_index().resolve(filename)
+    if file_path:
+        # Determine content type based on file extension
+        ext = os.path.splitext(filename)[1].lower()
+        content_type = 'application/octet-stream'  # Default content type
+        
+        # HLS specific formats
+        if ext == '.m3u8':
+            content_type = 'application/vnd.apple.mpegurl'
+        elif ext == '.ts':
+            content_type = 'video/mp2t'
+        # Video formats
+        elif ext in ['.mp4', '.m4v', '.mov']:
+            content_type = 'video/mp4'
+        elif ext == '.webm':
+            content_type = 'video/webm'
+        elif ext == '.mkv':
+            content_type = 'video/x-matroska'
+        elif ext in ['.avi', '.divx']:
+            content_type = 'video/x-msvideo'
+        elif ext in ['.wmv', '.asf']:
+            content_type = 'video/x-ms-wmv'
+        elif ext in ['.flv', '.f4v']:
+            content_type = 'video/x-flv'
+        elif ext in ['.3gp', '.3g2']:
+            content_type = 'video/3gpp'
+        elif ext in ['.mpg', '.mpeg']:
+            content_type = 'video/mpeg'
+        # Audio formats
+        elif ext == '.mp3':
+            content_type = 'audio/mpeg'
+        elif ext == '.m4a':
+            content_type = 'audio/mp4'
+        elif ext == '.aac':
+            content_type = 'audio/aac'
+        elif ext == '.wav':
+            content_type = 'audio/wav'
+        elif ext == '.ogg':
+            content_type = 'audio/ogg'
+        elif ext == '.flac':
+            content_type = 'audio/flac'
+        elif ext in ['.wma', '.asf']:
+            content_type = 'audio/x-ms-wma'
+            
+        # Serve the file with appropriate headers, without reading it into memory
+        try:
+            # Set up CORS and caching headers
+            headers = {
+                'Content-Type': content_type,
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept',
+            }
             
-            # HLS specific formats
+            # Set appropriate cache control based on file type
             if ext == '.m3u8':
-                content_type = 'application/vnd.apple.mpegurl'
+                # Don't cache manifest files
+                headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+                headers['Pragma'] = 'no-cache'
+                headers['Expires'] = '0'
             elif ext == '.ts':
-                content_type = 'video/mp2t'
-            # Video formats
-            elif ext in ['.mp4', '.m4v', '.mov']:
-                content_type = 'video/mp4'
-            elif ext == '.webm':
-                content_type = 'video/webm'
-            elif ext == '.mkv':
-                content_type = 'video/x-matroska'
-            elif ext in ['.avi', '.divx']:
-                content_type = 'video/x-msvideo'
-            elif ext in ['.wmv', '.asf']:
-                content_type = 'video/x-ms-wmv'
-            elif ext in ['.flv', '.f4v']:
-                content_type = 'video/x-flv'
-            elif ext in ['.3gp', '.3g2']:
-                content_type = 'video/3gpp'
-            elif ext in ['.mpg', '.mpeg']:
-                content_type = 'video/mpeg'
-            # Audio formats
-            elif ext == '.mp3':
-                content_type = 'audio/mpeg'
-            elif ext == '.m4a':
-                content_type = 'audio/mp4'
-            elif ext == '.aac':
-                content_type = 'audio/aac'
-            elif ext == '.wav':
-                content_type = 'audio/wav'
-            elif ext == '.ogg':
-                content_type = 'audio/ogg'
-            elif ext == '.flac':
-                content_type = 'audio/flac'
-            elif ext in ['.wma', '.asf']:
-                content_type = 'audio/x-ms-wma'
-                
-            # Open and serve the file with appropriate headers
-            try:
-                with open(file_path, 'rb') as f:
-                    response = f.read()
-                
-                # Set up CORS and caching headers
-                headers = {
-                    'Content-Type': content_type,
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                    'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept',
-                }
-                
-                # Set appropriate cache control based on file type
-                if ext == '.m3u8':
-                    # Don't cache manifest files
-                    headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                    headers['Pragma'] = 'no-cache'
-                    headers['Expires'] = '0'
-                elif ext == '.ts':
-                    # Cache segments for a short time
-                    headers['Cache-Control'] = 'public, max-age=60'
-                else:
-                    # Cache other files more aggressively
-                    headers['Cache-Control'] = 'public, max-age=86400'
-                
-                return response, 200, headers
-            except Exception as e:
-                print(f"Error serving file {file_path}: {str(e)}")
-                continue
-    
-    # If file not found in any location, try to forward the request
-    try:
-        import urllib.request
-        import urllib.error
-        
-        # Try both possible external URLs
-        external_urls = [
-            f"https://hwosecurity.org/live/hls/{filename}",
-            f"http://hwosecurity.org/live/hls/{filename}"
-        ]
-        
-        for url in external_urls:
-            try:
-                with urllib.request.urlopen(url, timeout=3) as response:
-                    if response.status == 200:
-                        content = response.read()
-                        content_type = response.headers.get('Content-Type', 'application/octet-stream')
-                        
-                        return content, 200, {
-                            'Content-Type': content_type,
-                            'Access-Control-Allow-Origin': '*',
-                            'Cache-Control': 'no-cache'
-                        }
-            except Exception:
-                continue
-    except Exception as e:
-        print(f"Error trying to proxy file {filename}: {str(e)}")
+                # Cache segments for a short time
+                headers['Cache-Control'] = 'public, max-age=60'
+            else:
+                # Cache other files more aggressively
+                headers['Cache-Control'] = 'public, max-age=86400'
+            
+            if ext in ('.ts', '.m4s'):
+                return send_segment(file_path, stream_key_for(filename), mimetype=content_type, headers=headers)
+            return send_media_file(file_path, mimetype=content_type, headers=headers)
+        except Exception as e:
+            logger.error(f"Error serving file {file_path}: {str(e)}")
+    
+    # Not on this node: relay from the HLS origin (cached, one origin request per file)
+    relay = get_edge_relay()
+    relative = os.path.normpath(filename).replace(os.sep, '/')
+    if relay and not (relative.startswith('../') or relative == '..' or os.path.isabs(relative)):
+        relayed = relay.fetch(relative)
+        if relayed.status == 200:
+            if relative.endswith('.m3u8'):
+                cache_control = 'no-cache'
+            else:
+                cache_control = f'public, max-age={HLS_EDGE_SEGMENT_TTL}'
+            return relayed.body, 200, {
+                'Content-Type': relayed.content_type,
+                'Access-Control-Allow-Origin': '*',
+                'Cache-Control': cache_control
+            }
     
     # If file not found in any location and proxy failed
     return "Media file not found", 404
@@ -737,10 +690,7 @@ def embed_stream(stream_id):
     if not stream.is_public:
         return render_template('live/embed_error.html', message="This stream is private or not available")
     
-    # Increment viewer count if live
-    if stream.is_live:
-        stream.viewer_count += 1
-        db.session.commit()
+    # Viewers are counted from player heartbeats, see viewer_heartbeat
     
     # Get streamer info
     streamer = User.query.get(stream.user_id)
@@ -758,6 +708,7 @@ def embed_stream(stream_id):
                           show_info=show_info,
                           show_watermark=show_watermark,
                           show_viewers=show_viewers,
+                          heartbeat_interval=VIEWER_HEARTBEAT_INTERVAL,
                           theme=theme)
 
 
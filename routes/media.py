@@ -1,16 +1,33 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, send_from_directory
+from flask import (Blueprint, render_template, redirect, url_for, flash, request, jsonify, abort, current_app,
+                   make_response)
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import os
+import re
+import secrets
 import logging
-from models import Media, Category
+import mimetypes
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from models import Media, Category, UploadSession, UploadChunk
 from app import db
-from utils import save_uploaded_file, format_file_size, format_duration, get_file_type
-from ffmpeg_utils import get_media_info, generate_thumbnail
-from config import UPLOAD_FOLDER, ITEMS_PER_PAGE
+from utils import (save_uploaded_file, format_file_size, format_duration, get_file_type, delete_file,
+                   allowed_file, generate_unique_filename, write_stream_at, remove_generated_folder)
+from media_queue import enqueue_job
+from job_progress import read_progress, delete_progress
+from waveform import read_waveform_level
+from delivery import send_media_file
+from viewer_tracker import record_media_viewer, viewer_identity
+from config import (UPLOAD_FOLDER, ITEMS_PER_PAGE, INCOMING_FOLDER, CHUNKED_UPLOAD_CHUNK_SIZE, CHUNKED_UPLOAD_MAX_SIZE,
+                    JOB_PROGRESS_POLL_INTERVAL)
 
 logger = logging.getLogger(__name__)
 
+# The system tables often map .ts to something other than MPEG transport streams
+mimetypes.add_type('video/mp2t', '.ts')
+
 media_bp = Blueprint('media', __name__)
 
 @media_bp.route('/')
@@ -37,7 +54,77 @@ def dashboard():
         page=page, per_page=ITEMS_PER_PAGE
     )
     
-    return render_template('dashboard.html', media_items=user_media)
+    # Items still being processed are watched through the progress endpoint
+    processing_ids = [item.id for item in user_media.items if not item.is_processed]
+    progress_url = _progress_url(processing_ids) if processing_ids else None
+    
+    return render_template('dashboard.html', media_items=user_media, progress_url=progress_url,
+                           progress_interval=JOB_PROGRESS_POLL_INTERVAL)
+
+def _progress_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='media-progress')
+
+def _progress_url(media_ids):
+    """URL of the progress endpoint for media the current user may watch.
+    
+    The ids are signed into the URL, so the endpoint can answer without
+    looking up ownership in the database.
+    """
+    return url_for('media.processing_progress', token=_progress_serializer().dumps(list(media_ids)))
+
+@media_bp.route('/upload/progress')
+def processing_progress():
+    """Processing progress of the media items named in a signed token.
+    
+    Reads only the progress records written by the media workers and
+    answers repeated polls with 304 while nothing has changed. Every item
+    maps job types to their records; the page combines them.
+    """
+    try:
+        media_ids = _progress_serializer().loads(request.args.get('token', ''), max_age=86400)
+    except BadSignature:
+        abort(403)
+    
+    records, version = read_progress(media_ids)
+    response = jsonify({'items': {str(media_id): record for media_id, record in records.items()}})
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def create_media_record(file_path, original_filename, filename, title, description, category_id, is_public,
+                        content_hash=None):
+    """Create the Media row for a stored upload and queue its processing job.
+    
+    Probing and thumbnails run in the media workers, so the record starts out
+    unprocessed. Nothing is committed: the caller commits the record and its
+    job together with its own changes, or rolls back on errors.
+    """
+    new_media = Media(
+        title=title,
+        description=description,
+        filename=filename,
+        original_filename=original_filename,
+        file_path=file_path,
+        media_type=get_file_type(original_filename),
+        file_size=os.path.getsize(file_path),
+        format=filename.rsplit('.', 1)[-1],
+        content_hash=content_hash,
+        is_public=is_public,
+        is_processed=False,  # Set by the media worker once the pipeline finishes
+        user_id=current_user.id
+    )
+    
+    # Set category if provided
+    if category_id and str(category_id).isdigit():
+        category = Category.query.get(int(category_id))
+        if category:
+            new_media.category_id = category.id
+    
+    # Add to database and queue processing in the same transaction
+    db.session.add(new_media)
+    db.session.flush()
+    enqueue_job(new_media.id, 'process_media', commit=False)
+    return new_media
 
 @media_bp.route('/upload', methods=['GET', 'POST'])
 @login_required
@@ -68,70 +155,238 @@ def upload():
             return redirect(request.url)
         
         # Save the uploaded file
-        file_path = save_uploaded_file(file)
+        result = save_uploaded_file(file)
         
-        if not file_path:
+        if result.get('error'):
             flash('Error saving file. Please try again.', 'danger')
             return redirect(request.url)
         
-        # Extract original filename
-        original_filename = secure_filename(file.filename)
-        filename = os.path.basename(file_path)
-        media_type = get_file_type(original_filename)
-        
-        # Get media information using ffprobe
-        media_info = get_media_info(file_path)
-        
-        if not media_info:
-            flash('Failed to process media file', 'danger')
-            return redirect(request.url)
-        
-        # Create new media record
-        new_media = Media(
-            title=title,
-            description=description,
-            filename=filename,
-            original_filename=original_filename,
-            file_path=file_path,
-            media_type=media_type,
-            file_size=media_info['filesize'],
-            duration=media_info['duration'],
-            format=media_info['format'],
-            is_public=is_public,
-            is_processed=True,  # For simplicity, mark as processed right away
-            user_id=current_user.id
-        )
-        
-        # Set category if provided
-        if category_id and category_id.isdigit():
-            category = Category.query.get(int(category_id))
-            if category:
-                new_media.category_id = category.id
+        file_path = result['file_path']
         
         try:
-            # Add to database
-            db.session.add(new_media)
+            create_media_record(file_path, result['original_filename'], result['unique_filename'],
+                                title, description, category_id, is_public, result['content_hash'])
             db.session.commit()
             
-            # Generate thumbnail for video files
-            if new_media.media_type == 'video':
-                thumbnail_path = generate_thumbnail(file_path, new_media.id)
-                if thumbnail_path:
-                    new_media.thumbnail_path = thumbnail_path
-                    db.session.commit()
-            
-            flash('Media uploaded successfully', 'success')
+            flash('Media uploaded successfully. It will be available once processing finishes.', 'success')
             return redirect(url_for('media.dashboard'))
         
         except Exception as e:
             db.session.rollback()
+            delete_file(file_path)
             logger.error(f"Error saving media: {str(e)}")
             flash('An error occurred while saving media', 'danger')
             return redirect(request.url)
     
     # GET request - show upload form
     categories = Category.query.all()
-    return render_template('upload.html', categories=categories)
+    return render_template('upload.html', categories=categories, max_upload_size=CHUNKED_UPLOAD_MAX_SIZE)
+
+def _get_upload_session(session_id):
+    """Look up an upload session owned by the current user or abort with 404."""
+    upload_session = UploadSession.query.get_or_404(session_id)
+    if upload_session.user_id != current_user.id:
+        abort(404)
+    return upload_session
+
+def _upload_session_status(upload_session):
+    """Describe which chunks of an upload session have been received."""
+    received = {index for (index,) in upload_session.chunks.with_entities(UploadChunk.chunk_index)}
+    missing = [index for index in range(upload_session.chunk_count) if index not in received]
+    
+    # Offset of the first missing byte, for clients that upload sequentially
+    offset = upload_session.total_size if not missing else missing[0] * upload_session.chunk_size
+    
+    return {
+        'session_id': upload_session.id,
+        'status': upload_session.status,
+        'total_size': upload_session.total_size,
+        'chunk_size': upload_session.chunk_size,
+        'chunk_count': upload_session.chunk_count,
+        'offset': offset,
+        'missing_chunks': missing,
+        'media_id': upload_session.media_id
+    }
+
+@media_bp.route('/upload/sessions', methods=['POST'])
+@login_required
+def create_upload_session():
+    """Start a resumable chunked upload.
+    
+    The client sends the file name, size and form fields, then PUTs the file
+    in chunks (in any order, in parallel) and finally completes the session.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    total_size = data.get('size')
+    title = (data.get('title') or '').strip()
+    
+    if not filename or not allowed_file(filename):
+        return jsonify({'success': False, 'message': 'Invalid file type'}), 400
+    if not isinstance(total_size, int) or total_size <= 0:
+        return jsonify({'success': False, 'message': 'Invalid file size'}), 400
+    if total_size > CHUNKED_UPLOAD_MAX_SIZE:
+        return jsonify({'success': False, 'message': f'File exceeds the maximum size of {format_file_size(CHUNKED_UPLOAD_MAX_SIZE)}'}), 413
+    if not title:
+        return jsonify({'success': False, 'message': 'Title is required'}), 400
+    
+    original_filename = secure_filename(filename)
+    session_id = secrets.token_hex(16)
+    part_path = os.path.join(INCOMING_FOLDER, f"{session_id}.part")
+    
+    # Preallocate the (sparse) target file so chunks can be written at their offsets
+    os.makedirs(INCOMING_FOLDER, exist_ok=True)
+    with open(part_path, 'wb') as f:
+        f.truncate(total_size)
+    
+    upload_session = UploadSession(
+        id=session_id,
+        original_filename=original_filename,
+        unique_filename=generate_unique_filename(original_filename),
+        part_path=part_path,
+        total_size=total_size,
+        chunk_size=CHUNKED_UPLOAD_CHUNK_SIZE,
+        form_data={
+            'title': title,
+            'description': data.get('description', ''),
+            'category_id': data.get('category_id'),
+            'is_public': bool(data.get('is_public', True))
+        },
+        user_id=current_user.id
+    )
+    
+    try:
+        db.session.add(upload_session)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        delete_file(part_path)
+        logger.error(f"Error creating upload session: {str(e)}")
+        return jsonify({'success': False, 'message': 'Could not start upload'}), 500
+    
+    status = _upload_session_status(upload_session)
+    status['upload_url'] = url_for('media.upload_chunk', session_id=session_id)
+    return jsonify(status), 201
+
+@media_bp.route('/upload/sessions/<session_id>', methods=['GET'])
+@login_required
+def upload_session_status(session_id):
+    """Report the received chunks of an upload so the client can resume."""
+    return jsonify(_upload_session_status(_get_upload_session(session_id)))
+
+@media_bp.route('/upload/sessions/<session_id>', methods=['PUT'])
+@login_required
+def upload_chunk(session_id):
+    """Write one chunk, given by a `Content-Range: bytes start-end/total` header."""
+    upload_session = _get_upload_session(session_id)
+    
+    if upload_session.status != 'uploading':
+        return jsonify({'success': False, 'message': 'Upload is already complete'}), 409
+    
+    content_range = request.headers.get('Content-Range', '')
+    match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', content_range)
+    if not match:
+        return jsonify({'success': False, 'message': 'Missing or invalid Content-Range header'}), 400
+    
+    start, end, total = (int(value) for value in match.groups())
+    length = end - start + 1
+    index = start // upload_session.chunk_size
+    
+    # Chunks must line up with the session's chunk grid
+    if (total != upload_session.total_size or start % upload_session.chunk_size
+            or index >= upload_session.chunk_count or length != upload_session.chunk_length(index)):
+        return jsonify({'success': False, 'message': 'Content-Range does not match a chunk of this upload'}), 416
+    
+    try:
+        written = write_stream_at(request.stream, upload_session.part_path, start, length)
+    except FileNotFoundError:
+        # Completed or expired since the status check above
+        status = db.session.query(UploadSession.status).filter_by(id=upload_session.id).scalar()
+        if status is None:
+            return jsonify({'success': False, 'message': 'Upload session not found'}), 404
+        return jsonify({'success': False, 'message': 'Upload is already being completed'}), 409
+    if written != length:
+        return jsonify({'success': False, 'message': f'Incomplete chunk: received {written} of {length} bytes'}), 400
+    
+    # A retried chunk simply overwrites the same bytes; record it once
+    if not upload_session.chunks.filter_by(chunk_index=index).first():
+        try:
+            db.session.add(UploadChunk(upload_session_id=upload_session.id, chunk_index=index, size=length))
+            upload_session.updated_at = datetime.utcnow()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    
+    return jsonify({'success': True, 'chunk_index': index})
+
+@media_bp.route('/upload/sessions/<session_id>/complete', methods=['POST'])
+@login_required
+def complete_upload_session(session_id):
+    """Move a fully received upload into place and create its media record."""
+    upload_session = _get_upload_session(session_id)
+    
+    if upload_session.status == 'complete':
+        return jsonify({'success': True, 'media_id': upload_session.media_id,
+                        'progress_url': _progress_url([upload_session.media_id]),
+                        'progress_interval': JOB_PROGRESS_POLL_INTERVAL,
+                        'redirect': url_for('media.dashboard')})
+    
+    status = _upload_session_status(upload_session)
+    if status['missing_chunks']:
+        return jsonify(dict(status, success=False, message='Upload is missing chunks')), 409
+    
+    # Claim the session so a concurrent completion request does not assemble it too
+    claimed = UploadSession.query.filter_by(id=upload_session.id, status='uploading').update(
+        {'status': 'assembling'}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return jsonify({'success': False, 'message': 'Upload is already being completed'}), 409
+    
+    # The partial file lives on the same filesystem, so this rename is atomic
+    file_path = os.path.join(UPLOAD_FOLDER, upload_session.unique_filename)
+    try:
+        os.replace(upload_session.part_path, file_path)
+    except OSError as e:
+        UploadSession.query.filter_by(id=upload_session.id).update({'status': 'uploading'}, synchronize_session=False)
+        db.session.commit()
+        logger.error(f"Error completing upload session {session_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'An error occurred while saving media'}), 500
+    
+    form_data = upload_session.form_data or {}
+    try:
+        new_media = create_media_record(file_path, upload_session.original_filename, upload_session.unique_filename,
+                                        form_data.get('title'), form_data.get('description', ''),
+                                        form_data.get('category_id'), form_data.get('is_public', True))
+        upload_session.status = 'complete'
+        upload_session.media_id = new_media.id
+        upload_session.chunks.delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        os.replace(file_path, upload_session.part_path)
+        UploadSession.query.filter_by(id=upload_session.id).update({'status': 'uploading'}, synchronize_session=False)
+        db.session.commit()
+        logger.error(f"Error completing upload session {session_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'An error occurred while saving media'}), 500
+    
+    flash('Media uploaded successfully. It will be available once processing finishes.', 'success')
+    return jsonify({'success': True, 'media_id': new_media.id,
+                    'progress_url': _progress_url([new_media.id]),
+                    'progress_interval': JOB_PROGRESS_POLL_INTERVAL,
+                    'redirect': url_for('media.dashboard')})
+
+@media_bp.route('/upload/sessions/<session_id>', methods=['DELETE'])
+@login_required
+def abort_upload_session(session_id):
+    """Cancel an upload and discard the received chunks."""
+    upload_session = _get_upload_session(session_id)
+    
+    if upload_session.status != 'complete':
+        delete_file(upload_session.part_path)
+    db.session.delete(upload_session)
+    db.session.commit()
+    
+    return jsonify({'success': True})
 
 @media_bp.route('/watch/<int:media_id>')
 def watch(media_id):
@@ -146,16 +401,46 @@ def watch(media_id):
     # Increment view count
     media.views += 1
     db.session.commit()
+    # Unique viewers go to a shared sketch, merged into playback_stats by the media worker
+    record_media_viewer(media.id, viewer_identity())
     
     # Format media information for display
-    formatted_size = format_file_size(media.file_size)
-    formatted_duration = format_duration(media.duration)
+    formatted_size = format_file_size(media.file_size or 0)
+    formatted_duration = format_duration(media.duration or 0)
     
     return render_template('watch.html', 
                            media=media, 
                            formatted_size=formatted_size,
                            formatted_duration=formatted_duration)
 
+@media_bp.route('/media/<int:media_id>/waveform')
+def waveform(media_id):
+    """Precomputed waveform peaks of an audio item.
+    
+    The ?peaks= argument is the number of peaks the player wants to draw;
+    the closest stored level is returned as raw interleaved min/max values.
+    """
+    media = Media.query.get_or_404(media_id)
+    
+    if not media.is_public and (not current_user.is_authenticated or media.user_id != current_user.id):
+        abort(403)
+    
+    relative_path = (media.encoding_settings or {}).get('waveform')
+    if not relative_path:
+        abort(404)
+    
+    level = read_waveform_level(os.path.join(UPLOAD_FOLDER, relative_path), request.args.get('peaks', type=int))
+    if not level:
+        abort(404)
+    
+    response = make_response(level['data'])
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Cache-Control'] = ('public' if media.is_public else 'private') + ', max-age=86400'
+    response.headers['X-Waveform-Sample-Rate'] = str(level['sample_rate'])
+    response.headers['X-Waveform-Samples-Per-Peak'] = str(level['samples_per_peak'])
+    response.headers['X-Waveform-Bits'] = str(level['bits'])
+    return response
+
 @media_bp.route('/category/<int:category_id>')
 def category(category_id):
     """Browse media by category."""
@@ -172,8 +457,14 @@ def category(category_id):
 
 @media_bp.route('/media/<path:filename>')
 def serve_media(filename):
-    """Serve media files."""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """Serve media files, handing the transfer to the front-end server when it supports it."""
+    # Partial uploads, progress records and scheduler metrics live in dot folders and are not media
+    if any(part.startswith('.') for part in filename.replace('\\', '/').split('/')):
+        abort(404)
+    file_path = safe_join(UPLOAD_FOLDER, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    return send_media_file(file_path)
 
 @media_bp.route('/media/<int:media_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -232,6 +523,16 @@ def delete_media(media_id):
         if media.thumbnail_path and os.path.exists(media.thumbnail_path):
             os.remove(media.thumbnail_path)
         
+        # Delete the adaptive HLS ladder, storyboard and waveform if they were generated
+        encoding_settings = media.encoding_settings or {}
+        remove_generated_folder((encoding_settings.get('hls') or {}).get('master'))
+        remove_generated_folder(encoding_settings.get('storyboard'))
+        remove_generated_folder(encoding_settings.get('waveform'))
+        delete_progress(media.id)
+        
+        # Finished upload sessions still point at the media until they expire
+        UploadSession.query.filter_by(media_id=media.id).update({'media_id': None}, synchronize_session=False)
+        
         # Delete database record
         db.session.delete(media)
         db.session.commit()
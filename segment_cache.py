@@ -0,0 +1,172 @@
+"""
+Shared-memory cache of the newest live HLS segments.
+
+All gunicorn workers map the same file (in /dev/shm where available), so a
+segment read from disk by one worker is served from memory by the others.
+The file holds a table of fixed-size slots:
+
+    header: magic b'SLSC', version (u32), slot count (u32), slot size (u32),
+            access clock (u64)
+    table: per slot key (16 bytes, hash of the path), stream (8 bytes, hash
+           of the stream key), mtime_ns (i64), size (u32), state (u32),
+           last used (u64, value of the access clock)
+    data: slot count * slot size bytes
+
+Entries are keyed by path and mtime, so a rewritten file never serves stale
+bytes. Each stream keeps at most HLS_SEGMENT_CACHE_PER_STREAM segments,
+otherwise the least recently used slot is evicted; the byte budget is
+slot count * slot size. Table updates are serialised with flock().
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from config import (HLS_SEGMENT_CACHE_PATH, HLS_SEGMENT_CACHE_BYTES, HLS_SEGMENT_CACHE_SLOT_BYTES,
+                    HLS_SEGMENT_CACHE_PER_STREAM)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SLSC'
+VERSION = 1
+_HEADER = struct.Struct('<4sIIIQ')
+_ENTRY = struct.Struct('<16s8sqIIQ')
+
+EMPTY = 0
+READY = 1
+
+class SegmentCache:
+    """Slot cache in a memory-mapped file shared by every process that opens it."""
+
+    def __init__(self, path=HLS_SEGMENT_CACHE_PATH, budget=HLS_SEGMENT_CACHE_BYTES,
+                 slot_size=HLS_SEGMENT_CACHE_SLOT_BYTES, per_stream=HLS_SEGMENT_CACHE_PER_STREAM):
+        self.slot_size = slot_size
+        self.slot_count = max(1, budget // slot_size)
+        self.per_stream = per_stream
+        self.table_offset = _HEADER.size
+        self.data_offset = self.table_offset + _ENTRY.size * self.slot_count
+        # Data slots start on a page boundary
+        self.data_offset += (-self.data_offset) % mmap.PAGESIZE
+        size = self.data_offset + self.slot_count * slot_size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._thread_lock = threading.Lock()
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+            magic, version, slot_count, slot_size, clock = _HEADER.unpack_from(self._mm, 0)
+            if (magic, version, slot_count, slot_size) != (MAGIC, VERSION, self.slot_count, self.slot_size):
+                # New file or different settings: start empty
+                self._mm[:self.data_offset] = bytes(self.data_offset)
+                _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.slot_count, self.slot_size, 0)
+
+    @contextmanager
+    def _locked(self):
+        # flock excludes other processes, the thread lock other threads of this one
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _entry(self, slot):
+        return _ENTRY.unpack_from(self._mm, self.table_offset + slot * _ENTRY.size)
+
+    def _set_entry(self, slot, key, stream, mtime_ns, size, state, last_used):
+        _ENTRY.pack_into(self._mm, self.table_offset + slot * _ENTRY.size,
+                         key, stream, mtime_ns, size, state, last_used)
+
+    def _tick(self):
+        """Advance and return the shared access clock."""
+        magic, version, slot_count, slot_size, clock = _HEADER.unpack_from(self._mm, 0)
+        clock += 1
+        _HEADER.pack_into(self._mm, 0, magic, version, slot_count, slot_size, clock)
+        return clock
+
+    @staticmethod
+    def _hash(value, length):
+        return hashlib.blake2b(value.encode('utf-8', errors='surrogateescape'), digest_size=length).digest()
+
+    def get(self, path, mtime_ns):
+        """Cached bytes of a file at the given mtime, or None."""
+        key = self._hash(path, 16)
+        with self._locked():
+            for slot in range(self.slot_count):
+                entry_key, stream, entry_mtime, size, state, last_used = self._entry(slot)
+                if state != READY or entry_key != key:
+                    continue
+                if entry_mtime != mtime_ns:
+                    # The file was rewritten since it was cached
+                    self._set_entry(slot, bytes(16), bytes(8), 0, 0, EMPTY, 0)
+                    return None
+                self._set_entry(slot, entry_key, stream, entry_mtime, size, state, self._tick())
+                start = self.data_offset + slot * self.slot_size
+                return self._mm[start:start + size]
+        return None
+
+    def put(self, path, mtime_ns, data, stream_key):
+        """Store a file's bytes; files larger than a slot are not cached."""
+        if len(data) > self.slot_size:
+            return False
+
+        key = self._hash(path, 16)
+        stream = self._hash(stream_key, 8)
+        with self._locked():
+            entries = [self._entry(slot) for slot in range(self.slot_count)]
+            same_key = [slot for slot, entry in enumerate(entries) if entry[4] == READY and entry[0] == key]
+            same_stream = [slot for slot, entry in enumerate(entries) if entry[4] == READY and entry[1] == stream]
+            empty = [slot for slot, entry in enumerate(entries) if entry[4] != READY]
+
+            if same_key:
+                victim = same_key[0]
+            elif len(same_stream) >= self.per_stream:
+                # Only the newest segments of a stream are worth keeping
+                victim = min(same_stream, key=lambda slot: entries[slot][2])
+            elif empty:
+                victim = empty[0]
+            else:
+                victim = min(range(self.slot_count), key=lambda slot: entries[slot][5])
+
+            start = self.data_offset + victim * self.slot_size
+            self._mm[start:start + len(data)] = data
+            self._set_entry(victim, key, stream, mtime_ns, len(data), READY, self._tick())
+        return True
+
+    def stats(self):
+        """Number of cached segments and bytes in use."""
+        with self._locked():
+            entries = [self._entry(slot) for slot in range(self.slot_count)]
+        ready = [entry for entry in entries if entry[4] == READY]
+        return {
+            'segments': len(ready),
+            'bytes': sum(entry[3] for entry in ready),
+            'budget': self.slot_count * self.slot_size
+        }
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+def get_segment_cache():
+    """The segment cache opened by this process, or None if it cannot be used.
+
+    Opened per process, since flock() does not exclude processes that share
+    a file descriptor inherited over fork.
+    """
+    global _cache, _cache_pid
+    if _cache_pid != os.getpid():
+        with _cache_lock:
+            if _cache_pid != os.getpid():
+                try:
+                    _cache = SegmentCache()
+                except (OSError, ValueError) as e:
+                    logger.error(f"Segment cache unavailable: {str(e)}")
+                    _cache = None
+                _cache_pid = os.getpid()
+    return _cache
@@ -0,0 +1,53 @@
+// Sends viewer heartbeats for a live stream so the server can count concurrent viewers
+(function() {
+    function sessionId() {
+        const key = 'streamlite-viewer-session';
+        let id = null;
+        try {
+            id = sessionStorage.getItem(key);
+        } catch (e) {
+            // Storage may be blocked in embedded frames, fall back to a per-page id
+        }
+        if (!id) {
+            const bytes = new Uint8Array(16);
+            (window.crypto || window.msCrypto).getRandomValues(bytes);
+            id = Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+            try {
+                sessionStorage.setItem(key, id);
+            } catch (e) {
+                // Ignore, the id lives as long as the page
+            }
+        }
+        return id;
+    }
+
+    function start(url, intervalSeconds) {
+        const session = sessionId();
+        let interval = (intervalSeconds || 15) * 1000;
+
+        function beat() {
+            fetch(url, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({session: session}),
+                keepalive: true
+            })
+                .then(response => response.ok ? response.json() : null)
+                .then(data => {
+                    if (data && data.interval) interval = data.interval * 1000;
+                })
+                .catch(() => {})
+                .then(() => setTimeout(beat, interval));
+        }
+
+        // Tell the server right away when the viewer leaves
+        window.addEventListener('pagehide', function() {
+            const body = new Blob([JSON.stringify({session: session, leaving: true})], {type: 'application/json'});
+            if (navigator.sendBeacon) navigator.sendBeacon(url, body);
+        });
+
+        beat();
+    }
+
+    window.StreamLiteHeartbeat = {start: start};
+})();
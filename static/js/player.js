@@ -118,6 +118,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
             }
         });
+        
+        // Seek previews from the storyboard sprite sheets
+        if (videoElement.dataset.storyboard) {
+            loadStoryboard(player, videoElement.dataset.storyboard);
+        }
     }
     
     // Audio player initialization
@@ -158,6 +163,11 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
         
+        // Waveform drawn from precomputed peaks
+        if (audioElement.dataset.waveform) {
+            loadWaveform(player, audioElement.dataset.waveform);
+        }
+        
         // Resume playback from saved position if available
         const mediaId = audioElement.dataset.mediaId;
         if (mediaId) {
@@ -237,3 +247,161 @@ document.addEventListener('DOMContentLoaded', function() {
         if (audioElement) audioElement.dataset.mediaId = mediaId;
     }
 });
+
+// Parse a WebVTT storyboard into cues of {start, end, url, x, y, w, h}
+function parseStoryboard(text, baseUrl) {
+    const cues = [];
+    const blocks = text.replace(/\r/g, '').split('\n\n');
+    
+    function toSeconds(timestamp) {
+        const parts = timestamp.trim().split(':').map(parseFloat);
+        return parts.reduce((total, part) => total * 60 + part, 0);
+    }
+    
+    blocks.forEach(function(block) {
+        const lines = block.trim().split('\n');
+        const timingIndex = lines.findIndex(line => line.includes('-->'));
+        if (timingIndex === -1 || !lines[timingIndex + 1]) return;
+        
+        const times = lines[timingIndex].split('-->');
+        const target = lines[timingIndex + 1].trim();
+        const match = target.match(/^(.*)#xywh=(\d+),(\d+),(\d+),(\d+)$/);
+        if (!match) return;
+        
+        cues.push({
+            start: toSeconds(times[0]),
+            end: toSeconds(times[1]),
+            url: new URL(match[1], baseUrl).href,
+            x: parseInt(match[2], 10),
+            y: parseInt(match[3], 10),
+            w: parseInt(match[4], 10),
+            h: parseInt(match[5], 10)
+        });
+    });
+    
+    return cues;
+}
+
+// Show a sprite-sheet frame above the progress bar while hovering it
+function loadStoryboard(player, vttUrl) {
+    const baseUrl = new URL(vttUrl, window.location.href).href;
+    
+    fetch(baseUrl).then(response => response.ok ? response.text() : Promise.reject(response.status)).then(function(text) {
+        const cues = parseStoryboard(text, baseUrl);
+        if (!cues.length) return;
+        
+        const progressControl = player.el().querySelector('.vjs-progress-control');
+        if (!progressControl) return;
+        
+        const preview = document.createElement('div');
+        preview.className = 'storyboard-preview';
+        preview.style.cssText = 'position:absolute;bottom:100%;display:none;pointer-events:none;' +
+            'border:2px solid #fff;border-radius:2px;background-repeat:no-repeat;z-index:2;';
+        progressControl.style.position = 'relative';
+        progressControl.appendChild(preview);
+        
+        // Sheets are fetched once by the browser and reused for every hover
+        [...new Set(cues.map(cue => cue.url))].forEach(url => { new Image().src = url; });
+        
+        function findCue(time) {
+            let low = 0;
+            let high = cues.length - 1;
+            while (low < high) {
+                const mid = (low + high + 1) >> 1;
+                if (cues[mid].start <= time) low = mid; else high = mid - 1;
+            }
+            return cues[low];
+        }
+        
+        progressControl.addEventListener('mousemove', function(event) {
+            const duration = player.duration();
+            if (!duration) return;
+            
+            const rect = progressControl.getBoundingClientRect();
+            const fraction = Math.min(1, Math.max(0, (event.clientX - rect.left) / rect.width));
+            const cue = findCue(fraction * duration);
+            
+            preview.style.width = cue.w + 'px';
+            preview.style.height = cue.h + 'px';
+            preview.style.backgroundImage = 'url("' + cue.url + '")';
+            preview.style.backgroundPosition = '-' + cue.x + 'px -' + cue.y + 'px';
+            preview.style.left = Math.min(Math.max(0, event.clientX - rect.left - cue.w / 2), rect.width - cue.w) + 'px';
+            preview.style.display = 'block';
+        });
+        
+        progressControl.addEventListener('mouseleave', function() {
+            preview.style.display = 'none';
+        });
+    }).catch(function(error) {
+        console.log('Storyboard not available: ' + error);
+    });
+}
+
+// Draw the precomputed waveform above the audio player; clicking it seeks
+function loadWaveform(player, waveformUrl) {
+    const container = player.el().parentNode;
+    const canvas = document.createElement('canvas');
+    canvas.className = 'waveform mb-3';
+    canvas.style.cssText = 'width:100%;height:96px;display:block;cursor:pointer;';
+    container.insertBefore(canvas, player.el());
+    
+    const ratio = window.devicePixelRatio || 1;
+    const width = Math.max(1, Math.floor(canvas.clientWidth * ratio));
+    const height = Math.floor(96 * ratio);
+    canvas.width = width;
+    canvas.height = height;
+    
+    const url = new URL(waveformUrl, window.location.href);
+    url.searchParams.set('peaks', width);
+    
+    fetch(url).then(function(response) {
+        if (!response.ok) return Promise.reject(response.status);
+        const bits = parseInt(response.headers.get('X-Waveform-Bits'), 10) || 8;
+        return response.arrayBuffer().then(buffer => bits === 16 ? new Int16Array(buffer) : new Int8Array(buffer));
+    }).then(function(values) {
+        const peakCount = values.length / 2;
+        if (!peakCount) return;
+        const scale = values instanceof Int16Array ? 32768 : 128;
+        
+        // Reduce the stored level to one min/max pair per canvas column
+        const columns = [];
+        for (let x = 0; x < width; x++) {
+            const first = Math.floor(x * peakCount / width);
+            const last = Math.max(first + 1, Math.floor((x + 1) * peakCount / width));
+            let min = 0;
+            let max = 0;
+            for (let i = first; i < last && i < peakCount; i++) {
+                min = Math.min(min, values[i * 2]);
+                max = Math.max(max, values[i * 2 + 1]);
+            }
+            columns.push([min / scale, max / scale]);
+        }
+        
+        const context = canvas.getContext('2d');
+        function draw() {
+            const duration = player.duration();
+            const played = duration ? player.currentTime() / duration * width : 0;
+            context.clearRect(0, 0, width, height);
+            columns.forEach(function(column, x) {
+                const top = (1 - column[1]) * height / 2;
+                const bottom = (1 - column[0]) * height / 2;
+                context.fillStyle = x < played ? '#0d6efd' : '#6c757d';
+                context.fillRect(x, top, 1, Math.max(1, bottom - top));
+            });
+        }
+        
+        draw();
+        player.on('timeupdate', draw);
+        player.on('loadedmetadata', draw);
+        
+        canvas.addEventListener('click', function(event) {
+            const duration = player.duration();
+            if (!duration) return;
+            const rect = canvas.getBoundingClientRect();
+            player.currentTime((event.clientX - rect.left) / rect.width * duration);
+            draw();
+        });
+    }).catch(function(error) {
+        console.log('Waveform not available: ' + error);
+    });
+}
@@ -0,0 +1,115 @@
+// Polls the processing progress endpoint for media items that are still being processed
+(function() {
+    const STAGE_LABELS = {
+        queued: 'Queued',
+        starting: 'Starting',
+        probe: 'Analyzing',
+        scan: 'Checking file',
+        thumbnail: 'Creating thumbnail',
+        storyboard: 'Creating previews',
+        waveform: 'Creating waveform',
+        encode: 'Encoding',
+        finished: 'Finished'
+    };
+
+    function formatEta(seconds) {
+        if (seconds === null || seconds === undefined) return '';
+        if (seconds < 60) return seconds + 's left';
+        return Math.floor(seconds / 60) + 'm ' + (seconds % 60) + 's left';
+    }
+
+    // Human readable summary of a progress record
+    function describeProgress(record) {
+        if (record.status === 'failed') return 'Processing failed';
+        if (record.status === 'retrying') return 'Retrying';
+        let text = STAGE_LABELS[record.stage] || record.stage;
+        if (record.status === 'running' && record.percent) {
+            text += ' ' + Math.floor(record.percent) + '%';
+            if (record.speed) text += ' (' + record.speed.toFixed(1) + 'x';
+            if (record.eta !== null && record.eta !== undefined) text += (record.speed ? ', ' : ' (') + formatEta(record.eta);
+            if (record.speed || (record.eta !== null && record.eta !== undefined)) text += ')';
+        }
+        return text;
+    }
+
+    const QUEUED = { status: 'pending', stage: 'queued', percent: 0 };
+
+    // The first job of an upload publishes it; later jobs (previews, HLS) run in the background
+    function isPublished(jobs) {
+        return !!jobs.process_media && jobs.process_media.status === 'done';
+    }
+
+    // One record to show for the jobs of a media item (records keyed by job type):
+    // the first job until the item is published, then a job that is still busy
+    function summarize(jobs) {
+        if (!isPublished(jobs)) return jobs.process_media || QUEUED;
+        let summary = jobs.process_media;
+        for (const jobType in jobs) {
+            const record = jobs[jobType];
+            if (record.status === 'running') return record;
+            if (record.status === 'retrying') summary = record;
+        }
+        return summary;
+    }
+
+    // Calls onUpdate(items) after every poll until it returns false
+    function watchProcessingProgress(url, interval, onUpdate) {
+        let timer = null;
+        let stopped = false;
+
+        function poll() {
+            fetch(url, { credentials: 'same-origin', cache: 'no-cache' })
+                .then(response => response.ok ? response.json() : Promise.reject(new Error(response.status)))
+                .then(function(data) {
+                    if (onUpdate(data.items) === false) stopped = true;
+                })
+                .catch(function(error) {
+                    console.error('Progress poll failed:', error);
+                })
+                .finally(function() {
+                    if (!stopped) timer = setTimeout(poll, interval);
+                });
+        }
+
+        poll();
+        return function stop() {
+            stopped = true;
+            clearTimeout(timer);
+        };
+    }
+
+    window.StreamLiteProgress = {
+        watch: watchProcessingProgress,
+        describe: describeProgress,
+        summarize: summarize,
+        isPublished: isPublished
+    };
+
+    // Dashboard: keep the "Processing" badges up to date
+    document.addEventListener('DOMContentLoaded', function() {
+        const container = document.querySelector('[data-progress-url]');
+        if (!container) return;
+
+        const interval = parseInt(container.dataset.progressInterval, 10) || 2000;
+        watchProcessingProgress(container.dataset.progressUrl, interval, function(items) {
+            let remaining = 0;
+            for (const mediaId in items) {
+                const badge = container.querySelector('[data-processing-badge="' + mediaId + '"]');
+                if (!badge) continue;
+                const jobs = items[mediaId];
+                const record = summarize(jobs);
+                if (isPublished(jobs)) {
+                    badge.className = 'badge bg-success';
+                    badge.textContent = 'Ready';
+                } else if (record.status === 'failed') {
+                    badge.className = 'badge bg-danger';
+                    badge.textContent = describeProgress(record);
+                } else {
+                    badge.textContent = describeProgress(record);
+                    remaining++;
+                }
+            }
+            return remaining > 0;
+        });
+    });
+})();
@@ -3,61 +3,249 @@ document.addEventListener('DOMContentLoaded', function() {
     const uploadButton = document.getElementById('uploadButton');
     const uploadProgress = document.getElementById('uploadProgress');
     const progressBar = uploadProgress.querySelector('.progress-bar');
-    
+    const processingStatus = document.getElementById('processingStatus');
+
+    // Chunked upload settings
+    const PARALLEL_CHUNKS = 4;     // Chunks in flight at the same time
+    const MAX_CHUNK_RETRIES = 5;   // Attempts per chunk before giving up
+
+    function setProgress(percent) {
+        percent = Math.min(100, Math.max(0, percent));
+        progressBar.style.width = percent + '%';
+        progressBar.setAttribute('aria-valuenow', percent);
+        progressBar.textContent = Math.floor(percent) + '%';
+    }
+
+    function resetButton() {
+        uploadButton.disabled = false;
+        uploadButton.innerHTML = '<i class="fas fa-upload me-2"></i> Upload';
+    }
+
+    // Follow server-side processing of the new upload until it is published
+    function watchProcessing(result) {
+        return new Promise(function(resolve) {
+            if (!result.progress_url || !window.StreamLiteProgress) {
+                resolve();
+                return;
+            }
+
+            uploadButton.innerHTML = '<i class="fas fa-spinner fa-spin me-2"></i> Processing...';
+            processingStatus.classList.remove('d-none');
+            setProgress(0);
+
+            StreamLiteProgress.watch(result.progress_url, result.progress_interval || 2000, function(items) {
+                const jobs = items[String(result.media_id)];
+                if (!jobs) return true;
+
+                const record = StreamLiteProgress.summarize(jobs);
+                processingStatus.textContent = StreamLiteProgress.describe(record);
+                setProgress(record.percent || 0);
+
+                if (StreamLiteProgress.isPublished(jobs) || record.status === 'failed') {
+                    resolve();
+                    return false;
+                }
+                return true;
+            });
+        });
+    }
+
+    // Key used to remember an unfinished upload session for the same file
+    function resumeKey(file) {
+        return 'uploadSession-' + file.name + '-' + file.size + '-' + file.lastModified;
+    }
+
+    async function jsonRequest(method, url, body) {
+        const response = await fetch(url, {
+            method: method,
+            headers: { 'Content-Type': 'application/json' },
+            body: body ? JSON.stringify(body) : undefined,
+            credentials: 'same-origin'
+        });
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            const error = new Error(data.message || ('Request failed with status ' + response.status));
+            error.status = response.status;
+            throw error;
+        }
+        return data;
+    }
+
+    // PUT a single chunk, reporting bytes sent so far through onProgress
+    function putChunk(url, blob, start, totalSize, onProgress) {
+        return new Promise(function(resolve, reject) {
+            const xhr = new XMLHttpRequest();
+            xhr.open('PUT', url);
+            xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+            xhr.setRequestHeader('Content-Range', 'bytes ' + start + '-' + (start + blob.size - 1) + '/' + totalSize);
+            xhr.upload.onprogress = function(e) {
+                if (e.lengthComputable) onProgress(e.loaded);
+            };
+            xhr.onload = function() {
+                if (xhr.status >= 200 && xhr.status < 300) {
+                    resolve();
+                } else {
+                    const error = new Error('Chunk upload failed with status ' + xhr.status);
+                    error.status = xhr.status;
+                    reject(error);
+                }
+            };
+            xhr.onerror = function() { reject(new Error('Network error')); };
+            xhr.send(blob);
+        });
+    }
+
+    async function putChunkWithRetry(url, blob, start, totalSize, onProgress) {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                return await putChunk(url, blob, start, totalSize, onProgress);
+            } catch (error) {
+                onProgress(0);
+                // Client errors other than timeouts will not succeed on retry
+                const retryable = !error.status || error.status >= 500 || error.status === 408 || error.status === 429;
+                if (!retryable || attempt >= MAX_CHUNK_RETRIES) throw error;
+                // Exponential backoff: 1s, 2s, 4s, ...
+                await new Promise(resolve => setTimeout(resolve, 1000 * Math.pow(2, attempt - 1)));
+            }
+        }
+    }
+
+    async function chunkedUpload(file, fields) {
+        const sessionsUrl = uploadForm.dataset.sessionsUrl;
+        const key = resumeKey(file);
+        let session = null;
+
+        // Resume a previous session for this file if the server still has it
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            try {
+                session = await jsonRequest('GET', sessionsUrl + '/' + savedId);
+                session.upload_url = sessionsUrl + '/' + savedId;
+                if (session.status !== 'uploading') session = null;
+            } catch (error) {
+                session = null;
+            }
+        }
+
+        if (!session) {
+            session = await jsonRequest('POST', sessionsUrl, Object.assign({
+                filename: file.name,
+                size: file.size
+            }, fields));
+            localStorage.setItem(key, session.session_id);
+        }
+
+        // Bytes already on the server plus bytes in flight per chunk
+        const pending = session.missing_chunks.slice();
+        const inFlight = {};
+        let completedBytes = file.size - pending.reduce(function(sum, index) {
+            return sum + Math.min(session.chunk_size, file.size - index * session.chunk_size);
+        }, 0);
+
+        function updateProgress() {
+            let sent = completedBytes;
+            for (const index in inFlight) sent += inFlight[index];
+            setProgress(sent / file.size * 100);
+        }
+        updateProgress();
+
+        async function worker() {
+            while (pending.length) {
+                const index = pending.shift();
+                const start = index * session.chunk_size;
+                const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+
+                await putChunkWithRetry(session.upload_url, blob, start, file.size, function(loaded) {
+                    inFlight[index] = loaded;
+                    updateProgress();
+                });
+
+                delete inFlight[index];
+                completedBytes += blob.size;
+                updateProgress();
+            }
+        }
+
+        const workers = [];
+        for (let i = 0; i < PARALLEL_CHUNKS; i++) workers.push(worker());
+        await Promise.all(workers);
+
+        uploadButton.innerHTML = '<i class="fas fa-spinner fa-spin me-2"></i> Finalizing...';
+        const result = await jsonRequest('POST', session.upload_url + '/complete');
+        localStorage.removeItem(key);
+        return result;
+    }
+
     if (uploadForm) {
         uploadForm.addEventListener('submit', function(e) {
             const fileInput = document.getElementById('media_file');
             const titleInput = document.getElementById('title');
-            
+
             // Basic validation
             if (!fileInput.files.length) {
                 e.preventDefault();
                 alert('Please select a file to upload');
                 return;
             }
-            
+
             if (!titleInput.value.trim()) {
                 e.preventDefault();
                 alert('Please enter a title');
                 return;
             }
-            
-            // File size validation (max 1GB)
-            const maxSize = 1024 * 1024 * 1024; // 1GB in bytes
-            const fileSize = fileInput.files[0].size;
-            
-            if (fileSize > maxSize) {
+
+            const file = fileInput.files[0];
+            const chunkedSupported = uploadForm.dataset.sessionsUrl && window.fetch && file.slice;
+
+            // File size validation
+            const maxSize = chunkedSupported ? parseInt(uploadForm.dataset.maxChunkedSize, 10) : 1024 * 1024 * 1024;
+
+            if (file.size > maxSize) {
                 e.preventDefault();
-                alert('File size exceeds the maximum allowed size (1GB)');
+                alert('File size exceeds the maximum allowed size');
                 return;
             }
-            
+
             // Show progress bar for visual feedback
             uploadProgress.classList.remove('d-none');
             uploadButton.disabled = true;
             uploadButton.innerHTML = '<i class="fas fa-spinner fa-spin me-2"></i> Uploading...';
-            
-            // Simulate progress (since we don't have XHR upload)
-            let progress = 0;
-            const interval = setInterval(function() {
-                progress += Math.random() * 10;
-                if (progress > 95) {
-                    clearInterval(interval);
-                    progress = 95; // Cap at 95% until the form actually submits
-                }
-                progressBar.style.width = progress + '%';
-                progressBar.setAttribute('aria-valuenow', progress);
-            }, 500);
+
+            if (!chunkedSupported) {
+                // Plain form submission, the browser shows its own progress
+                return;
+            }
+
+            e.preventDefault();
+
+            const categoryInput = document.getElementById('category_id');
+            const fields = {
+                title: titleInput.value.trim(),
+                description: document.getElementById('description').value,
+                category_id: categoryInput.value || null,
+                is_public: document.getElementById('is_public').checked
+            };
+
+            chunkedUpload(file, fields).then(function(result) {
+                setProgress(100);
+                return watchProcessing(result).then(function() {
+                    window.location.href = result.redirect;
+                });
+            }).catch(function(error) {
+                console.error('Chunked upload failed:', error);
+                alert('Upload interrupted: ' + error.message + '. Submit again to resume where it stopped.');
+                resetButton();
+            });
         });
     }
-    
+
     // File input change handler to show selected filename
     const fileInput = document.getElementById('media_file');
     if (fileInput) {
         fileInput.addEventListener('change', function() {
             const fileName = this.files[0]?.name;
             const fileSize = this.files[0]?.size;
-            
+
             if (fileName) {
                 // Format file size
                 let formattedSize;
@@ -68,7 +256,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 } else {
                     formattedSize = (fileSize / (1024 * 1024 * 1024)).toFixed(2) + ' GB';
                 }
-                
+
                 // Set custom text for the file input
                 const small = fileInput.nextElementSibling;
                 small.innerHTML = `Selected: <strong>${fileName}</strong> (${formattedSize})`;
@@ -0,0 +1,367 @@
+"""
+CPU budget for ffmpeg processes.
+
+Every ffmpeg process started by the media workers has to be admitted by the
+scheduler first. Admission hands out encoder threads from a budget shared
+by all worker processes, so transcodes never use more cores than
+TRANSCODE_CPU_BUDGET and the rest stay free for the web workers. Jobs wait
+in priority lanes (see TRANSCODE_LANES); a lane is served ahead of the lanes
+below it, except that TRANSCODE_LOWER_LANE_RESERVE of the budget stays
+available to the lanes below one with work waiting.
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from config import (
+    TRANSCODE_CPU_BUDGET, TRANSCODE_LANES, TRANSCODE_LOWER_LANE_RESERVE, SCHEDULER_METRICS_PATH, SCHEDULER_LOCK_PATH
+)
+
+logger = logging.getLogger(__name__)
+
+# Cumulative per-lane counters kept in shared memory
+_LANE_FIELDS = ('admitted', 'wait_seconds', 'max_wait_seconds')
+# Every waiting or admitted process holds a grant slot: (pid, lane index, threads; 0 while waiting)
+_GRANT_FIELDS = 3
+GRANT_SLOTS = 256
+# Seconds between admission checks of a waiting process
+ADMIT_POLL_INTERVAL = 0.2
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by another user
+    return True
+
+class CpuScheduler:
+    """
+    Thread budget shared between processes.
+
+    Create it in the parent process and pass it to the worker processes
+    as a Process argument; all state lives in shared memory. Grants are
+    recorded with the pid holding them, so reclaim() can hand back the
+    threads of a worker that died, and updates are serialised with flock()
+    rather than a multiprocessing lock, which a process killed while
+    holding it would never release.
+    """
+
+    def __init__(self, budget=TRANSCODE_CPU_BUDGET, lanes=None, ctx=None, lock_path=SCHEDULER_LOCK_PATH,
+                 lower_lane_reserve=TRANSCODE_LOWER_LANE_RESERVE):
+        ctx = ctx or multiprocessing.get_context('spawn')
+        self.budget = max(1, int(budget))
+        self.lanes = dict(lanes or TRANSCODE_LANES)
+        self.lane_names = list(self.lanes)
+        # Threads the lanes below a lane can always get, even while it has work waiting
+        self.reserve = int(self.budget * lower_lane_reserve)
+        self.lock_path = lock_path
+        self._counters = ctx.Array('d', len(self.lane_names) * len(_LANE_FIELDS), lock=False)
+        self._grants = ctx.Array('d', GRANT_SLOTS * _GRANT_FIELDS, lock=False)
+        self._lock_fd = None
+        self._lock_pid = None
+        self._thread_lock = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Opened again by each process, an flock is per open file
+        state.update(_lock_fd=None, _lock_pid=None, _thread_lock=None)
+        return state
+
+    @contextmanager
+    def _locked(self):
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_pid = os.getpid()
+            self._thread_lock = threading.Lock()
+        # flock excludes other processes, the thread lock other threads of this one
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _slot(self, lane_index, field):
+        return lane_index * len(_LANE_FIELDS) + _LANE_FIELDS.index(field)
+
+    def _add(self, lane_index, field, value):
+        self._counters[self._slot(lane_index, field)] += value
+
+    def _grant(self, slot):
+        offset = slot * _GRANT_FIELDS
+        return int(self._grants[offset]), int(self._grants[offset + 1]), int(self._grants[offset + 2])
+
+    def _set_grant(self, slot, pid, lane_index, threads):
+        offset = slot * _GRANT_FIELDS
+        self._grants[offset:offset + _GRANT_FIELDS] = [pid, lane_index, threads]
+
+    def _find_grant(self, pid, lane_index, threads):
+        """Slot holding a grant, or a free slot for (0, 0, 0); None if there is none."""
+        for slot in range(GRANT_SLOTS):
+            if self._grant(slot) == (pid, lane_index, threads):
+                return slot
+        return None
+
+    def _available(self):
+        return self.budget - sum(self._grant(slot)[2] for slot in range(GRANT_SLOTS))
+
+    def _lanes_waiting(self, lane_index):
+        """
+        Work waiting around a lane, as (highest lane above it with work
+        waiting or None, whether a lane below it has work waiting).
+        """
+        higher = None
+        lower = False
+        for slot in range(GRANT_SLOTS):
+            pid, index, threads = self._grant(slot)
+            if pid and not threads:
+                if index < lane_index:
+                    higher = index if higher is None else min(higher, index)
+                lower = lower or index > lane_index
+        return higher, lower
+
+    def _held_below(self, lane_index):
+        """Threads held by the lanes below a lane."""
+        return sum(threads for pid, index, threads in map(self._grant, range(GRANT_SLOTS))
+                   if pid and index > lane_index)
+
+    def _take(self, slot, lane_index, wanted):
+        """Grant threads to a waiting slot if the lane may start now; returns the threads granted or 0."""
+        available = self._available()
+        higher, lower = self._lanes_waiting(lane_index)
+        if higher is not None:
+            # Only the reserve of the lanes below the waiting one is left to this lane
+            available = min(available, self.reserve - self._held_below(higher))
+        if lower:
+            # Leave the reserve of the lanes below this one free for them
+            available -= max(0, self.reserve - self._held_below(lane_index))
+        if available < 1:
+            return 0
+        granted = int(min(wanted, available))
+        self._set_grant(slot, os.getpid(), lane_index, granted)
+        self._add(lane_index, 'admitted', 1)
+        return granted
+
+    def _wanted(self, index, threads):
+        return max(1, min(threads or self.lanes[self.lane_names[index]]['threads'], self.budget))
+
+    def lane_index(self, lane):
+        """Position of a lane, unknown lanes queue behind all others."""
+        if lane in self.lanes:
+            return self.lane_names.index(lane)
+        return len(self.lane_names) - 1
+
+    @contextmanager
+    def admit(self, lane, threads=None, cancel_event=None):
+        """
+        Wait until the lane may start a process and reserve threads for it.
+
+        Yields the number of threads granted (at most the requested or lane
+        default number, fewer when the budget is nearly used up), or 0 when
+        cancel_event was set while waiting.
+        """
+        index = self.lane_index(lane)
+        wanted = self._wanted(index, threads)
+        pid = os.getpid()
+        slot = None
+        granted = 0
+        started = time.time()
+
+        try:
+            while True:
+                with self._locked():
+                    if slot is None:
+                        slot = self._find_grant(0, 0, 0)
+                        if slot is not None:
+                            self._set_grant(slot, pid, index, 0)
+                    if slot is not None:
+                        granted = self._take(slot, index, wanted)
+                        if granted:
+                            waited = time.time() - started
+                            self._add(index, 'wait_seconds', waited)
+                            counter = self._slot(index, 'max_wait_seconds')
+                            self._counters[counter] = max(self._counters[counter], waited)
+                            break
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                time.sleep(ADMIT_POLL_INTERVAL)
+
+            yield granted
+        finally:
+            if slot is not None:
+                with self._locked():
+                    self._set_grant(slot, 0, 0, 0)
+
+    def try_admit(self, lane, threads=None, queued=False):
+        """
+        Reserve threads for a long-running process without blocking.
+
+        For processes that outlive a single call, like live encoders. While
+        the budget is used up the caller is counted as waiting in the lane,
+        so lower lanes do not take the threads freed meanwhile, until it
+        calls again with queued=True or calls cancel_queued().
+
+        Returns:
+            Number of threads granted, to be handed back with release(), or
+            0 if the caller is now queued
+        """
+        index = self.lane_index(lane)
+        pid = os.getpid()
+        with self._locked():
+            slot = self._find_grant(pid, index, 0) if queued else None
+            if slot is None:
+                slot = self._find_grant(0, 0, 0)
+                if slot is None:
+                    return 0  # Every slot taken, try again later
+                self._set_grant(slot, pid, index, 0)
+            granted = self._take(slot, index, self._wanted(index, threads))
+            return granted
+
+    def cancel_queued(self, lane):
+        """Leave the queue joined by a try_admit() that returned 0."""
+        with self._locked():
+            slot = self._find_grant(os.getpid(), self.lane_index(lane), 0)
+            if slot is not None:
+                self._set_grant(slot, 0, 0, 0)
+
+    def release(self, lane, granted):
+        """Hand back threads reserved by try_admit()."""
+        if not granted:
+            return
+        with self._locked():
+            slot = self._find_grant(os.getpid(), self.lane_index(lane), granted)
+            if slot is not None:
+                self._set_grant(slot, 0, 0, 0)
+
+    def reclaim(self, pid=None):
+        """
+        Hand back the grants of a dead process.
+
+        Args:
+            pid: Process that exited, or None to check every pid holding a
+                grant and reclaim those that no longer exist
+
+        Returns:
+            Number of threads reclaimed
+        """
+        reclaimed = 0
+        with self._locked():
+            for slot in range(GRANT_SLOTS):
+                holder, index, threads = self._grant(slot)
+                if not holder:
+                    continue
+                if pid is not None:
+                    if holder != pid:
+                        continue
+                elif holder == os.getpid() or _pid_exists(holder):
+                    continue
+                self._set_grant(slot, 0, 0, 0)
+                reclaimed += threads
+        if reclaimed:
+            logger.warning(f"Reclaimed {reclaimed} encoder threads of "
+                           f"{'process ' + str(pid) if pid else 'exited processes'}")
+        return reclaimed
+
+    def metrics(self):
+        """Snapshot of the budget and admission counters of every lane."""
+        with self._locked():
+            lanes = {}
+            for index, name in enumerate(self.lane_names):
+                lane = {'waiting': 0, 'running': 0, 'threads': 0}
+                lane.update((field, self._counters[self._slot(index, field)]) for field in _LANE_FIELDS)
+                lane['admitted'] = int(lane['admitted'])
+                lane['avg_wait_seconds'] = round(lane['wait_seconds'] / lane['admitted'], 3) if lane['admitted'] else 0.0
+                lanes[name] = lane
+            for slot in range(GRANT_SLOTS):
+                pid, index, threads = self._grant(slot)
+                if not pid:
+                    continue
+                lane = lanes[self.lane_names[index]]
+                if threads:
+                    lane['running'] += 1
+                    lane['threads'] += threads
+                else:
+                    lane['waiting'] += 1
+            return {
+                'budget': self.budget,
+                'reserve': self.reserve,
+                'available': self._available(),
+                'lanes': lanes,
+                'updated_at': time.time()
+            }
+
+    def write_metrics(self, path=SCHEDULER_METRICS_PATH):
+        """Publish metrics() as JSON for the web processes."""
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.metrics(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error writing scheduler metrics: {str(e)}")
+
+def read_metrics(path=SCHEDULER_METRICS_PATH):
+    """Last metrics published by the media worker pool, or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def apply_lane(cmd, lane_config, threads):
+    """
+    Adjust an ffmpeg command for an admitted lane.
+
+    Sets -threads to the granted number (ahead of the output) and runs the
+    command under nice and ionice for the lane's CPU and I/O priority, where
+    those tools exist.
+    Commands with several video encoders (per-stream -c:v:N, like HLS
+    ladders) get the grant split between them, since -threads applies to
+    every encoder. The decoders (-threads ahead of every -i) and the filter
+    graphs (-filter_threads, -filter_complex_threads) are capped at the
+    grant too, otherwise each starts a thread per core.
+
+    Returns:
+        The adjusted command
+    """
+    cmd = list(cmd)
+    # Input, output and filter thread options are all set again below
+    for option in ('-threads', '-filter_threads', '-filter_complex_threads'):
+        while option in cmd:
+            del cmd[cmd.index(option):cmd.index(option) + 2]
+
+    encoders = sorted({arg.rsplit(':', 1)[1] for arg in cmd if re.match(r'^-c:v:\d+$', arg)}, key=int)
+    if len(encoders) > 1:
+        share = str(max(1, threads // len(encoders)))
+        cmd[-1:-1] = [arg for index in encoders for arg in (f"-threads:v:{index}", share)]
+    else:
+        cmd[-1:-1] = ['-threads', str(threads)]
+
+    inputs = [position for position, arg in enumerate(cmd) if arg == '-i']
+    for position in reversed(inputs):
+        cmd[position:position] = ['-threads', str(threads)]
+    cmd[1:1] = ['-filter_threads', str(threads)]
+    if '-filter_complex' in cmd:
+        cmd[1:1] = ['-filter_complex_threads', str(threads)]
+
+    ionice_class = lane_config.get('ionice_class')
+    if ionice_class and shutil.which('ionice'):
+        prefix = ['ionice', '-c', str(ionice_class)]
+        if ionice_class == 2 and lane_config.get('ionice_level') is not None:
+            prefix += ['-n', str(lane_config['ionice_level'])]
+        cmd = prefix + cmd
+
+    nice = lane_config.get('nice', 0)
+    if nice and shutil.which('nice'):
+        cmd = ['nice', '-n', str(nice)] + cmd
+    return cmd
@@ -1,12 +1,56 @@
+import io
 import os
 import uuid
 import json
+import shutil
+import hashlib
 from werkzeug.utils import secure_filename
 from config import ALLOWED_EXTENSIONS, UPLOAD_FOLDER
 import logging
 
 logger = logging.getLogger(__name__)
 
+class IngestFile(io.FileIO):
+    """Disk file that multipart uploads are streamed into as they arrive.
+    
+    It lives in INCOMING_FOLDER, on the same filesystem as UPLOAD_FOLDER, so
+    keeping an upload is a rename instead of a second copy. The SHA-256 hash
+    and size are computed while the request body is written. Files that are
+    never committed are removed when the request closes them.
+    """
+    
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{uuid.uuid4().hex}.part")
+        super().__init__(self.path, 'w+')
+        self.bytes_written = 0
+        self.committed = False
+        self._hash = hashlib.sha256()
+    
+    def write(self, data):
+        written = super().write(data)
+        if written:
+            self._hash.update(memoryview(data)[:written])
+            self.bytes_written += written
+        return written
+    
+    def hexdigest(self):
+        return self._hash.hexdigest()
+    
+    def commit(self, final_path):
+        """Atomically move the received file to its final location."""
+        os.replace(self.path, final_path)
+        self.path = final_path
+        self.committed = True
+    
+    def close(self):
+        super().close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
 def allowed_file(filename, allowed_extensions=None):
     """Check if the file extension is allowed.
     
@@ -35,6 +79,23 @@ def generate_unique_filename(filename):
     unique_filename = f"{uuid.uuid4().hex}.{ext}"
     return unique_filename
 
+def generate_output_folder(root):
+    """Path of a new folder under root for files generated from a media item.
+    
+    The name is random like upload filenames: serve_media hands out anything
+    under UPLOAD_FOLDER, so the HLS ladder, storyboard or waveform of a
+    private item must not be reachable by counting media ids.
+    """
+    return os.path.join(root, uuid.uuid4().hex)
+
+def remove_generated_folder(relative_path):
+    """Remove the folder of a generated file, given relative to UPLOAD_FOLDER as stored in encoding_settings."""
+    if not relative_path:
+        return
+    folder = os.path.dirname(os.path.join(UPLOAD_FOLDER, relative_path))
+    if os.path.realpath(folder) != os.path.realpath(UPLOAD_FOLDER):
+        shutil.rmtree(folder, ignore_errors=True)
+
 def save_uploaded_file(file, subfolder=None, allowed_extensions=None):
     """Save an uploaded file to the filesystem with a unique filename.
     
@@ -60,12 +121,24 @@ def save_uploaded_file(file, subfolder=None, allowed_extensions=None):
             file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
         
         try:
-            file.save(file_path)
+            stream = getattr(file, 'stream', None)
+            if isinstance(stream, IngestFile):
+                # Already on disk next to UPLOAD_FOLDER; just rename it into place
+                stream.commit(file_path)
+                content_hash = stream.hexdigest()
+                file_size = stream.bytes_written
+            else:
+                file.save(file_path)
+                content_hash = None
+                file_size = os.path.getsize(file_path)
+            
             # Return dictionary with file information
             return {
                 'file_path': file_path,
                 'original_filename': original_filename,
                 'unique_filename': unique_filename,
+                'content_hash': content_hash,
+                'file_size': file_size,
                 'error': None
             }
         except Exception as e:
@@ -74,6 +147,56 @@ def save_uploaded_file(file, subfolder=None, allowed_extensions=None):
     
     return {'error': 'Invalid file type', 'file_path': None}
 
+def write_stream_at(stream, file_path, offset, length, buffer_size=1024 * 1024):
+    """Copy exactly `length` bytes from a stream into a file at the given offset.
+    
+    The data is copied in small pieces so the request body is never held in
+    memory, and pwrite lets several requests fill the same file concurrently.
+    
+    Returns:
+        Number of bytes written
+    
+    Raises:
+        FileNotFoundError: The file does not exist (any more)
+    """
+    written = 0
+    fd = os.open(file_path, os.O_WRONLY)
+    try:
+        while written < length:
+            data = memoryview(stream.read(min(buffer_size, length - written)))
+            if not data:
+                break
+            # pwrite may write less than it was given
+            while data:
+                count = os.pwrite(fd, data, offset + written)
+                data = data[count:]
+                written += count
+    finally:
+        os.close(fd)
+    return written
+
+def cleanup_upload_sessions(max_age=None):
+    """Delete chunked upload sessions (and their partial files) that were abandoned.
+    
+    Returns:
+        Number of sessions removed
+    """
+    from datetime import datetime, timedelta
+    from app import db
+    from models import UploadSession
+    from config import CHUNKED_UPLOAD_EXPIRY
+    
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age or CHUNKED_UPLOAD_EXPIRY)
+    stale_sessions = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+    
+    for upload_session in stale_sessions:
+        if upload_session.status != 'complete':
+            delete_file(upload_session.part_path)
+        db.session.delete(upload_session)
+    
+    db.session.commit()
+    return len(stale_sessions)
+
 def format_file_size(size_bytes):
     """Format file size from bytes to human-readable format."""
     if size_bytes < 1024:
@@ -0,0 +1,268 @@
+"""
+Concurrent viewer tracking from player heartbeats.
+
+Viewer pages send a heartbeat every VIEWER_HEARTBEAT_INTERVAL seconds with
+a per-tab session id. A heartbeat only touches a file in a tmpfs directory
+shared by all workers:
+
+    <VIEWER_FOLDER>/<stream id>/<session id>  mtime = last heartbeat
+    <VIEWER_FOLDER>/<stream id>/.joins         one byte appended per new session
+
+    <VIEWER_FOLDER>/<stream id>/.hll           unique viewer sketch registers
+    <VIEWER_FOLDER>/media/<media id>.hll       unique viewer sketch of a media item
+
+so page views and heartbeats never write to the database. The media worker
+pool periodically calls flush_viewer_counts(), which expires sessions
+without a heartbeat for VIEWER_SESSION_TIMEOUT seconds and writes the
+current count, peak, sessions, unique viewers and accumulated watch time of
+every live stream in one commit, then flush_media_viewers() for media items.
+"""
+
+import os
+import re
+import time
+import shutil
+import logging
+from config import VIEWER_FOLDER, VIEWER_SESSION_TIMEOUT
+from hyperloglog import HyperLogLog, add_to_sketch_file, read_sketch_file
+
+logger = logging.getLogger(__name__)
+
+_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+JOINS_FILE = '.joins'
+SKETCH_FILE = '.hll'
+MEDIA_FOLDER = 'media'
+# Kept in LiveStream.stream_stats
+VIEWER_STAT_KEYS = ('peak_viewers', 'total_viewers', 'watch_seconds', 'unique_viewers', 'viewer_sketch')
+
+def _stream_folder(stream_id):
+    return os.path.join(VIEWER_FOLDER, str(int(stream_id)))
+
+def viewer_identity():
+    """Identity of the current viewer for unique counts: the user, or address and browser."""
+    from flask import request
+    from flask_login import current_user
+
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    address = request.headers.get('X-Real-IP') or request.remote_addr or ''
+    return f"anon:{address}|{request.headers.get('User-Agent', '')}"
+
+def heartbeat(stream_id, session_id, leaving=False, identity=None):
+    """
+    Record a heartbeat (or the departure) of a viewer session.
+
+    Args:
+        stream_id: Stream being watched
+        session_id: Random id of the viewer page
+        leaving: The page is being closed
+        identity: Viewer identity added to the unique viewer sketch when the
+            session is new
+
+    Returns:
+        False if the session id is invalid
+    """
+    if not session_id or not _SESSION_ID.match(session_id):
+        return False
+
+    folder = _stream_folder(stream_id)
+    path = os.path.join(folder, session_id)
+    if leaving:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(folder, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        return True  # Another tab request created it first
+    os.close(fd)
+    # O_APPEND writes are atomic, the file size counts the sessions
+    fd = os.open(os.path.join(folder, JOINS_FILE), os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o600)
+    try:
+        os.write(fd, b'.')
+    finally:
+        os.close(fd)
+    if identity:
+        add_to_sketch_file(os.path.join(folder, SKETCH_FILE), identity)
+    return True
+
+def record_media_viewer(media_id, identity):
+    """Add a viewer of a media item to its pending unique viewer sketch."""
+    folder = os.path.join(VIEWER_FOLDER, MEDIA_FOLDER)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        add_to_sketch_file(os.path.join(folder, f"{int(media_id)}.hll"), identity)
+    except OSError as e:
+        logger.error(f"Error recording viewer of media {media_id}: {str(e)}")
+
+def stream_sketch(stream):
+    """Unique viewer sketch of a stream's session: flushed registers merged with pending ones."""
+    sketch = HyperLogLog.from_json((stream.stream_stats or {}).get('viewer_sketch'))
+    pending = read_sketch_file(os.path.join(_stream_folder(stream.id), SKETCH_FILE))
+    if pending is not None and pending.precision == sketch.precision:
+        sketch.merge(pending)
+    return sketch
+
+def collect_viewers(stream_id, timeout=VIEWER_SESSION_TIMEOUT):
+    """
+    Count active sessions of a stream, removing expired ones.
+
+    Returns:
+        Tuple of (active sessions, sessions seen since the last reset)
+    """
+    folder = _stream_folder(stream_id)
+    cutoff = time.time() - timeout
+    active = 0
+    joins = 0
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return 0, 0
+
+    for entry in entries:
+        try:
+            if entry.name == JOINS_FILE:
+                joins = entry.stat().st_size
+            elif entry.name == SKETCH_FILE:
+                continue
+            elif entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+            else:
+                active += 1
+        except FileNotFoundError:
+            continue
+    return active, joins
+
+def reset_viewers(stream_id):
+    """Forget all sessions of a stream (at stream start and end)."""
+    shutil.rmtree(_stream_folder(stream_id), ignore_errors=True)
+
+def begin_viewer_tracking(stream):
+    """Start counting viewers of a stream from zero; the caller commits."""
+    reset_viewers(stream.id)
+    stream.viewer_count = 0
+    stream.stream_stats = {key: value for key, value in (stream.stream_stats or {}).items()
+                           if key not in VIEWER_STAT_KEYS}
+
+_last_flush = None
+
+def flush_viewer_counts():
+    """
+    Write viewer counts of live streams to the database in one commit.
+
+    Updates viewer_count and stream_stats (peak_viewers, total_viewers,
+    watch_seconds) of every live stream, and drops the session folders of
+    streams that are no longer live. Must be called within an application
+    context.
+
+    Returns:
+        Number of streams updated
+    """
+    global _last_flush
+    from app import db
+    from models import LiveStream
+
+    now = time.time()
+    # Watch time accrues for the time since the last flush of this process
+    elapsed = min(now - _last_flush, 2 * VIEWER_SESSION_TIMEOUT) if _last_flush else 0
+    _last_flush = now
+
+    live_ids = set()
+    updated = 0
+    for stream in LiveStream.query.filter_by(is_live=True).all():
+        live_ids.add(str(stream.id))
+        active, joins = collect_viewers(stream.id)
+        stats = dict(stream.stream_stats or {})
+        new_stats = dict(stats)
+        new_stats['peak_viewers'] = max(stats.get('peak_viewers', 0), active)
+        new_stats['total_viewers'] = max(stats.get('total_viewers', 0), joins)
+        new_stats['watch_seconds'] = stats.get('watch_seconds', 0) + int(active * elapsed)
+        sketch = stream_sketch(stream)
+        new_stats['viewer_sketch'] = sketch.to_json()
+        new_stats['unique_viewers'] = sketch.count()
+
+        if active != stream.viewer_count or new_stats != stats:
+            stream.viewer_count = active
+            stream.stream_stats = new_stats  # Reassigned so the JSON column is saved
+            updated += 1
+
+    if updated:
+        db.session.commit()
+
+    try:
+        folders = os.listdir(VIEWER_FOLDER)
+    except FileNotFoundError:
+        folders = []
+    for name in folders:
+        if name not in live_ids and name != MEDIA_FOLDER:
+            shutil.rmtree(os.path.join(VIEWER_FOLDER, name), ignore_errors=True)
+
+    return updated
+
+def flush_media_viewers():
+    """
+    Merge pending unique viewer sketches into Media.playback_stats.
+
+    Each pending file is renamed before it is read, so viewers recorded
+    meanwhile start a new file instead of being lost. Must be called within
+    an application context.
+
+    Returns:
+        Number of media items updated
+    """
+    import fcntl
+    from app import db
+    from models import Media
+
+    folder = os.path.join(VIEWER_FOLDER, MEDIA_FOLDER)
+    try:
+        names = [name for name in os.listdir(folder) if name.endswith('.hll')]
+    except FileNotFoundError:
+        return 0
+
+    flushed = []
+    updated = 0
+    for name in names:
+        path = os.path.join(folder, name)
+        flushing = path + '.flushing'
+        try:
+            os.replace(path, flushing)
+            # Wait for writers that opened the file before the rename
+            with open(flushing, 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+        except FileNotFoundError:
+            continue
+        flushed.append(flushing)
+
+        pending = read_sketch_file(flushing)
+        media = Media.query.get(int(name[:-len('.hll')]))
+        if pending is None or media is None:
+            continue
+        stats = dict(media.playback_stats or {})
+        sketch = HyperLogLog.from_json(stats.get('viewer_sketch'))
+        if pending.precision != sketch.precision:
+            continue
+        sketch.merge(pending)
+        stats['viewer_sketch'] = sketch.to_json()
+        stats['unique_viewers'] = sketch.count()
+        media.playback_stats = stats  # Reassigned so the JSON column is saved
+        updated += 1
+
+    if updated:
+        db.session.commit()
+    for path in flushed:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return updated
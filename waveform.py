@@ -0,0 +1,135 @@
+"""
+Precomputed audio waveforms.
+
+A waveform file holds min/max peak pairs at several resolutions, each level
+summarising WAVEFORM_LEVEL_FACTOR times more samples per peak than the one
+before. Players request the level that matches their width, which is read
+straight from the file; audio is never decoded on request.
+
+File layout (little endian):
+    header: magic b'SLWF', version (u16), bits per value (u16),
+            sample rate (u32), level count (u32)
+    per level: samples per peak (u32), peak count (u32), data offset (u32)
+    data: interleaved min, max values as int8 or int16
+"""
+
+import struct
+import logging
+from config import WAVEFORM_SAMPLES_PER_PEAK, WAVEFORM_LEVEL_FACTOR, WAVEFORM_MIN_PEAKS
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SLWF'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHII')
+_LEVEL = struct.Struct('<III')
+
+def compute_levels(pcm, block_peaks=65536):
+    """
+    Compute min/max peak levels from mono 16-bit PCM.
+
+    Args:
+        pcm: NumPy int16 array (a np.memmap works, it is read block by block)
+        block_peaks: Finest-level peaks computed per block, bounds memory use
+
+    Returns:
+        List of (samples_per_peak, mins, maxs) tuples, finest level first
+    """
+    import numpy as np
+
+    spp = WAVEFORM_SAMPLES_PER_PEAK
+    count = -(-len(pcm) // spp)
+    mins = np.empty(count, dtype=np.int16)
+    maxs = np.empty(count, dtype=np.int16)
+
+    block = block_peaks * spp
+    for start in range(0, len(pcm), block):
+        chunk = np.asarray(pcm[start:start + block])
+        full = len(chunk) // spp
+        first = start // spp
+        if full:
+            frames = chunk[:full * spp].reshape(full, spp)
+            mins[first:first + full] = frames.min(axis=1)
+            maxs[first:first + full] = frames.max(axis=1)
+        if len(chunk) % spp:
+            # Partial last peak at the end of the recording
+            tail = chunk[full * spp:]
+            mins[first + full] = tail.min()
+            maxs[first + full] = tail.max()
+
+    levels = [(spp, mins, maxs)]
+    factor = WAVEFORM_LEVEL_FACTOR
+    while len(mins) > WAVEFORM_MIN_PEAKS:
+        # Pad with the last values so the reduction does not invent silence
+        pad = (-len(mins)) % factor
+        if pad:
+            mins = np.concatenate([mins, np.repeat(mins[-1:], pad)])
+            maxs = np.concatenate([maxs, np.repeat(maxs[-1:], pad)])
+        mins = mins.reshape(-1, factor).min(axis=1)
+        maxs = maxs.reshape(-1, factor).max(axis=1)
+        spp *= factor
+        levels.append((spp, mins, maxs))
+
+    return levels
+
+def write_waveform(path, levels, sample_rate, bits=8):
+    """Write computed levels to a waveform file, quantised to int8 or int16."""
+    import numpy as np
+
+    dtype = np.dtype('<i1') if bits == 8 else np.dtype('<i2')
+    payloads = []
+    for spp, mins, maxs in levels:
+        pairs = np.empty(len(mins) * 2, dtype=np.int16)
+        pairs[0::2] = mins
+        pairs[1::2] = maxs
+        if bits == 8:
+            pairs = pairs >> 8
+        payloads.append(pairs.astype(dtype).tobytes())
+
+    offset = _HEADER.size + _LEVEL.size * len(levels)
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, bits, sample_rate, len(levels)))
+        for (spp, mins, maxs), payload in zip(levels, payloads):
+            f.write(_LEVEL.pack(spp, len(mins), offset))
+            offset += len(payload)
+        for payload in payloads:
+            f.write(payload)
+
+def read_waveform_level(path, peaks=None):
+    """
+    Read one level of a waveform file.
+
+    Picks the coarsest level that still has at least `peaks` peaks, or the
+    finest level when none has that many.
+
+    Returns:
+        Dictionary with sample_rate, bits, samples_per_peak, peaks and data
+        (raw interleaved min/max bytes), or None if the file is missing or invalid
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic, version, bits, sample_rate, count = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                logger.error(f"Not a waveform file: {path}")
+                return None
+
+            levels = [_LEVEL.unpack(f.read(_LEVEL.size)) for _ in range(count)]
+            chosen = levels[0]
+            for level in levels:
+                if peaks and level[1] >= peaks:
+                    chosen = level
+
+            spp, peak_count, offset = chosen
+            f.seek(offset)
+            data = f.read(peak_count * 2 * (bits // 8))
+    except (OSError, struct.error) as e:
+        logger.error(f"Error reading waveform {path}: {str(e)}")
+        return None
+
+    return {
+        'sample_rate': sample_rate,
+        'bits': bits,
+        'samples_per_peak': spp,
+        'peaks': peak_count,
+        'data': data
+    }